@@ -0,0 +1,113 @@
+"""
+Admission control for the job queue.
+
+Every accepted job holds a place in the queue until it finishes. Once the
+queue is full, new work is turned away with 429 and a Retry-After estimate
+instead of piling up and slowing every job down. Jobs in the shared job
+queue count for every node; work that only runs in this process (trims,
+combines) holds a place here while it runs.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_JOB_SECONDS = 60.0  # Used for Retry-After until a job has finished
+DURATION_SMOOTHING = 0.2
+MAX_RETRY_AFTER = 600
+
+
+class JobQueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Job queue is full, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class JobTooLarge(Exception):
+    """
+    Work needing more places than the queue has, which no wait will admit.
+    """
+
+    def __init__(self, weight, max_jobs):
+        super().__init__(f'Needs {weight} places in the job queue, which holds {max_jobs}')
+        self.weight = weight
+        self.max_jobs = max_jobs
+
+
+class AdmissionController:
+    """
+    `queued`, if given, returns the places held in the shared job queue.
+    """
+
+    def __init__(self, max_jobs, queued=None):
+        self.max_jobs = max_jobs
+        self.queued = queued
+        self._inflight = 0
+        self._avg_job_seconds = DEFAULT_JOB_SECONDS
+        self._lock = threading.Lock()
+
+    @property
+    def inflight(self):
+        return self._inflight + (self.queued() if self.queued else 0)
+
+    def retry_after(self, weight=1, inflight=None):
+        """
+        Seconds until `weight` places are likely to be free. The queue works
+        through about max_jobs jobs per average job duration, so the wait
+        grows with how far the queue is over its limit.
+        """
+        inflight = self.inflight if inflight is None else inflight
+        with self._lock:
+            estimate = self._avg_job_seconds * max(1, inflight + weight - self.max_jobs) / max(1, self.max_jobs)
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(estimate)))
+
+    def check(self, weight=1):
+        """
+        Raise JobTooLarge or JobQueueFull unless `weight` more places fit.
+        For work that holds its place by being in the shared queue.
+        """
+        if weight > max(1, self.max_jobs):
+            raise JobTooLarge(weight, self.max_jobs)
+        inflight = self.inflight
+        if inflight + weight > self.max_jobs:
+            raise JobQueueFull(self.retry_after(weight, inflight))
+
+    def try_acquire(self, weight=1):
+        """
+        Take `weight` places for work in this process, or raise as check() does.
+        """
+        if weight > max(1, self.max_jobs):
+            raise JobTooLarge(weight, self.max_jobs)
+        queued = self.queued() if self.queued else 0
+        with self._lock:
+            inflight = self._inflight + queued
+            full = inflight + weight > self.max_jobs
+            if not full:
+                self._inflight += weight
+        if full:
+            raise JobQueueFull(self.retry_after(weight, inflight))
+
+    def release(self, weight=1, duration=None):
+        """
+        Give back places. Passing the job's duration refines Retry-After.
+        """
+        with self._lock:
+            self._inflight = max(0, self._inflight - weight)
+        if duration is not None:
+            self.observe(duration)
+
+    def observe(self, duration):
+        """
+        Record how long a job took, for Retry-After.
+        """
+        with self._lock:
+            self._avg_job_seconds += DURATION_SMOOTHING * (duration - self._avg_job_seconds)
+
+    @contextmanager
+    def admit(self, weight=1):
+        self.try_acquire(weight)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(weight, time.monotonic() - start)
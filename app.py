@@ -1,239 +1,362 @@
-from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
+from flask import Blueprint, Flask, current_app, g, render_template, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 from werkzeug.utils import secure_filename
+import werkzeug.utils
 import os
-import replicate
 import json
-from pydub import AudioSegment
 import tempfile
 import shutil
 from pathlib import Path
 import zipfile
 from datetime import datetime
-import re
-import time
-import requests
 import base64
+import functools
+import glob
+import importlib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import log
+import workers
+from workers import run_in_process
+from admission import AdmissionController, JobQueueFull, JobTooLarge
+from artifacts import FilesystemArtifactStore
+from batch import EXPORT_WORKERS, OUTPUT_COMBINED, OUTPUT_MODES, cancel_batch, create_batch, discard_batch, get_batch
+from jobs import (
+    JOB_STATUSES, STATUS_CANCELED, STATUS_READY, STATUS_TRANSCRIBING, UNFINISHED_STATUSES, Job, JobStore, cancel_job,
+    leave_job, run_job, wait_for_job
+)
+from job_queue import JOB_LEASE, JobWorkers, SqliteJobQueue
+from cancellation import CancelToken, Cancelled, cancel_on_disconnect, run_subprocess
+from pipeline import (
+    DEFAULT_OUTPUT_FORMAT, DEFAULT_SPLIT_MODE, SPLIT_MODES, OUTPUT_FORMATS, estimate_export_time, estimate_transcription_time, friendly_error_message, get_audio_duration,
+    normalize_output_options, probe_audio_duration, render_segment, store_upload
+)
+from segment_cache import SegmentCache, segment_key
+from kling import create_lipsync_batch, discard_lipsync_batch, get_kling_client, get_lipsync_batch
+from chunked_upload import CHUNK_SIZE, MAX_UPLOAD_BYTES, ChunkedUploads, OffsetMismatch, UploadNotFound, UploadTooLarge
 
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
-app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
-app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # Disable caching for development
+DEFAULT_CONFIG = {
+    'MAX_CONTENT_LENGTH': 500 * 1024 * 1024,  # 500MB max file size
+    'UPLOAD_FOLDER': None,  # Private temp dir created on first use; set it to a shared path to run several nodes
+    'STATE_FOLDER': None,  # Job database, locks, segment cache and chunked uploads; defaults to '<UPLOAD_FOLDER>.state'
+    'SEND_FILE_MAX_AGE_DEFAULT': 0,  # Disable caching for development
+    'MAX_QUEUED_JOBS': 200,  # Accepted-but-unfinished jobs before new work gets a 429
+    'CPU_WORKERS': None,  # Processes for decoding/encoding; defaults to the CPU count
+    'SEGMENT_CACHE_BYTES': 2 * 1024 * 1024 * 1024,  # Disk budget for rendered segments (LRU)
+    'JOB_DATABASE': None,  # SQLite job store; defaults to jobs.sqlite3 in STATE_FOLDER
+    'JOB_QUEUE': 'sqlite',  # Or 'module:Class' for another queue backend (see job_queue)
+    'ARTIFACT_STORE': 'filesystem',  # Or 'module:Class' for another artifact backend (see artifacts)
+    'JOB_WORKERS': 16,  # Jobs this process runs at once; 0 makes a node that only accepts and serves
+    'JOB_LEASE_SECONDS': JOB_LEASE,  # Heartbeat silence before another worker takes over a running job
+    'PRERENDER_SEGMENTS': False,  # Encode segments into the cache as soon as they are planned
+    'KLING_API_BASE': 'https://api.klingai.com',  # Overridden to point load tests at a local fake
+    'SENDFILE_BACKEND': None,  # 'x-accel-redirect' (nginx) or 'x-sendfile' to let a fronting proxy send downloads
+    'ACCEL_REDIRECT_PREFIX': '/_artifacts/',  # Internal nginx location aliased to UPLOAD_FOLDER
+    'KLING_MAX_CONCURRENT_TASKS': 4,  # Lipsync tasks running at once per Kling key
+    'KLING_REQUESTS_PER_SECOND': 2.0,  # Kling API calls per second per key
+    'KLING_POLL_INTERVAL': 5.0,  # Seconds between status checks of a batch's Kling tasks
+    'MAX_CHUNKED_UPLOAD_BYTES': MAX_UPLOAD_BYTES,  # Size limit for /api/uploads/chunked (each chunk is within MAX_CONTENT_LENGTH)
+    'LOG_LEVEL': 'INFO',  # DEBUG adds prediction polling, ffmpeg commands and sampled payload dumps
+    'LOG_DEBUG_SAMPLE_RATE': log.DEBUG_SAMPLE_RATE,  # Share of debug payload dumps written
+    'LOG_MAX_FIELD_CHARS': log.MAX_FIELD_CHARS,  # Longer logged values are truncated
+}
 
-# Increase request timeouts for large file uploads
-import socket
-socket.setdefaulttimeout(300)  # 5 minutes default timeout
+SENDFILE_BACKENDS = ('x-accel-redirect', 'x-sendfile')
 
-# Increase timeouts for long-running requests
-import signal
-signal.signal(signal.SIGALRM, lambda *args: None)  # Prevent timeouts
+bp = Blueprint('segmenter', __name__)
 
-ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg', 'm4a', 'flac', 'aac', 'wma'}
+_upload_folder_lock = threading.Lock()
+_state_folder_lock = threading.Lock()
+_segment_cache_lock = threading.Lock()
+_jobs_lock = threading.Lock()
+_job_queue_lock = threading.Lock()
+_artifacts_lock = threading.Lock()
+_chunked_uploads_lock = threading.Lock()
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+JOB_QUEUES = {'sqlite': SqliteJobQueue}
+ARTIFACT_STORES = {'filesystem': FilesystemArtifactStore}
 
-def parse_srt_to_segments(srt_text):
+def create_app(config=None):
     """
-    Parse SRT format text to extract segments with millisecond-accurate timestamps.
-    SRT format:
-    1
-    00:00:00,000 --> 00:00:02,500
-    Text here
+    Application factory. Settings come from DEFAULT_CONFIG, then
+    AUDIO_SEGMENTER_* environment variables, then `config`.
     """
-    segments = []
+    app = Flask(__name__)
+    CORS(app)  # Enable CORS for all routes
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_prefixed_env('AUDIO_SEGMENTER')
+    if config:
+        app.config.update(config)
     
-    # Split by double newlines to get each subtitle block
-    blocks = re.split(r'\n\s*\n', srt_text.strip())
+    if app.config['SENDFILE_BACKEND'] not in (None, *SENDFILE_BACKENDS):
+        raise ValueError(f"SENDFILE_BACKEND must be one of: {', '.join(SENDFILE_BACKENDS)}")
     
-    for block in blocks:
-        lines = block.strip().split('\n')
-        if len(lines) >= 3:
-            # Parse timestamp line (format: 00:00:00,000 --> 00:00:02,500)
-            timestamp_line = lines[1]
-            match = re.match(r'(\d{2}):(\d{2}):(\d{2}),(\d{3})\s*-->\s*(\d{2}):(\d{2}):(\d{2}),(\d{3})', timestamp_line)
-            
-            if match:
-                # Start time
-                start_h, start_m, start_s, start_ms = map(int, match.groups()[:4])
-                start_time = start_h * 3600 + start_m * 60 + start_s + start_ms / 1000.0
-                
-                # End time
-                end_h, end_m, end_s, end_ms = map(int, match.groups()[4:])
-                end_time = end_h * 3600 + end_m * 60 + end_s + end_ms / 1000.0
-                
-                # Text (join remaining lines)
-                text = ' '.join(lines[2:]).strip()
-                
-                segments.append({
-                    'start': start_time,
-                    'end': end_time,
-                    'text': text
-                })
+    workers.configure(app.config['CPU_WORKERS'])
+    log.configure(app.config['LOG_LEVEL'], app.config['LOG_DEBUG_SAMPLE_RATE'], app.config['LOG_MAX_FIELD_CHARS'])
+    app.extensions['admission'] = AdmissionController(app.config['MAX_QUEUED_JOBS'], queued=queued_jobs)
+    
+    app.register_blueprint(bp)
     
-    return segments
+    # Run queued jobs, including any a previous run or a dead node left unfinished.
+    # The queue (and SQLite) is opened by the dispatcher thread, off the startup path.
+    if app.config['JOB_WORKERS']:
+        JobWorkers(app, get_job_queue, app.config['JOB_WORKERS'], lambda job: process_job(job, job.prerender)).start()
+    return app
 
-def find_split_points(segments, max_duration=60.0):
+def load_backend(spec, builtins):
     """
-    Find optimal split points in transcript based on punctuation marks.
-    Ensures each segment is as long as possible without exceeding max_duration.
-    Only splits at punctuation if there are 3+ words before it.
+    Class for a backend setting: a built-in name, or 'module:Class'.
     """
-    split_points = []
-    current_start = 0.0
-    
-    # Get total duration from segments
-    if not segments:
-        return split_points
-    
-    total_duration = segments[-1].get('end', 0)
-    if total_duration is None:
-        total_duration = 0
-    
-    # Build a list of all word timings with their text
-    word_timings = []
-    for segment in segments:
-        text = segment.get('text', '').strip()
-        start_time = segment.get('start', 0)
-        end_time = segment.get('end', start_time)
-        
-        # Skip segments with invalid timestamps
-        if start_time is None:
-            start_time = 0
-        if end_time is None:
-            end_time = start_time
-        
-        if text and end_time > 0:
-            word_timings.append({
-                'start': start_time,
-                'end': end_time,
-                'text': text
-            })
-    
-    if not word_timings:
-        return split_points
-    
-    # Find split points by looking for the best break before max_duration
-    current_start = 0.0
-    
-    while current_start < total_duration:
-        target_time = current_start + max_duration
-        
-        # Accumulate text from current_start to count words
-        accumulated_text = []
-        
-        # Find the best split point before target_time
-        best_split = None
-        best_priority = -1
-        
-        for word in word_timings:
-            word_start = word['start']
-            word_end = word['end']
-            text = word['text']
-            
-            # Only consider words in the current segment window
-            if word_end > current_start and word_end <= target_time:
-                # Add to accumulated text
-                accumulated_text.append(text)
-                
-                # Count words in accumulated text (split by spaces and filter empty strings)
-                word_count = len([w for w in ' '.join(accumulated_text).split() if w.strip()])
-                
-                priority = 0
-                
-                # Check last character for punctuation (ONLY punctuation, no spaces)
-                if text and len(text) > 0:
-                    last_char = text[-1]
-                    # Only consider punctuation if we have 3+ words
-                    if word_count >= 3:
-                        if last_char in '.?!':
-                            priority = 3  # Highest - sentence endings
-                        elif last_char in ',;':
-                            priority = 2  # Medium - phrase breaks
-                    # No priority for spaces/word boundaries - people speak continuously
-                
-                # Take the highest priority break point, or the latest one if same priority
-                if priority > 0 and priority >= best_priority:
-                    best_split = word_end
-                    best_priority = priority
-        
-        # If we found a good split point, use it
-        if best_split and best_split > current_start:
-            split_points.append(best_split)
-            current_start = best_split
+    if spec in builtins:
+        return builtins[spec]
+    module, _, name = str(spec).partition(':')
+    if not name:
+        raise ValueError(f"Unknown backend {spec!r}: use one of {', '.join(builtins)} or 'module:Class'")
+    return getattr(importlib.import_module(module), name)
+
+def get_upload_folder():
+    """
+    Working directory for uploads and outputs, created on first use.
+    """
+    with _upload_folder_lock:
+        folder = current_app.config.get('UPLOAD_FOLDER')
+        if not folder:
+            folder = current_app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
         else:
-            # No good split found, just move forward by max_duration
-            current_start += max_duration
-            if current_start < total_duration:
-                split_points.append(current_start)
-    
-    return split_points
+            os.makedirs(folder, exist_ok=True)
+        return folder
 
-def split_audio_file(audio_path, split_points, output_dir):
+def inside_upload_folder(path):
+    upload_folder = os.path.realpath(get_upload_folder())
+    return os.path.commonpath([upload_folder, os.path.realpath(path)]) == upload_folder
+
+def get_state_folder():
     """
-    Split audio file at specified timestamps.
+    Private working directory for the job database, locks, segment cache and
+    chunked uploads, created on first use. It must not be inside the upload
+    folder, which the artifact store (and so the download routes) serves.
     """
-    audio = AudioSegment.from_file(audio_path)
-    segments = []
-    
-    # Add start and end points
-    all_points = [0.0] + split_points + [len(audio) / 1000.0]
-    
-    for i in range(len(all_points) - 1):
-        start_ms = int(all_points[i] * 1000)
-        end_ms = int(all_points[i + 1] * 1000)
-        
-        segment_audio = audio[start_ms:end_ms]
-        
-        # Generate output filename
-        segment_filename = f"segment_{i+1:03d}.mp3"
-        segment_path = os.path.join(output_dir, segment_filename)
-        
-        # Export segment
-        segment_audio.export(segment_path, format="mp3", bitrate="192k")
-        
-        segments.append({
-            'filename': segment_filename,
-            'start_time': all_points[i],
-            'end_time': all_points[i + 1],
-            'duration': all_points[i + 1] - all_points[i]
-        })
-    
-    return segments
+    with _state_folder_lock:
+        folder = current_app.config.get('STATE_FOLDER')
+        if not folder:
+            folder = current_app.config['STATE_FOLDER'] = os.path.realpath(get_upload_folder()) + '.state'
+        if inside_upload_folder(folder):
+            raise ValueError('STATE_FOLDER must not be inside UPLOAD_FOLDER')
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+def get_admission():
+    return current_app.extensions['admission']
+
+def queued_jobs():
+    # Unfinished jobs on every node hold their places in the shared queue
+    return get_job_queue().depth()
+
+def get_jobs():
+    """
+    SQLite job store, opened on first use.
+    """
+    with _jobs_lock:
+        jobs = current_app.extensions.get('jobs')
+        if jobs is None:
+            path = current_app.config['JOB_DATABASE']
+            if path is None:
+                path = os.path.join(get_state_folder(), 'jobs.sqlite3')
+                move_legacy_database(path)
+            elif inside_upload_folder(path):
+                raise ValueError('JOB_DATABASE must not be inside UPLOAD_FOLDER')
+            jobs = current_app.extensions['jobs'] = JobStore(path, artifacts=get_artifacts())
+        return jobs
+
+def move_legacy_database(path):
+    # Earlier versions kept the database in the upload folder, where it could be downloaded
+    legacy_path = os.path.join(get_upload_folder(), 'jobs.sqlite3')
+    if os.path.exists(legacy_path) and not os.path.exists(path):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(legacy_path + suffix):
+                shutil.move(legacy_path + suffix, path + suffix)
+        log.info('job', 'Moved the job database out of the upload folder', path=path)
+
+def get_job_queue():
+    """
+    Queue that jobs wait in until a worker on any node claims them.
+    """
+    with _job_queue_lock:
+        queue = current_app.extensions.get('job_queue')
+        if queue is None:
+            backend = load_backend(current_app.config['JOB_QUEUE'], JOB_QUEUES)
+            queue = current_app.extensions['job_queue'] = backend(get_jobs(), current_app.config['JOB_LEASE_SECONDS'])
+        return queue
+
+def get_artifacts():
+    """
+    Store for uploads, job sources and ZIPs, rooted at the upload folder.
+    """
+    with _artifacts_lock:
+        artifacts = current_app.extensions.get('artifacts')
+        if artifacts is None:
+            backend = load_backend(current_app.config['ARTIFACT_STORE'], ARTIFACT_STORES)
+            artifacts = current_app.extensions['artifacts'] = backend(get_upload_folder())
+        return artifacts
+
+def get_segment_cache():
+    """
+    Rendered-segment cache in the state folder, created on first use.
+    """
+    with _segment_cache_lock:
+        cache = current_app.extensions.get('segment_cache')
+        if cache is None:
+            cache = current_app.extensions['segment_cache'] = SegmentCache(
+                os.path.join(get_state_folder(), 'segment_cache'), current_app.config['SEGMENT_CACHE_BYTES']
+            )
+        return cache
+
+def get_chunked_uploads():
+    """
+    Resumable chunked uploads, kept in the state folder so every worker sees them.
+    """
+    with _chunked_uploads_lock:
+        uploads = current_app.extensions.get('chunked_uploads')
+        if uploads is None:
+            uploads = current_app.extensions['chunked_uploads'] = ChunkedUploads(
+                os.path.join(get_state_folder(), 'chunked'), current_app.config['MAX_CHUNKED_UPLOAD_BYTES']
+            )
+        return uploads
+
+def busy_response(error):
+    """
+    429 for a full job queue, telling the client when to come back.
+    """
+    response = jsonify({'error': 'Server is busy. Please try again shortly.', 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
-def extract_text_for_segments(transcript_segments, audio_segments):
+def admission_controlled(view):
     """
-    Extract transcript text for each audio segment.
+    Hold a place in the job queue for the duration of the request.
     """
-    for audio_seg in audio_segments:
-        start = audio_seg['start_time']
-        end = audio_seg['end_time']
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admission = get_admission()
+        try:
+            admission.try_acquire()
+        except JobQueueFull as e:
+            return busy_response(e)
         
-        text_parts = []
-        for trans_seg in transcript_segments:
-            seg_start = trans_seg.get('start', 0)
-            seg_end = trans_seg.get('end', seg_start)
-            
-            # Handle None values
-            if seg_start is None:
-                seg_start = 0
-            if seg_end is None:
-                seg_end = seg_start
-            
-            # Check if transcript segment overlaps with audio segment
-            if seg_end >= start and seg_start <= end:
-                text_parts.append(trans_seg.get('text', ''))
+        start = time.monotonic()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.release(duration=time.monotonic() - start)
+    return wrapper
+
+def queue_admission(view):
+    """
+    Turn the request away if the shared job queue is full. The job it queues
+    holds its place there; the request's duration refines Retry-After.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admission = get_admission()
+        try:
+            admission.check()
+        except JobQueueFull as e:
+            return busy_response(e)
         
-        audio_seg['text'] = ' '.join(text_parts).strip()
+        start = time.monotonic()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.observe(time.monotonic() - start)
+    return wrapper
+
+def cancel_on_client_disconnect(view):
+    """
+    Give the request a cancel token (g.cancel) that fires if the client hangs
+    up, so work nobody will collect stops right away.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.cancel = CancelToken()
+        with cancel_on_disconnect(request.environ, g.cancel):
+            return view(*args, **kwargs)
+    return wrapper
+
+MAX_PROFILES = 12
+
+ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg', 'm4a', 'flac', 'aac', 'wma'}
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def parse_max_duration(value):
+    """
+    Validate a max segment duration form value. Returns (max_duration, error).
+    """
+    try:
+        max_duration = float(value)
+        if max_duration < 10 or max_duration > 300:
+            return None, 'Max duration must be between 10 and 300 seconds'
+    except (TypeError, ValueError):
+        return None, 'Invalid max duration value'
+    return max_duration, None
+
+def form_list(form, key):
+    """
+    Values of a form field given repeated and/or comma-separated.
+    """
+    return [item.strip() for value in form.getlist(key) for item in value.split(',') if item.strip()]
+
+def parse_profiles(form):
+    """
+    Split profiles from max_duration and split_mode form values, either of
+    which may list several. Every duration is cut in every mode, in the order
+    given. Returns (profiles, error) with profiles as [(max_duration, split_mode)].
+    """
+    durations = []
+    for value in form_list(form, 'max_duration') or [60]:
+        max_duration, error = parse_max_duration(value)
+        if error:
+            return None, error
+        durations.append(max_duration)
+    modes = form_list(form, 'split_mode') or [DEFAULT_SPLIT_MODE]
+    for mode in modes:
+        if mode not in SPLIT_MODES:
+            return None, f'Split mode must be one of: {", ".join(SPLIT_MODES)}'
     
-    return audio_segments
+    profiles = []
+    for max_duration in durations:
+        for mode in modes:
+            if (max_duration, mode) not in profiles:
+                profiles.append((max_duration, mode))
+    if len(profiles) > MAX_PROFILES:
+        return None, f'At most {MAX_PROFILES} split profiles per job'
+    return profiles, None
+
+def parse_flag(value, default=False):
+    if value is None or value == '':
+        return default
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def parse_output_options(form):
+    """
+    Read output_format/bitrate form values. Returns (output_format, bitrate, error).
+    """
+    try:
+        output_format, bitrate = normalize_output_options(form.get('output_format'), form.get('bitrate'))
+    except ValueError as e:
+        return None, None, str(e)
+    return output_format, bitrate, None
 
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/test')
+@bp.route('/test')
 def test():
     return '''
     <!DOCTYPE html>
@@ -269,7 +392,7 @@ def test():
     </html>
     '''
 
-@app.route('/api/estimate-time', methods=['POST'])
+@bp.route('/api/estimate-time', methods=['POST'])
 def estimate_time():
     """Get estimated processing time for an audio file without processing it"""
     try:
@@ -280,23 +403,37 @@ def estimate_time():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        # Save temporarily to get duration
+        # Save temporarily to get duration; unique per request so concurrent uploads of the same name don't collide
         filename = secure_filename(file.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f'temp_{filename}')
+        temp_path = os.path.join(get_upload_folder(), f'temp_{uuid.uuid4().hex[:8]}_{filename}')
         file.save(temp_path)
         
         try:
-            audio = AudioSegment.from_file(temp_path)
-            audio_duration_seconds = len(audio) / 1000.0
-            # incredibly-fast-whisper with batch_size=4: ~33x real-time speed (30 min in 54 sec)
-            estimated_transcription_time = int(audio_duration_seconds / 33)
+            # A header probe is enough for an estimate and avoids decoding (or starting the process pool)
+            try:
+                audio_duration_seconds = probe_audio_duration(temp_path)
+            except Exception as e:
+                log.info('upload', 'Duration probe failed, decoding instead', error=str(e))
+                audio_duration_seconds = run_in_process(get_audio_duration, temp_path)
+            estimated_transcription_time = estimate_transcription_time(audio_duration_seconds)
             
             os.remove(temp_path)
             
-            return jsonify({
+            result = {
                 'audio_duration': audio_duration_seconds,
-                'estimated_time': estimated_transcription_time
-            })
+                'estimated_time': estimated_transcription_time,
+                'estimated_export_time': estimate_export_time(
+                    audio_duration_seconds, request.form.get('output_format') or DEFAULT_OUTPUT_FORMAT
+                )
+            }
+            
+            # With the key, also estimate the wait behind that key's queued transcriptions
+            api_key = request.form.get('api_key')
+            if api_key:
+                from replicate_client import get_client
+                result['estimated_wait'] = int(get_client(api_key).expected_wait(estimated_transcription_time))
+            
+            return jsonify(result)
         except Exception as e:
             if os.path.exists(temp_path):
                 os.remove(temp_path)
@@ -305,10 +442,11 @@ def estimate_time():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/process', methods=['POST'])
+@bp.route('/api/process', methods=['POST'])
+@queue_admission
+@cancel_on_client_disconnect
 def process_audio():
-    uploaded_file_path = None
-    output_dir = None
+    source = None
     
     try:
         # Check if file is present
@@ -327,262 +465,808 @@ def process_audio():
         if not api_key:
             return jsonify({'error': 'Replicate API key is required'}), 400
         
-        try:
-            max_duration = float(request.form.get('max_duration', 60))
-            if max_duration < 10 or max_duration > 300:
-                return jsonify({'error': 'Max duration must be between 10 and 300 seconds'}), 400
-        except ValueError:
-            return jsonify({'error': 'Invalid max duration value'}), 400
+        # One or more split profiles, all planned from one transcription
+        profiles, error = parse_profiles(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        (max_duration, split_mode), extra_profiles = profiles[0], profiles[1:]
         
-        # Save uploaded file
+        output_format, bitrate, error = parse_output_options(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        # Save uploaded file under its content hash, which also keys the segment cache
         filename = secure_filename(file.filename)
-        uploaded_file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(uploaded_file_path)
+        sources_folder = os.path.join(get_upload_folder(), 'sources')
+        os.makedirs(sources_folder, exist_ok=True)
+        uploaded_file_path, content_hash = store_upload(file.stream, sources_folder, filename)
+        artifacts = get_artifacts()
+        source = artifacts.put(f'sources/{os.path.basename(uploaded_file_path)}', uploaded_file_path)
         
         # Get audio duration for time estimate
-        audio = AudioSegment.from_file(uploaded_file_path)
-        audio_duration_seconds = len(audio) / 1000.0
-        # incredibly-fast-whisper with batch_size=4: ~33x real-time speed (30 min in 54 sec)
-        estimated_transcription_time = int(audio_duration_seconds / 33)
-        
-        print(f"Audio duration: {audio_duration_seconds:.1f}s, Estimated transcription time: {estimated_transcription_time}s")
-        
-        # Set Replicate API token
-        os.environ['REPLICATE_API_TOKEN'] = api_key
-        
-        # Step 1: Transcribe with incredibly-fast-whisper (with word-level timestamps)
-        print("Starting transcription with incredibly-fast-whisper...")
-        
-        import urllib.request
-        
-        # Open file and read contents for Replicate
-        # Using incredibly-fast-whisper with conservative settings to avoid GPU memory issues
-        # Use prediction API with polling to avoid timeouts
-        prediction = replicate.predictions.create(
-            version="3ab86df6c8f54c11309d4d1f930ac292bad43ace52d10c80d87eb258b3c9f79c",
-            input={
-                "audio": open(uploaded_file_path, 'rb'),
-                "task": "transcribe",
-                "batch_size": 4,  # Very low batch size to avoid GPU memory overflow
-                "timestamp": "word"  # Word-level timestamps for accurate splitting
-            }
-        )
-        
-        print(f"Prediction created with ID: {prediction.id}")
-        
-        # Poll for completion with periodic status updates
-        max_wait_time = 600  # 10 minutes maximum wait
-        poll_interval = 2  # Poll every 2 seconds
-        start_time = time.time()
-        
-        while prediction.status not in ['succeeded', 'failed', 'canceled']:
-            elapsed = time.time() - start_time
-            
-            if elapsed > max_wait_time:
-                prediction.cancel()
-                raise Exception(f'Transcription timed out after {max_wait_time} seconds')
-            
-            time.sleep(poll_interval)
-            prediction.reload()
-            print(f"Prediction status: {prediction.status} (elapsed: {elapsed:.1f}s)")
-        
-        if prediction.status == 'failed':
-            error_msg = getattr(prediction, 'error', 'Unknown error')
-            raise Exception(f'Replicate prediction failed: {error_msg}')
-        
-        if prediction.status == 'canceled':
-            raise Exception('Prediction was canceled')
-        
-        output = prediction.output
-        print(f"Transcription completed in {time.time() - start_time:.1f}s")
-        
-        print(f"Whisper output type: {type(output)}")
-        print(f"Whisper output: {output}")
-        
-        # Parse output - incredibly-fast-whisper returns JSON with word-level timestamps
-        segments = []
-        
-        if isinstance(output, dict):
-            # Check if output has 'segments' or 'chunks' or 'words'
-            if 'segments' in output:
-                # Standard format with segments
-                for seg in output['segments']:
-                    # If segment has words, use word-level timestamps for better precision
-                    if 'words' in seg and seg['words']:
-                        for word in seg['words']:
-                            segments.append({
-                                'start': word.get('start', 0),
-                                'end': word.get('end', word.get('start', 0)),
-                                'text': word.get('word', word.get('text', '')).strip()
-                            })
-                    else:
-                        # Fall back to segment-level timestamps
-                        segments.append({
-                            'start': seg.get('start', 0),
-                            'end': seg.get('end', 0),
-                            'text': seg.get('text', '').strip()
-                        })
-            elif 'chunks' in output:
-                # Alternative format
-                for chunk in output['chunks']:
-                    segments.append({
-                        'start': chunk.get('timestamp', [0, 0])[0],
-                        'end': chunk.get('timestamp', [0, 0])[1],
-                        'text': chunk.get('text', '').strip()
-                    })
-            elif 'text' in output:
-                # Simple text output, try to parse if it's SRT
-                srt_text = output.get('text', '')
-                segments = parse_srt_to_segments(srt_text)
-        elif isinstance(output, str):
-            # String output, might be SRT or URL
-            if output.startswith('http'):
-                with urllib.request.urlopen(output) as response:
-                    data = response.read().decode('utf-8')
-                    try:
-                        output = json.loads(data)
-                        if 'segments' in output:
-                            segments = [{'start': s['start'], 'end': s['end'], 'text': s['text'].strip()} 
-                                      for s in output['segments']]
-                    except:
-                        segments = parse_srt_to_segments(data)
-            else:
-                segments = parse_srt_to_segments(output)
-        
-        # Extract plain text from segments for metadata
-        transcript_text = ' '.join([seg['text'] for seg in segments])
-        
-        if not segments:
-            # Clean up uploaded file before returning error
-            if uploaded_file_path and os.path.exists(uploaded_file_path):
-                os.remove(uploaded_file_path)
-            return jsonify({'error': 'No transcript segments received from Whisper'}), 500
-        
-        print(f"Total segments parsed: {len(segments)}")
-        print(f"First 3 segments: {segments[:3]}")
-        print(f"Last segment end time: {segments[-1].get('end', 0)}")
-        
-        # Step 2: Find split points
-        print("Finding split points...")
-        split_points = find_split_points(segments, max_duration=max_duration)
-        print(f"Split points found: {split_points}")
-        
-        # Step 3: Split audio
-        print("Splitting audio...")
-        output_dir = os.path.join(app.config['UPLOAD_FOLDER'], f'output_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
-        os.makedirs(output_dir, exist_ok=True)
-        
-        audio_segments = split_audio_file(uploaded_file_path, split_points, output_dir)
-        
-        # Step 4: Extract text for each segment
-        audio_segments = extract_text_for_segments(segments, audio_segments)
-        
-        # Save transcript files
-        for seg in audio_segments:
-            txt_filename = seg['filename'].replace('.mp3', '.txt')
-            txt_path = os.path.join(output_dir, txt_filename)
-            with open(txt_path, 'w', encoding='utf-8') as f:
-                f.write(seg['text'])
-        
-        # Save metadata
-        metadata = {
-            'original_file': filename,
-            'total_segments': len(audio_segments),
-            'max_duration': max_duration,
-            'segments': audio_segments,
-            'full_transcript': transcript_text
-        }
-        
-        metadata_path = os.path.join(output_dir, 'metadata.json')
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, indent=2, fp=f)
-        
-        # Create ZIP file with organized folders
-        zip_filename = f'segments_{datetime.now().strftime("%Y%m%d_%H%M%S")}.zip'
-        zip_path = os.path.join(app.config['UPLOAD_FOLDER'], zip_filename)
-        
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, dirs, files in os.walk(output_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    
-                    # Organize files into subfolders
-                    if file.endswith('.mp3'):
-                        arcname = os.path.join('audio', file)
-                    elif file.endswith('.txt'):
-                        arcname = os.path.join('transcripts', file)
-                    elif file == 'metadata.json':
-                        arcname = file
-                    else:
-                        arcname = file
-                    
-                    zipf.write(file_path, arcname)
-        
-        # Clean up uploaded file
-        os.remove(uploaded_file_path)
+        audio_duration_seconds = run_in_process(get_audio_duration, artifacts.path(source))
+        estimated_transcription_time = estimate_transcription_time(audio_duration_seconds)
+        
+        log.info('upload', 'Upload stored', content_hash=content_hash, audio_duration=audio_duration_seconds,
+                 estimated_time=estimated_transcription_time)
+        
+        # Queued for any worker (on any node) to transcribe and plan; a restart
+        # resumes it. An identical request already in flight is joined instead.
+        store = get_jobs()
+        prerender = parse_flag(request.form.get('prerender'), current_app.config['PRERENDER_SEGMENTS'])
+        waiter = uuid.uuid4().hex
+        job, created = get_job_queue().submit(Job(
+            source, content_hash, filename, max_duration, output_format, bitrate, audio_duration_seconds, api_key,
+            split_mode=split_mode, extra_profiles=extra_profiles, prerender=prerender
+        ), waiter)
+        if not created:
+            discard_duplicate_source(source, job)
+        source = None  # The job owns the file now
+        
+        # The job keeps running for as long as any request is waiting on it
+        with g.cancel.on_cancel(lambda: leave_job(store, job.id, waiter)):
+            job = wait_for_job(store, job.id, g.cancel)
+            error = finished_job_error(job)
+            if error:
+                return error
         
         return jsonify({
             'success': True,
-            'download_url': f'/api/download/{zip_filename}',
-            'metadata': metadata,
+            'job_id': job.id,
+            'coalesced': not created,
+            'download_url': job.download_url,
+            'cleanup_url': f'/api/jobs/{job.id}/cleanup',
+            'metadata': job.metadata(),
             'audio_duration': audio_duration_seconds,
             'estimated_time': estimated_transcription_time
         })
     
+    except Cancelled:
+        # The job removed its own files; the client has usually gone already
+        return jsonify({'error': 'Job was canceled', 'status': 'canceled'}), 409
+    
     except Exception as e:
         error_message = str(e)
-        print(f"Error: {error_message}")
+        log.error('process', 'Processing failed', error=error_message)
         
         # Provide helpful error messages for common issues
-        if "cuda" in error_message.lower() or "out of memory" in error_message.lower() or "memory" in error_message.lower():
-            error_message = "GPU memory limit exceeded. Your audio file is too long for Replicate's GPU. Please try splitting your audio into smaller files (10-15 minutes each) and processing them separately."
-        elif "timeout" in error_message.lower():
-            error_message = "Processing timed out. This usually happens with very large files. Try splitting your audio into smaller files first."
-        elif "404" in error_message or "not found" in error_message.lower():
-            error_message = "Replicate model not found. Please check your internet connection and try again."
+        error_message = friendly_error_message(error_message)
         
         # Clean up on error
         try:
-            if uploaded_file_path and os.path.exists(uploaded_file_path):
-                os.remove(uploaded_file_path)
-            if output_dir and os.path.exists(output_dir):
-                shutil.rmtree(output_dir)
+            if source and not get_jobs().in_use(source):
+                get_artifacts().delete(source)
         except Exception as cleanup_error:
-            print(f"Cleanup error: {str(cleanup_error)}")
+            log.error('process', 'Cleanup failed', error=str(cleanup_error))
         
         return jsonify({'error': error_message}), 500
 
-@app.route('/api/download/<filename>')
+def discard_duplicate_source(name, job):
+    """
+    Remove the upload of a request that joined an identical job, unless it
+    is the same file (same content and extension) as the job's own.
+    """
+    if name != job.audio_path and not get_jobs().in_use(name):
+        get_artifacts().delete(name)
+
+def finished_job_error(job):
+    """
+    Error response for a job that didn't become ready, or None.
+    """
+    if job is None:
+        return jsonify({'error': 'Job was removed'}), 404
+    if job.status == STATUS_CANCELED:
+        return jsonify({'error': 'Job was canceled', 'status': job.status}), 409
+    if job.status != STATUS_READY:
+        return jsonify({'error': job.error or f'Job is {job.status}', 'status': job.status}), 500
+    return None
+
+def process_job(job, prerender, cancel=None):
+    """
+    Run a job to ready. Planned segments can be fetched (and, with prerender,
+    get encoded) while the rest transcribes. If `cancel` fires (or the job is
+    canceled), queued encodes are dropped and running ones killed.
+    """
+    cancel = cancel or CancelToken()
+    prerender_pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='prerender') if prerender else None
+    try:
+        run_job(
+            get_jobs(), job, cancel=cancel,
+            on_segments=prerender_segments(get_segment_cache(), get_artifacts(), prerender_pool, cancel) if prerender else None
+        )
+    finally:
+        if prerender_pool:
+            # Renders still running finish in the background; the ZIP waits for them in the cache
+            prerender_pool.shutdown(wait=False, cancel_futures=cancel.cancelled)
+
+def send_artifact(f, download_name, mimetype=None, as_attachment=False, etag=None):
+    """
+    Send an open artifact file with Range (resumable downloads) and
+    If-None-Match / If-Modified-Since support. The ETag defaults to the file's
+    mtime and size. With SENDFILE_BACKEND set, only the headers are sent and
+    the fronting proxy delivers the file, so the worker is freed right away.
+    """
+    stat = os.fstat(f.fileno())
+    etag = etag or f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    backend = current_app.config['SENDFILE_BACKEND']
+    
+    if backend:
+        path = f.name
+        f.close()
+        response = werkzeug.utils.send_file(
+            path, request.environ, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+            conditional=False, etag=etag, max_age=current_app.get_send_file_max_age,
+            use_x_sendfile=True, response_class=current_app.response_class
+        )
+        if backend == 'x-accel-redirect':
+            location = os.path.relpath(response.headers.pop('X-Sendfile'), get_upload_folder())
+            response.headers['X-Accel-Redirect'] = current_app.config['ACCEL_REDIRECT_PREFIX'] + location
+        # The proxy serves Range requests itself; only answer revalidation here
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+            response.headers.pop('X-Accel-Redirect', None)
+        return response
+    
+    response = send_file(
+        f, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+        conditional=False, etag=etag, last_modified=stat.st_mtime
+    )
+    response.content_length = stat.st_size
+    response.accept_ranges = 'bytes'
+    try:
+        return response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+    except RequestedRangeNotSatisfiable as e:
+        f.close()
+        return e.get_response()
+
+def open_segment(cache, artifacts, job, seg, cancel=None):
+    """
+    Open one of a job's segments from the segment cache, rendering it from the
+    source audio in `artifacts` on a miss. Call with the job's lock held.
+    """
+    key = segment_key(job.content_hash, seg['start_time'], seg['end_time'], job.output_format, job.bitrate)
+    extension = OUTPUT_FORMATS[job.output_format]['extension']
+    return cache.open(
+        key, extension,
+        lambda path: render_segment(
+            artifacts.path(job.audio_path), seg['start_time'], seg['end_time'], path, job.output_format, job.bitrate,
+            cancel=cancel
+        )
+    )
+
+def prerender_segments(cache, artifacts, pool, cancel=None):
+    """
+    on_segments callback for run_job that encodes new segments into the
+    segment cache in `pool`, so they are ready by the time they're requested.
+    """
+    def render(job, seg):
+        try:
+            open_segment(cache, artifacts, job, seg, cancel).close()
+        except Cancelled:
+            pass
+        except Exception as e:
+            log.error('render', 'Prerender failed', job_id=job.id, segment=seg['filename'], error=str(e))
+    
+    def on_segments(job, segments):
+        for seg in segments:
+            pool.submit(render, job, seg)
+    return on_segments
+
+def build_job_zip(job, cancel=None):
+    """
+    Write the job's ZIP (audio/, transcripts/, metadata.json) from the segment
+    cache. A job with several split profiles gets one such folder per profile.
+    If `cancel` fires, or a render fails, the other renders stop. Call with
+    the job's lock held.
+    """
+    # Written under a private name, so a build on another node never sees it half done
+    zip_path = os.path.join(get_upload_folder(), f'segments_{job.id}.{uuid.uuid4().hex[:8]}.incoming')
+    profiles = job.all_profiles()
+    
+    # Cuts shared by several profiles are rendered and read once
+    unique = {}
+    for profile in profiles:
+        for seg in profile['segments']:
+            unique.setdefault((seg['start_time'], seg['end_time']), seg)
+    
+    # Render missing segments in parallel; ffmpeg runs outside the GIL
+    cache = get_segment_cache()
+    artifacts = get_artifacts()
+    renders = CancelToken()
+    files = {}
+    try:
+        with (cancel or CancelToken()).on_cancel(lambda: renders.cancel(cancel.reason)):
+            pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS)
+            futures = {cut: pool.submit(open_segment, cache, artifacts, job, seg, renders) for cut, seg in unique.items()}
+            try:
+                for cut, future in futures.items():
+                    files[cut] = future.result()
+            except BaseException:
+                renders.cancel('ZIP build failed')
+                raise
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+                # Renders that finished after a failure still hold open files
+                for cut, future in futures.items():
+                    if cut not in files and not future.cancelled() and future.exception() is None:
+                        files[cut] = future.result()
+        
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            for profile in profiles:
+                folder = profile['name'] if len(profiles) > 1 else ''
+                for seg in profile['segments']:
+                    f = files[(seg['start_time'], seg['end_time'])]
+                    f.seek(0)
+                    with zipf.open(os.path.join(folder, 'audio', seg['filename']), 'w') as dest:
+                        shutil.copyfileobj(f, dest)
+                    txt_filename = os.path.splitext(seg['filename'])[0] + '.txt'
+                    zipf.writestr(os.path.join(folder, 'transcripts', txt_filename), seg['text'])
+                zipf.writestr(
+                    os.path.join(folder, 'metadata.json'), json.dumps(job.metadata(urls=False, profile=profile), indent=2)
+                )
+        name = artifacts.put(f'segments_{job.id}.zip', zip_path)
+    finally:
+        for f in files.values():
+            f.close()
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+    
+    get_jobs().update(job, zip_path=name)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_PREFETCH = EXPORT_WORKERS * 2  # Segments rendered ahead of the one being sent
+
+class ZipStreamBuffer:
+    """
+    Write-only file for ZipFile that collects output until the response
+    generator takes it. It can't seek, so ZipFile writes sizes after each file.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_job_zip(job):
+    """
+    Generate the job's ZIP (same layout as build_job_zip) while it is
+    written, so the first bytes go out before every segment is encoded.
+    Segments are rendered a few ahead of the one being sent.
+    """
+    store = get_jobs()
+    cache = get_segment_cache()
+    artifacts = get_artifacts()
+    profiles = job.all_profiles()
+    segments = [seg for profile in profiles for seg in profile['segments']]
+    
+    def fetch(seg):
+        with store.lock(job.id):
+            return open_segment(cache, artifacts, job, seg)
+    
+    def generate():
+        pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='zip-stream')
+        futures = [pool.submit(fetch, seg) for seg in segments[:STREAM_PREFETCH]]
+        buffer = ZipStreamBuffer()
+        try:
+            position = 0
+            with zipfile.ZipFile(buffer, 'w') as zipf:
+                for profile in profiles:
+                    folder = profile['name'] if len(profiles) > 1 else ''
+                    for seg in profile['segments']:
+                        if position + STREAM_PREFETCH < len(segments):
+                            futures.append(pool.submit(fetch, segments[position + STREAM_PREFETCH]))
+                        f = futures[position].result()
+                        position += 1
+                        with f, zipf.open(os.path.join(folder, 'audio', seg['filename']), 'w') as dest:
+                            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                                dest.write(chunk)
+                                yield buffer.take()
+                        txt_filename = os.path.splitext(seg['filename'])[0] + '.txt'
+                        zipf.writestr(os.path.join(folder, 'transcripts', txt_filename), seg['text'])
+                    zipf.writestr(
+                        os.path.join(folder, 'metadata.json'), json.dumps(job.metadata(urls=False, profile=profile), indent=2)
+                    )
+                    yield buffer.take()
+            yield buffer.take()
+        finally:
+            # The client may have gone away mid-stream; close whatever was opened ahead
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
+    
+    return generate()
+
+def find_job(job_id, number=None, profile=None):
+    """
+    Load a ready job (and check a segment number in one of its split
+    profiles). Segments planned so far are available while the job is still
+    transcribing. Returns (job, error_response).
+    """
+    job = get_jobs().get(job_id)
+    if job is None:
+        return None, (jsonify({'error': 'Job not found'}), 404)
+    segments = job.profile_segments(profile)
+    if segments is None:
+        return None, (jsonify({'error': 'Profile not found'}), 404)
+    planned = job.status == STATUS_TRANSCRIBING and number is not None and number <= len(segments)
+    if job.status != STATUS_READY and not planned:
+        return None, (jsonify({'error': f'Job is {job.status}', 'status': job.status}), 409)
+    if number is not None and (number < 1 or number > len(segments)):
+        return None, (jsonify({'error': 'Segment not found'}), 404)
+    return job, None
+
+@bp.route('/api/jobs')
+def list_jobs():
+    """Jobs, newest first, optionally filtered with ?status="""
+    status = request.args.get('status')
+    if status and status not in JOB_STATUSES:
+        return jsonify({'error': f'Status must be one of: {", ".join(JOB_STATUSES)}'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or offset'}), 400
+    
+    jobs = get_jobs().list(status=status, limit=limit, offset=offset)
+    return jsonify({'jobs': [job.summary() for job in jobs], 'limit': limit, 'offset': offset})
+
+@bp.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = get_jobs().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(dict(job.summary(), metadata=job.metadata()))
+
+@bp.route('/api/jobs/<job_id>/segments/<int:number>')
+def job_segment(job_id, number):
+    """Segment audio, rendered on first request and cached; ?profile= picks a split profile"""
+    profile = request.args.get('profile')
+    try:
+        with get_jobs().lock(job_id):
+            job, error = find_job(job_id, number, profile)
+            if error:
+                return error
+            seg = job.profile_segments(profile)[number - 1]
+            f = open_segment(get_segment_cache(), get_artifacts(), job, seg)
+        # Cache entries are named after what they contain, which makes a stable ETag
+        etag = os.path.splitext(os.path.basename(f.name))[0]
+        return send_artifact(f, seg['filename'], etag=etag)
+    except Exception as e:
+        log.error('download', 'Segment failed', job_id=job_id, segment=number, error=str(e))
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/jobs/<job_id>/segments/<int:number>/transcript')
+def job_segment_transcript(job_id, number):
+    profile = request.args.get('profile')
+    job, error = find_job(job_id, number, profile)
+    if error:
+        return error
+    response = Response(job.profile_segments(profile)[number - 1]['text'], mimetype='text/plain')
+    response.add_etag()
+    return response.make_conditional(request)
+
+@bp.route('/api/jobs/<job_id>/download')
+@cancel_on_client_disconnect
+def download_job(job_id):
+    """
+    ZIP of all segments, assembled from the segment cache. With ?stream=1 and
+    no ZIP built yet, the ZIP is sent as it is written instead.
+    """
+    try:
+        with get_jobs().lock(job_id):
+            job, error = find_job(job_id)
+            if error:
+                return error
+            artifacts = get_artifacts()
+            if parse_flag(request.args.get('stream')) and not artifacts.exists(job.zip_path):
+                response = Response(stream_job_zip(job), mimetype='application/zip')
+                response.headers['Content-Disposition'] = f'attachment; filename=segments_{job.id}.zip'
+                return response
+            if not artifacts.exists(job.zip_path):
+                build_job_zip(job, g.cancel)
+            # Opened under the lock so cleanup can't delete it first
+            f = artifacts.open(job.zip_path)
+        return send_artifact(f, os.path.basename(job.zip_path), mimetype='application/zip', as_attachment=True)
+    except Exception as e:
+        log.error('download', 'ZIP download failed', job_id=job_id, error=str(e))
+        return jsonify({'error': friendly_error_message(str(e))}), 500
+
+@bp.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job_request(job_id):
+    """
+    Stop an unfinished job: its prediction is cancelled, encodes stop and its
+    upload is removed. The job stays listed as canceled. A job shared by
+    identical requests only stops once each of them has canceled or gone, so
+    a request cancels with the `waiter` token from its cancel_url. Until the
+    last one, that only ends its own wait; repeating it changes nothing.
+    """
+    store = get_jobs()
+    job = store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    waiter = request.args.get('waiter') or request.form.get('waiter')
+    if job.status in UNFINISHED_STATUSES:
+        if waiter:
+            waiters = leave_job(store, job_id, waiter)
+            if waiters is None:
+                return jsonify({'success': True, 'status': job.status, 'waiters': job.waiters})
+            if waiters > 0:
+                return jsonify({'success': True, 'status': job.status, 'waiters': waiters})
+            job = store.get(job_id) or job
+            return jsonify({'success': True, 'status': job.status})
+        if job.waiters > 1:
+            return jsonify({
+                'error': 'Job is shared by identical requests; cancel it with your cancel_url',
+                'status': job.status, 'waiters': job.waiters
+            }), 409
+    if not cancel_job(store, job_id):
+        return jsonify({'error': f'Job is {job.status}', 'status': job.status}), 409
+    return jsonify({'success': True, 'status': 'canceled'})
+
+@bp.route('/api/jobs/<job_id>/cleanup', methods=['POST'])
+def cleanup_job(job_id):
+    """
+    Remove a job's files; rendered segments stay in the cache until evicted.
+    A job shared by identical requests is kept until each has cleaned up.
+    """
+    job = get_jobs().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    try:
+        removed = get_jobs().release(job)
+        return jsonify({'success': True, 'removed': removed})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/download/<filename>')
 def download_file(filename):
     # Validate filename to prevent path traversal attacks
     filename = secure_filename(filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    # Only ZIPs the store handed out; the rest of the upload folder isn't public
+    if not get_jobs().issued(filename):
+        return jsonify({'error': 'File not found'}), 404
     
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True, download_name=filename)
-    return jsonify({'error': 'File not found'}), 404
+    try:
+        f = get_artifacts().open(filename)
+    except (FileNotFoundError, IsADirectoryError):
+        return jsonify({'error': 'File not found'}), 404
+    return send_artifact(f, filename, as_attachment=True)
 
-@app.route('/api/cleanup/<filename>', methods=['POST'])
+@bp.route('/api/cleanup/<filename>', methods=['POST'])
 def cleanup_files(filename):
     """Clean up files after download"""
     try:
         filename = secure_filename(filename)
-        zip_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if not get_jobs().issued(filename):
+            return jsonify({'error': 'File not found'}), 404
+        zip_path = os.path.join(get_upload_folder(), filename)
         
         # Remove ZIP file
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
+        get_artifacts().delete(filename)
         
         # Remove corresponding output directory
         output_dir = zip_path.replace('.zip', '').replace('segments_', 'output_')
         if os.path.exists(output_dir):
             shutil.rmtree(output_dir)
         
+        # A combined batch ZIP also owns one output directory per file
+        for batch_output_dir in glob.glob(f'{glob.escape(output_dir)}_[0-9][0-9][0-9]'):
+            shutil.rmtree(batch_output_dir)
+        
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/combine-videos', methods=['POST'])
+ARTIFACT_ID_LENGTH = 64  # sha256 hex digest
+
+def find_uploaded_artifact(artifact_id):
+    """
+    Resolve an artifact id returned by /api/uploads to its artifact name.
+    """
+    if len(artifact_id) != ARTIFACT_ID_LENGTH or not all(c in '0123456789abcdef' for c in artifact_id):
+        return None
+    matches = get_artifacts().find(f'upload_{artifact_id}.')
+    return matches[0] if matches else None
+
+@bp.route('/api/uploads', methods=['POST'])
+def upload_artifact():
+    """
+    Store an audio file for later reference by /api/batch. Batches of many
+    episodes exceed MAX_CONTENT_LENGTH as a single request, so files can be
+    uploaded one at a time first. Identical content gets the same id.
+    """
+    try:
+        if 'audio' not in request.files:
+            return jsonify({'error': 'No audio file provided'}), 400
+        
+        file = request.files['audio']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type. Supported: mp3, wav, ogg, m4a, flac, aac, wma'}), 400
+        
+        filename = secure_filename(file.filename)
+        path, content_hash = store_upload(file.stream, get_upload_folder(), filename)
+        size = os.path.getsize(path)
+        get_artifacts().put(os.path.basename(path), path)
+        
+        return jsonify({
+            'success': True,
+            'artifact_id': content_hash,
+            'filename': filename,
+            'size': size
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/uploads/chunked', methods=['POST'])
+def create_chunked_upload():
+    """
+    Start a resumable upload. The file is then sent as raw bytes with
+    PUT /api/uploads/chunked/<upload_id>?offset=N, so there is no base64 or
+    form encoding and no limit beyond MAX_CHUNKED_UPLOAD_BYTES.
+    """
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(data.get('filename') or '')
+    if not filename:
+        return jsonify({'error': 'filename is required'}), 400
+    if not allowed_file(filename):
+        return jsonify({'error': 'Invalid file type. Supported: mp3, wav, ogg, m4a, flac, aac, wma'}), 400
+    try:
+        size = int(data['size']) if data.get('size') is not None else None
+    except ValueError:
+        return jsonify({'error': 'Invalid size'}), 400
+    
+    try:
+        upload_id = get_chunked_uploads().create(filename, size)
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'upload_url': f'/api/uploads/chunked/{upload_id}',
+        'chunk_size': min(CHUNK_SIZE, current_app.config['MAX_CONTENT_LENGTH'] or CHUNK_SIZE),
+        'received': 0
+    }), 201
+
+@bp.route('/api/uploads/chunked/<upload_id>')
+def chunked_upload_status(upload_id):
+    """Bytes received so far, for resuming after a dropped connection"""
+    try:
+        status = get_chunked_uploads().status(upload_id)
+    except UploadNotFound:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(status)
+
+@bp.route('/api/uploads/chunked/<upload_id>', methods=['PUT'])
+def append_chunked_upload(upload_id):
+    """
+    Append the raw request body at ?offset=. A chunk that doesn't continue
+    the upload gets 409 with the offset to resend from.
+    """
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid offset'}), 400
+    
+    try:
+        received = get_chunked_uploads().append(upload_id, offset, request.stream)
+    except UploadNotFound:
+        return jsonify({'error': 'Upload not found'}), 404
+    except OffsetMismatch as e:
+        return jsonify({'error': str(e), 'received': e.received}), 409
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    return jsonify({'success': True, 'received': received})
+
+@bp.route('/api/uploads/chunked/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """
+    Finish an upload. The file becomes an artifact, the same as one from
+    /api/uploads, for /api/jobs or /api/batch.
+    """
+    try:
+        path, content_hash, filename = get_chunked_uploads().complete(upload_id, get_upload_folder())
+        size = os.path.getsize(path)
+        get_artifacts().put(os.path.basename(path), path)
+    except UploadNotFound:
+        return jsonify({'error': 'Upload not found'}), 404
+    except OffsetMismatch as e:
+        return jsonify({'error': f'Upload is incomplete: {e.received} bytes received', 'received': e.received}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({
+        'success': True,
+        'artifact_id': content_hash,
+        'filename': filename,
+        'size': size
+    })
+
+@bp.route('/api/jobs', methods=['POST'])
+def create_job():
+    """
+    Start a job for an uploaded artifact and return right away with 202.
+    Takes the same form fields as /api/process, with `artifact_id` in place
+    of the file. Poll GET /api/jobs/<job_id>; segments planned so far can be
+    fetched while it transcribes, and ?stream=1 on the download streams the ZIP.
+    """
+    form = request.form
+    artifact = find_uploaded_artifact(str(form.get('artifact_id', '')))
+    if not artifact:
+        return jsonify({'error': 'Artifact not found'}), 404
+    
+    api_key = form.get('api_key')
+    if not api_key:
+        return jsonify({'error': 'Replicate API key is required'}), 400
+    
+    profiles, error = parse_profiles(form)
+    if error:
+        return jsonify({'error': error}), 400
+    (max_duration, split_mode), extra_profiles = profiles[0], profiles[1:]
+    
+    output_format, bitrate, error = parse_output_options(form)
+    if error:
+        return jsonify({'error': error}), 400
+    prerender = parse_flag(form.get('prerender'), current_app.config['PRERENDER_SEGMENTS'])
+    
+    # Counted across every node sharing the queue, since any of them may run it
+    try:
+        get_admission().check()
+    except JobQueueFull as e:
+        return busy_response(e)
+    queue = get_job_queue()
+    
+    try:
+        # Jobs own their source file, so link the artifact in rather than copying it
+        artifacts = get_artifacts()
+        source = artifacts.link(artifact, f'sources/{os.path.basename(artifact)}')
+        
+        content_hash = form['artifact_id']
+        filename = form.get('filename') or os.path.basename(artifact)
+        audio_duration_seconds = run_in_process(get_audio_duration, artifacts.path(source))
+        # An identical job still in flight is shared. It runs until this request's
+        # waiter token is canceled (or the other requests' waits end too).
+        waiter = uuid.uuid4().hex
+        job, created = queue.submit(Job(
+            source, content_hash, secure_filename(filename), max_duration, output_format, bitrate,
+            audio_duration_seconds, api_key, split_mode=split_mode, extra_profiles=extra_profiles, prerender=prerender
+        ), waiter)
+        if not created:
+            discard_duplicate_source(source, job)
+    except Exception as e:
+        log.error('job', 'Job could not be created', error=str(e))
+        return jsonify({'error': friendly_error_message(str(e))}), 500
+    
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'coalesced': not created,
+        'status_url': f'/api/jobs/{job.id}',
+        'download_url': job.download_url,
+        'cleanup_url': f'/api/jobs/{job.id}/cleanup',
+        'cancel_url': f'/api/jobs/{job.id}/cancel?waiter={waiter}',
+        'audio_duration': audio_duration_seconds,
+        'estimated_time': estimate_transcription_time(audio_duration_seconds)
+    }), 202
+
+@bp.route('/api/batch', methods=['POST'])
+def create_batch_job():
+    """
+    Process many files at once. Accepts uploaded 'audio' files and/or an
+    'artifacts' JSON list of ids from /api/uploads. Returns immediately; poll
+    /api/batch/<batch_id> for progress and download links.
+    """
+    try:
+        files = [f for f in request.files.getlist('audio') if f.filename]
+        try:
+            artifact_ids = json.loads(request.form.get('artifacts') or '[]')
+        except ValueError:
+            return jsonify({'error': 'Invalid artifacts list'}), 400
+        
+        if not files and not artifact_ids:
+            return jsonify({'error': 'No audio files provided'}), 400
+        
+        for file in files:
+            if not allowed_file(file.filename):
+                return jsonify({'error': f'Invalid file type: {file.filename}. Supported: mp3, wav, ogg, m4a, flac, aac, wma'}), 400
+        
+        # Each artifact is an id, or {"id": ..., "name": ...} to keep the original filename
+        artifacts = []
+        for artifact in artifact_ids:
+            artifact_id = str(artifact.get('id', '')) if isinstance(artifact, dict) else str(artifact)
+            found = find_uploaded_artifact(artifact_id)
+            if not found:
+                return jsonify({'error': f'Unknown artifact: {artifact_id}'}), 404
+            path = get_artifacts().path(found)
+            name = artifact.get('name') if isinstance(artifact, dict) else None
+            name = secure_filename(name or '') or f'{artifact_id[:12]}{os.path.splitext(path)[1]}'
+            artifacts.append((artifact_id, path, name))
+        
+        api_key = request.form.get('api_key')
+        if not api_key:
+            return jsonify({'error': 'Replicate API key is required'}), 400
+        
+        max_duration, error = parse_max_duration(request.form.get('max_duration', 60))
+        if error:
+            return jsonify({'error': error}), 400
+        
+        output_format, bitrate, error = parse_output_options(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        output_mode = request.form.get('output', OUTPUT_COMBINED)
+        if output_mode not in OUTPUT_MODES:
+            return jsonify({'error': f'Output must be one of: {", ".join(OUTPUT_MODES)}'}), 400
+        
+        store = get_jobs()
+        batch = create_batch(store, get_upload_folder(), api_key, max_duration, output_mode, output_format, bitrate)
+        
+        for file in files:
+            filename = secure_filename(file.filename)
+            path, content_hash = store_upload(file.stream, batch.scratch_dir, filename)
+            batch.add_item(filename, path, content_hash)
+        
+        for artifact_id, path, name in artifacts:
+            batch.add_item(name, path, artifact_id)
+        
+        # Each distinct file holds a place in the job queue until it is exported
+        admission = get_admission()
+        try:
+            admission.try_acquire(batch.unique_count)
+        except JobTooLarge as e:
+            discard_batch(batch)
+            return jsonify({'error': f'A batch can have at most {e.max_jobs} distinct files'}), 413
+        except JobQueueFull as e:
+            discard_batch(batch)
+            return busy_response(e)
+        
+        try:
+            batch.start(on_item_done=lambda duration: admission.release(duration=duration))
+        except Exception:
+            admission.release(batch.unique_count)
+            discard_batch(batch)
+            raise
+        log.info('batch', 'Batch started', batch_id=batch.id, files=len(batch.items))
+        
+        return jsonify(dict(get_batch(store, batch.id), success=True, status_url=f'/api/batch/{batch.id}')), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/batch/<batch_id>')
+def batch_status(batch_id):
+    batch = get_batch(get_jobs(), batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch)
+
+@bp.route('/api/batch/<batch_id>/cancel', methods=['POST'])
+def cancel_batch_request(batch_id):
+    store = get_jobs()
+    batch = get_batch(store, batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    if not cancel_batch(store, batch_id):
+        return jsonify({'error': f"Batch is {batch['status']}", 'status': batch['status']}), 409
+    return jsonify({'success': True})
+
+@bp.route('/combine-videos', methods=['POST'])
+@admission_controlled
+@cancel_on_client_disconnect
 def combine_videos():
     """Combine multiple video files into one using ffmpeg"""
     import subprocess
@@ -634,25 +1318,20 @@ def combine_videos():
             output_path
         ]
         
-        print(f'Running ffmpeg command: {" ".join(ffmpeg_cmd)}')
+        log.debug('video', 'Running ffmpeg', command=' '.join(ffmpeg_cmd))
         
         # Run ffmpeg
-        result = subprocess.run(
-            ffmpeg_cmd,
-            capture_output=True,
-            text=True,
-            timeout=300  # 5 minute timeout
-        )
+        result = run_subprocess(ffmpeg_cmd, 300, g.cancel)  # 5 minute timeout
         
         if result.returncode != 0:
-            print(f'FFmpeg error: {result.stderr}')
+            log.error('video', 'ffmpeg failed', stderr=result.stderr)
             return jsonify({'error': f'FFmpeg failed: {result.stderr}'}), 500
         
         # Check if output file was created
         if not os.path.exists(output_path):
             return jsonify({'error': 'Combined video file was not created'}), 500
         
-        print(f'Successfully combined {len(video_files)} videos into {output_filename}')
+        log.info('video', 'Videos combined', videos=len(video_files), output=output_filename)
         
         # Send the combined video file
         return send_file(
@@ -665,7 +1344,7 @@ def combine_videos():
     except subprocess.TimeoutExpired:
         return jsonify({'error': 'Video combining timed out (>5 minutes)'}), 500
     except Exception as e:
-        print(f'Error combining videos: {str(e)}')
+        log.error('video', 'Combining videos failed', error=str(e))
         return jsonify({'error': str(e)}), 500
     finally:
         # Clean up temp files after a delay (to allow download to complete)
@@ -674,19 +1353,23 @@ def combine_videos():
             if 'temp_dir' in locals():
                 # Give the download 10 seconds to complete before cleanup
                 import threading
+                cancelled = g.cancel.cancelled
                 def cleanup_later():
                     import time
-                    time.sleep(10)
+                    if not cancelled:
+                        time.sleep(10)
                     try:
                         shutil.rmtree(temp_dir)
-                        print(f'Cleaned up temp directory: {temp_dir}')
+                        log.debug('video', 'Cleaned up temp directory', path=temp_dir)
                     except:
                         pass
                 threading.Thread(target=cleanup_later, daemon=True).start()
         except:
             pass
 
-@app.route('/trim-videos-zip', methods=['POST'])
+@bp.route('/trim-videos-zip', methods=['POST'])
+@admission_controlled
+@cancel_on_client_disconnect
 def trim_videos_zip():
     """Trim multiple video files to specified durations and return as ZIP"""
     import subprocess
@@ -709,7 +1392,7 @@ def trim_videos_zip():
         temp_dir = tempfile.mkdtemp()
         trimmed_files = []
         
-        print(f'Trimming {len(videos)} videos...')
+        log.info('video', 'Trimming videos', videos=len(videos))
         
         # Process each video
         for video in videos:
@@ -717,7 +1400,7 @@ def trim_videos_zip():
             
             # Check if we have a duration for this video
             if filename not in durations_map:
-                print(f'Warning: No duration specified for {filename}, skipping trim')
+                log.warning('video', 'No duration specified, not trimming', filename=filename)
                 # Save without trimming
                 video_path = os.path.join(temp_dir, filename)
                 video.save(video_path)
@@ -756,17 +1439,12 @@ def trim_videos_zip():
                 trimmed_path
             ]
             
-            print(f'Trimming {filename} to {target_duration:.3f}s (millisecond precision)...')
+            log.info('video', 'Trimming video', filename=filename, duration=round(target_duration, 3))
             
-            result = subprocess.run(
-                ffmpeg_cmd,
-                capture_output=True,
-                text=True,
-                timeout=120  # Increased timeout for re-encoding
-            )
+            result = run_subprocess(ffmpeg_cmd, 120, g.cancel)  # Increased timeout for re-encoding
             
             if result.returncode != 0:
-                print(f'FFmpeg trim error for {filename}: {result.stderr}')
+                log.error('video', 'ffmpeg trim failed, using original', filename=filename, stderr=result.stderr)
                 # Use original if trim fails
                 shutil.copy(original_path, trimmed_path)
             
@@ -783,7 +1461,7 @@ def trim_videos_zip():
             for video_file in trimmed_files:
                 zipf.write(video_file, os.path.basename(video_file))
         
-        print(f'Successfully trimmed and zipped {len(trimmed_files)} videos')
+        log.info('video', 'Videos trimmed and zipped', videos=len(trimmed_files))
         
         # Send the ZIP file
         return send_file(
@@ -796,19 +1474,21 @@ def trim_videos_zip():
     except subprocess.TimeoutExpired:
         return jsonify({'error': 'Video trimming timed out'}), 500
     except Exception as e:
-        print(f'Error trimming videos: {str(e)}')
+        log.error('video', 'Trimming videos failed', error=str(e))
         return jsonify({'error': str(e)}), 500
     finally:
         # Clean up temp files after a delay
         try:
             if 'temp_dir' in locals():
                 import threading
+                cancelled = g.cancel.cancelled
                 def cleanup_later():
                     import time
-                    time.sleep(10)
+                    if not cancelled:
+                        time.sleep(10)
                     try:
                         shutil.rmtree(temp_dir)
-                        print(f'Cleaned up temp directory: {temp_dir}')
+                        log.debug('video', 'Cleaned up temp directory', path=temp_dir)
                     except:
                         pass
                 threading.Thread(target=cleanup_later, daemon=True).start()
@@ -816,7 +1496,9 @@ def trim_videos_zip():
             pass
 
 
-@app.route('/trim-and-combine-videos', methods=['POST'])
+@bp.route('/trim-and-combine-videos', methods=['POST'])
+@admission_controlled
+@cancel_on_client_disconnect
 def trim_and_combine_videos():
     """Trim videos to specified durations and then combine them into one"""
     import subprocess
@@ -839,10 +1521,7 @@ def trim_and_combine_videos():
         temp_dir = tempfile.mkdtemp()
         trimmed_files = []
         
-        print(f'Trimming and combining {len(videos)} videos...')
-        print(f'Received videos in this order:')
-        for idx, video in enumerate(videos, 1):
-            print(f'  {idx}. {video.filename}')
+        log.info('video', 'Trimming and combining videos', filenames=[video.filename for video in videos])
         
         # Step 1: Trim each video
         for video in videos:
@@ -850,7 +1529,7 @@ def trim_and_combine_videos():
             
             # Check if we have a duration for this video
             if filename not in durations_map:
-                print(f'Warning: No duration specified for {filename}, using original')
+                log.warning('video', 'No duration specified, using original', filename=filename)
                 # Save without trimming
                 video_path = os.path.join(temp_dir, filename)
                 video.save(video_path)
@@ -889,17 +1568,12 @@ def trim_and_combine_videos():
                 trimmed_path
             ]
             
-            print(f'Trimming {filename} to {target_duration:.3f}s (millisecond precision)...')
+            log.info('video', 'Trimming video', filename=filename, duration=round(target_duration, 3))
             
-            result = subprocess.run(
-                ffmpeg_cmd,
-                capture_output=True,
-                text=True,
-                timeout=120  # Increased timeout for re-encoding
-            )
+            result = run_subprocess(ffmpeg_cmd, 120, g.cancel)  # Increased timeout for re-encoding
             
             if result.returncode != 0:
-                print(f'FFmpeg trim error for {filename}: {result.stderr}')
+                log.error('video', 'ffmpeg trim failed, using original', filename=filename, stderr=result.stderr)
                 # Use original if trim fails
                 shutil.copy(original_path, trimmed_path)
             
@@ -911,10 +1585,7 @@ def trim_and_combine_videos():
         # Step 2: Sort files by name to ensure correct order
         trimmed_files.sort()
         
-        # Debug: Print the order of files
-        print(f'Sorted order for combining:')
-        for idx, video_file in enumerate(trimmed_files, 1):
-            print(f'  {idx}. {os.path.basename(video_file)}')
+        log.debug('video', 'Combining in order', filenames=[os.path.basename(video_file) for video_file in trimmed_files])
         
         # Step 3: Create concat file for ffmpeg
         concat_file_path = os.path.join(temp_dir, 'concat.txt')
@@ -924,11 +1595,6 @@ def trim_and_combine_videos():
                 escaped_path = video_file.replace("'", "'\\''")
                 f.write(f"file '{escaped_path}'\n")
         
-        # Debug: Print concat file contents
-        print(f'Concat file contents:')
-        with open(concat_file_path, 'r') as f:
-            print(f.read())
-        
         # Step 4: Combine trimmed videos
         output_filename = f'combined_trimmed_{datetime.now().strftime("%Y%m%d_%H%M%S")}.mp4'
         output_path = os.path.join(temp_dir, output_filename)
@@ -942,23 +1608,16 @@ def trim_and_combine_videos():
             output_path
         ]
         
-        print(f'Combining {len(trimmed_files)} trimmed videos...')
-        
-        result = subprocess.run(
-            ffmpeg_cmd,
-            capture_output=True,
-            text=True,
-            timeout=300
-        )
+        result = run_subprocess(ffmpeg_cmd, 300, g.cancel)
         
         if result.returncode != 0:
-            print(f'FFmpeg combine error: {result.stderr}')
+            log.error('video', 'ffmpeg combine failed', stderr=result.stderr)
             return jsonify({'error': f'FFmpeg failed: {result.stderr}'}), 500
         
         if not os.path.exists(output_path):
             return jsonify({'error': 'Combined video file was not created'}), 500
         
-        print(f'Successfully trimmed and combined {len(trimmed_files)} videos into {output_filename}')
+        log.info('video', 'Videos trimmed and combined', videos=len(trimmed_files), output=output_filename)
         
         # Send the combined video file
         return send_file(
@@ -971,19 +1630,21 @@ def trim_and_combine_videos():
     except subprocess.TimeoutExpired:
         return jsonify({'error': 'Video processing timed out'}), 500
     except Exception as e:
-        print(f'Error processing videos: {str(e)}')
+        log.error('video', 'Trimming and combining failed', error=str(e))
         return jsonify({'error': str(e)}), 500
     finally:
         # Clean up temp files after a delay
         try:
             if 'temp_dir' in locals():
                 import threading
+                cancelled = g.cancel.cancelled
                 def cleanup_later():
                     import time
-                    time.sleep(10)
+                    if not cancelled:
+                        time.sleep(10)
                     try:
                         shutil.rmtree(temp_dir)
-                        print(f'Cleaned up temp directory: {temp_dir}')
+                        log.debug('video', 'Cleaned up temp directory', path=temp_dir)
                     except:
                         pass
                 threading.Thread(target=cleanup_later, daemon=True).start()
@@ -991,9 +1652,11 @@ def trim_and_combine_videos():
             pass
 
 
-@app.route('/api/kling-lipsync', methods=['POST'])
+@bp.route('/api/kling-lipsync', methods=['POST'])
 def kling_lipsync():
     """Submit video and audio to Kling AI for lip sync"""
+    import requests
+    
     video_file_path = None
     audio_file_path = None
     
@@ -1018,40 +1681,25 @@ def kling_lipsync():
         video_filename = secure_filename(video_file.filename)
         audio_filename = secure_filename(audio_file.filename)
         
-        video_file_path = os.path.join(app.config['UPLOAD_FOLDER'], video_filename)
-        audio_file_path = os.path.join(app.config['UPLOAD_FOLDER'], audio_filename)
+        video_file_path = os.path.join(get_upload_folder(), video_filename)
+        audio_file_path = os.path.join(get_upload_folder(), audio_filename)
         
         video_file.save(video_file_path)
         audio_file.save(audio_file_path)
         
-        print(f"Files saved: video={video_file_path}, audio={audio_file_path}")
-        
         try:
             # Read and encode files as base64
-            print("Encoding video file...")
             with open(video_file_path, 'rb') as f:
-                video_content = f.read()
-                video_base64 = base64.b64encode(video_content).decode('utf-8')
-                print(f"Video file encoded: {len(video_content)} bytes -> {len(video_base64)} chars")
-            
-            print("Encoding audio file...")
+                video_base64 = base64.b64encode(f.read()).decode('utf-8')
             with open(audio_file_path, 'rb') as f:
-                audio_content = f.read()
-                audio_base64 = base64.b64encode(audio_content).decode('utf-8')
-                print(f"Audio file encoded: {len(audio_content)} bytes -> {len(audio_base64)} chars")
+                audio_base64 = base64.b64encode(f.read()).decode('utf-8')
         except Exception as e:
             error_msg = f"Failed to encode files: {str(e)}"
-            print(error_msg)
+            log.error('kling', 'Encoding files failed', error=str(e))
             return jsonify({'error': error_msg}), 500
         
         # Submit lip sync job to Kling AI
-        kling_api_url = "https://api.klingai.com/v1/videos/video-to-lip"
-        
-        # Get file extensions
-        video_ext = os.path.splitext(video_file_path)[1][1:].lower()  # Remove dot and lowercase
-        audio_ext = os.path.splitext(audio_file_path)[1][1:].lower()
-        
-        print(f"File extensions: video={video_ext}, audio={audio_ext}")
+        kling_api_url = f"{current_app.config['KLING_API_BASE']}/v1/videos/video-to-lip"
         
         # Prepare headers
         headers = {
@@ -1059,8 +1707,6 @@ def kling_lipsync():
             "Content-Type": "application/json"
         }
         
-        print(f"Authorization header: Bearer {access_key[:10]}...:{secret_key[:10]}...")
-        
         # Prepare JSON payload - try minimal required fields first
         payload = {
             "model_name": "kling-v1",
@@ -1069,25 +1715,22 @@ def kling_lipsync():
             "cfg_scale": 0.5
         }
         
-        print(f"Submitting to Kling API: {kling_api_url}")
-        print(f"- Payload keys: {list(payload.keys())}")
-        print(f"- Video: {len(video_base64)} chars")
-        print(f"- Audio: {len(audio_base64)} chars")
+        log.info('kling', 'Submitting lipsync task', url=kling_api_url, video_chars=len(video_base64),
+                 audio_chars=len(audio_base64))
         
         try:
             response = requests.post(kling_api_url, headers=headers, json=payload, timeout=180)
         except Exception as e:
             error_msg = f"Request failed: {str(e)}"
-            print(error_msg)
+            log.error('kling', 'Request failed', error=str(e))
             return jsonify({'error': error_msg}), 500
         
-        print(f"Response status: {response.status_code}")
-        print(f"Response headers: {dict(response.headers)}")
-        print(f"Response body: {response.text[:500]}")  # First 500 chars
+        log.dump('kling', 'Kling response', {'headers': dict(response.headers), 'body': response.text},
+                 status=response.status_code)
         
         if response.status_code != 200:
             error_msg = f"Kling API error: {response.status_code} - {response.text}"
-            print(error_msg)
+            log.error('kling', 'Kling API error', status=response.status_code, body=response.text)
             
             # Try to parse error details
             try:
@@ -1100,16 +1743,15 @@ def kling_lipsync():
             return jsonify({'error': error_msg}), 500
         
         result = response.json()
-        print(f"Kling API response: {result}")
         
         if result.get('code') != 0:
             error_msg = f"Kling API error: {result.get('message', 'Unknown error')}"
-            print(error_msg)
+            log.error('kling', 'Kling API error', code=result.get('code'), body=result.get('message'))
             return jsonify({'error': error_msg}), 500
         
         task_id = result['data']['task_id']
         
-        print(f"Kling task created: {task_id}")
+        log.info('kling', 'Kling task created', task_id=task_id)
         
         # Store task info for polling
         # In production, use a database
@@ -1132,7 +1774,7 @@ def kling_lipsync():
     
     except requests.exceptions.RequestException as e:
         error_message = f'Network error: {str(e)}'
-        print(f"Error: {error_message}")
+        log.error('kling', 'Network error', error=str(e))
         
         # Clean up on error
         if video_file_path and os.path.exists(video_file_path):
@@ -1144,7 +1786,7 @@ def kling_lipsync():
     
     except Exception as e:
         error_message = str(e)
-        print(f"Error: {error_message}")
+        log.error('kling', 'Lipsync submission failed', error=error_message)
         
         # Clean up on error
         if video_file_path and os.path.exists(video_file_path):
@@ -1154,9 +1796,11 @@ def kling_lipsync():
         
         return jsonify({'error': error_message}), 500
 
-@app.route('/api/kling-status/<task_id>')
+@bp.route('/api/kling-status/<task_id>')
 def kling_status(task_id):
     """Poll Kling AI for task status"""
+    import requests
+    
     try:
         # In production, retrieve API keys from database
         # For now, accept them as query parameters
@@ -1166,7 +1810,7 @@ def kling_status(task_id):
             return jsonify({'error': 'Both Access Key and Secret Key required'}), 400
         
         # Query Kling API for task status
-        kling_api_url = f"https://api.klingai.com/v1/videos/video-to-lip/{task_id}"
+        kling_api_url = f"{current_app.config['KLING_API_BASE']}/v1/videos/video-to-lip/{task_id}"
         
         headers = {
             "Authorization": f"Bearer {access_key}:{secret_key}"
@@ -1203,9 +1847,104 @@ def kling_status(task_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@bp.route('/api/kling-lipsync/batch', methods=['POST'])
+def kling_lipsync_batch():
+    """
+    Lipsync a whole segment set in one request. Audio comes from a job's
+    segments (job_id, optional profile) or from repeated `audio` files. Send
+    one `video` for every pair, or one video per audio. Tasks are submitted
+    in the background, at most `concurrency` at once and within the key's
+    rate limit, and tracked under the returned batch_id.
+    """
+    access_key = request.form.get('kling_access_key')
+    secret_key = request.form.get('kling_secret_key')
+    if not access_key or not secret_key:
+        return jsonify({'error': 'Both Kling Access Key and Secret Key are required'}), 400
+    
+    max_concurrent = current_app.config['KLING_MAX_CONCURRENT_TASKS']
+    try:
+        concurrency = int(request.form.get('concurrency') or max_concurrent)
+    except ValueError:
+        return jsonify({'error': 'Invalid concurrency'}), 400
+    if not 1 <= concurrency <= max_concurrent:
+        return jsonify({'error': f'Concurrency must be between 1 and {max_concurrent}'}), 400
+    
+    job_id = request.form.get('job_id')
+    if job_id:
+        profile = request.form.get('profile')
+        job, error = find_job(job_id, profile=profile)
+        if error:
+            return error
+        segments = job.profile_segments(profile)
+        audio_names = [seg['filename'] for seg in segments]
+    else:
+        audio_files = [f for f in request.files.getlist('audio') if f.filename]
+        audio_names = [secure_filename(f.filename) for f in audio_files]
+    if not audio_names:
+        return jsonify({'error': 'A job_id or audio files are required'}), 400
+    
+    video_files = [f for f in request.files.getlist('video') if f.filename]
+    if len(video_files) not in (1, len(audio_names)):
+        return jsonify({'error': f'Send one video, or one per audio ({len(audio_names)})'}), 400
+    
+    client = get_kling_client(
+        current_app.config['KLING_API_BASE'], access_key, secret_key,
+        max_concurrent, current_app.config['KLING_REQUESTS_PER_SECOND']
+    )
+    store = get_jobs()
+    batch = create_lipsync_batch(
+        store, get_upload_folder(), client, concurrency, current_app.config['KLING_POLL_INTERVAL']
+    )
+    try:
+        video_paths = []
+        for i, video_file in enumerate(video_files):
+            path = os.path.join(batch.scratch_dir, f'video_{i + 1:03d}_{secure_filename(video_file.filename)}')
+            video_file.save(path)
+            video_paths.append(path)
+        
+        if job_id:
+            cache = get_segment_cache()
+            artifacts = get_artifacts()
+            def open_audio(seg):
+                # Segments are encoded on demand, as each task's turn comes
+                def opener():
+                    with store.lock(job.id):
+                        return open_segment(cache, artifacts, job, seg)
+                return opener
+            openers = [open_audio(seg) for seg in segments]
+        else:
+            openers = []
+            for i, (audio_file, name) in enumerate(zip(audio_files, audio_names)):
+                path = os.path.join(batch.scratch_dir, f'audio_{i + 1:03d}_{name}')
+                audio_file.save(path)
+                openers.append(functools.partial(open, path, 'rb'))
+        
+        for i, (name, opener) in enumerate(zip(audio_names, openers)):
+            batch.add_task(name, video_paths[i if len(video_paths) > 1 else 0], opener)
+    except Exception as e:
+        discard_lipsync_batch(batch)
+        return jsonify({'error': str(e)}), 500
+    
+    try:
+        batch.start()
+    except Exception as e:
+        discard_lipsync_batch(batch)
+        return jsonify({'error': str(e)}), 500
+    log.info('lipsync', 'Lipsync batch started', batch_id=batch.id, tasks=len(batch.tasks), concurrency=concurrency)
+    return jsonify(dict(
+        get_lipsync_batch(store, batch.id), success=True, status_url=f'/api/kling-lipsync/batch/{batch.id}'
+    )), 202
+
+@bp.route('/api/kling-lipsync/batch/<batch_id>')
+def kling_lipsync_batch_status(batch_id):
+    batch = get_lipsync_batch(get_jobs(), batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch)
+
 
 if __name__ == '__main__':
+    # Development server; use wsgi.py behind a WSGI server in production
     # Use threaded mode to handle multiple requests
-    # Set higher timeout limits for long-running transcription tasks
-    app.run(debug=True, port=5003, host='127.0.0.1', threaded=True)
+    create_app().run(debug=True, port=5003, host='127.0.0.1', threaded=True)
 
@@ -0,0 +1,87 @@
+"""
+Where uploads, job sources and job ZIPs live, so that any node can serve
+what any other node produced.
+
+Artifacts are addressed by name: a relative path such as
+'sources/upload_<hash>.mp3' or 'segments_<job id>.zip'. Jobs save names, not
+paths. The default backend is a directory, usually the upload folder on a
+filesystem every node mounts. Another backend (object storage, say) can be
+plugged in with the ARTIFACT_STORE setting as 'module:Class'. It is
+constructed with the upload folder and must provide the same methods.
+`path` and `open` hand back local files, because ffmpeg and sendfile need
+them; a remote backend would fetch into a local cache first.
+"""
+import glob
+import os
+import shutil
+
+
+class FilesystemArtifactStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        """
+        Local path of an artifact. Names saved as absolute paths by earlier
+        versions resolve to themselves.
+        """
+        return os.path.join(self.root, name)
+
+    def put(self, name, local_path):
+        """
+        Move a finished local file in as `name`, replacing any artifact of
+        that name atomically. Returns the name.
+        """
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.abspath(local_path) != os.path.abspath(path):
+            try:
+                os.replace(local_path, path)
+            except OSError:
+                # Another filesystem: copy alongside, then swap in
+                temp_path = f'{path}.incoming'
+                shutil.copyfile(local_path, temp_path)
+                os.replace(temp_path, path)
+                os.remove(local_path)
+        return name
+
+    def link(self, name, new_name):
+        """
+        Make `name` also available as `new_name`, sharing storage where the
+        filesystem allows. Returns new_name.
+        """
+        path = self.path(new_name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.link(self.path(name), path)
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copyfile(self.path(name), path)
+        return new_name
+
+    def open(self, name):
+        """
+        Binary file for reading. Raises FileNotFoundError.
+        """
+        return open(self.path(name), 'rb')
+
+    def exists(self, name):
+        return bool(name) and os.path.exists(self.path(name))
+
+    def delete(self, name):
+        if not name:
+            return
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def find(self, prefix):
+        """
+        Names of the artifacts whose names start with prefix.
+        """
+        matches = glob.glob(glob.escape(self.path(prefix)) + '*')
+        return [os.path.relpath(match, self.root) for match in matches]
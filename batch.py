@@ -0,0 +1,404 @@
+"""
+Batch processing of many audio files through the transcribe -> split/encode
+pipeline.
+
+Transcription waits on Replicate while splitting and encoding burn local CPU,
+so each stage has its own worker pool. Segments are planned as each chunk of
+a file's transcript comes in and encoded as soon as their boundaries are
+final, so file A encodes while it is still transcribing, file B transcribes
+while file A is being encoded, and throughput approaches the slowest stage
+instead of the sum of both. Cancelling a batch kills its running encodes and
+predictions and drops everything still queued.
+
+A batch runs in the process that accepted it, but its state and each item's
+progress are saved in the job store, and its ZIPs go to the artifact store,
+so any worker can report on it, cancel it or serve its downloads. Finished
+batches expire with the store's finished jobs.
+"""
+import contextvars
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+from cancellation import CancelToken
+from jobs import BATCH_FAILED, BATCH_PROCESSING, watch_batch
+from pipeline import (
+    DEFAULT_OUTPUT_FORMAT, IncrementalPlanner, friendly_error_message, get_audio_duration, probe_audio_duration,
+    render_segment, transcribe_chunked, write_segments_to_zip, zip_segments
+)
+from scheduler import throughput
+from workers import run_in_process
+
+# Files waiting for or running a prediction. The Replicate client caps
+# concurrent predictions per key and lets the shortest waiting file in first.
+TRANSCRIBE_WORKERS = 16
+EXPORT_WORKERS = os.cpu_count() or 2  # Concurrent segment encodes
+
+OUTPUT_COMBINED = 'combined'
+OUTPUT_PER_FILE = 'per_file'
+OUTPUT_MODES = (OUTPUT_COMBINED, OUTPUT_PER_FILE)
+
+BATCH_KIND = 'audio'  # Kind of these batches in the job store
+
+_running = {}  # batch id -> Batch, for batches this process is running
+_running_lock = threading.Lock()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(stage):
+    # Pools are shared by all batches so concurrent batches don't multiply the worker count
+    with _pools_lock:
+        if stage not in _pools:
+            workers = TRANSCRIBE_WORKERS if stage == 'transcribe' else EXPORT_WORKERS
+            _pools[stage] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'batch-{stage}')
+        return _pools[stage]
+
+
+class BatchItem:
+    def __init__(self, index, name, path, content_hash):
+        self.index = index
+        self.name = name
+        self.path = path
+        self.content_hash = content_hash
+        self.status = 'queued'
+        self.duplicate_of = None
+        self.output_dir = None
+        self.zip_path = None  # Artifact name of a per-file ZIP
+        self.total_segments = None
+        self.error = None
+        self.started_at = None
+        self.audio_duration = None
+
+    @property
+    def folder_name(self):
+        return f'{self.index + 1:03d}_{os.path.splitext(self.name)[0]}'
+
+    def to_row(self):
+        """
+        The item as saved in the job store's batch_items.
+        """
+        return {
+            'item_index': self.index,
+            'name': self.name,
+            'status': self.status,
+            'duplicate_of': self.duplicate_of,
+            'total_segments': self.total_segments,
+            'zip_path': self.zip_path,
+            'error': self.error
+        }
+
+    def to_dict(self):
+        return _item_summary(self.to_row())
+
+
+def _item_summary(row):
+    return {
+        'index': row['item_index'],
+        'name': row['name'],
+        'status': row['status'],
+        'duplicate_of': row['duplicate_of'],
+        'total_segments': row['total_segments'],
+        'download_url': f"/api/download/{row['zip_path']}" if row['zip_path'] else None,
+        'error': row['error']
+    }
+
+
+class Batch:
+    """
+    One submitted batch. Items with identical content are processed once and
+    the duplicates share the result.
+    """
+
+    def __init__(self, store, upload_folder, api_key, max_duration, output_mode, output_format, bitrate):
+        self.id = uuid.uuid4().hex[:12]
+        self.store = store
+        self.upload_folder = upload_folder
+        self.api_key = api_key
+        self.max_duration = max_duration
+        self.output_mode = output_mode
+        self.output_format = output_format
+        self.bitrate = bitrate
+        self.items = []
+        self.status = 'queued'
+        self.zip_path = None  # Artifact name of the combined ZIP
+        self._by_hash = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._on_item_done = None
+        self._cancel = CancelToken()
+        self._finished = threading.Event()
+
+    @property
+    def scratch_dir(self):
+        """Directory for files uploaded directly with this batch"""
+        return os.path.join(self.upload_folder, f'batch_{self.id}')
+
+    def add_item(self, name, path, content_hash):
+        item = BatchItem(len(self.items), name, path, content_hash)
+        primary = self._by_hash.get(content_hash)
+        if primary is not None:
+            item.duplicate_of = primary.index
+            item.status = 'duplicate'
+        else:
+            self._by_hash[content_hash] = item
+        self.items.append(item)
+        return item
+
+    @property
+    def unique_count(self):
+        return len(self._by_hash)
+
+    def start(self, on_item_done=None):
+        """
+        Queue every distinct file for transcription. on_item_done(duration) is
+        called as each one finishes, successfully or not.
+        """
+        unique = [item for item in self.items if item.duplicate_of is None]
+        self._pending = len(unique)
+        self._on_item_done = on_item_done
+        self.status = BATCH_PROCESSING
+        self.store.add_batch(
+            self.id, BATCH_KIND, [item.to_row() for item in self.items], output_mode=self.output_mode,
+            output_format=self.output_format, bitrate=self.bitrate
+        )
+        with _running_lock:
+            _running[self.id] = self
+        watch_batch(self.store, self.id, self._finished, self.cancel)
+        for item in unique:
+            _pool('transcribe').submit(self._run_item, item)
+
+    def cancel(self):
+        """
+        Stop the batch: running predictions are cancelled, ffmpeg is killed,
+        queued files and encodes are skipped and their output is removed.
+        """
+        self._cancel.cancel(f'Batch {self.id} canceled')
+
+    def _run_item(self, item):
+        with log.context(batch_id=self.id, item=item.index):
+            self._transcribe(item)
+
+    def _save(self, item, **fields):
+        # Progress is saved for status requests on any worker; failing to save it doesn't stop the batch
+        for field, value in fields.items():
+            setattr(item, field, value)
+        try:
+            self.store.update_batch_item(self.id, item.index, **fields)
+        except Exception as e:
+            log.error('batch', 'Failed to save item progress', batch_id=self.id, item=item.index, error=str(e))
+
+    def _transcribe(self, item):
+        item.started_at = time.monotonic()
+        item.output_dir = os.path.join(self.upload_folder, f'output_{self.id}_{item.index + 1:03d}')
+        planner = IncrementalPlanner(self.max_duration, self.output_format)
+        renders = []
+
+        def planned(new):
+            # Segments whose boundaries are final are encoded while the rest transcribes
+            for seg in new:
+                renders.append(_pool('export').submit(contextvars.copy_context().run, self._render, item, seg))
+
+        try:
+            self._cancel.raise_if_cancelled()
+            self._save(item, status='transcribing')
+            try:
+                item.audio_duration = probe_audio_duration(item.path)
+            except Exception as e:
+                log.info('batch', 'No header duration, decoding', error=str(e))
+                item.audio_duration = run_in_process(get_audio_duration, item.path)
+            os.makedirs(item.output_dir, exist_ok=True)
+            transcript = transcribe_chunked(
+                item.path, self.api_key, item.audio_duration, on_words=lambda words: planned(planner.feed(words)),
+                cancel=self._cancel
+            )
+            if not transcript:
+                raise Exception('No transcript segments received from Whisper')
+            self._save(item, status='exporting')
+            planned(planner.finish(item.audio_duration))
+            # Usually only the last few segments are still encoding by now
+            encode_time = sum(render.result() for render in renders)
+        except Exception as e:
+            log.error('batch', 'Item processing failed', error=str(e))
+            for render in renders:
+                render.cancel()
+            self._item_failed(item, e)
+            return
+
+        throughput.observe('export', self.output_format, item.audio_duration, encode_time)
+        self._export(item, transcript, planner.segments)
+
+    def _render(self, item, seg):
+        started = time.monotonic()
+        render_segment(
+            item.path, seg['start_time'], seg['end_time'], os.path.join(item.output_dir, seg['filename']),
+            self.output_format, self.bitrate, cancel=self._cancel
+        )
+        return time.monotonic() - started
+
+    def _export(self, item, transcript, segments):
+        try:
+            for seg in segments:
+                txt_path = os.path.join(item.output_dir, os.path.splitext(seg['filename'])[0] + '.txt')
+                with open(txt_path, 'w', encoding='utf-8') as f:
+                    f.write(seg['text'])
+            metadata = {
+                'original_file': item.name,
+                'total_segments': len(segments),
+                'max_duration': self.max_duration,
+                'output_format': self.output_format,
+                'bitrate': self.bitrate,
+                'segments': segments,
+                'full_transcript': transcript.text
+            }
+            with open(os.path.join(item.output_dir, 'metadata.json'), 'w', encoding='utf-8') as f:
+                json.dump(metadata, indent=2, fp=f)
+
+            zip_path = None
+            if self.output_mode == OUTPUT_PER_FILE:
+                zip_path = f'segments_{self.id}_{item.index + 1:03d}.zip'
+                local_path = os.path.join(self.scratch_dir, zip_path)
+                zip_segments(item.output_dir, local_path)
+                self.store.artifacts.put(zip_path, local_path)
+
+            self._save(item, status='completed', total_segments=len(segments), zip_path=zip_path)
+        except Exception as e:
+            log.error('export', 'Item export failed', error=str(e))
+            self._item_failed(item, e)
+            return
+
+        self._item_done(item)
+
+    def _item_failed(self, item, error):
+        if self._cancel.cancelled:
+            self._save(item, status='canceled', error='Canceled')
+        else:
+            self._save(item, status='failed', error=friendly_error_message(str(error)))
+        if item.output_dir and os.path.exists(item.output_dir):
+            shutil.rmtree(item.output_dir, ignore_errors=True)
+        self._item_done(item)
+
+    def _item_done(self, item):
+        if self._on_item_done:
+            self._on_item_done(time.monotonic() - item.started_at)
+
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return
+
+        error = None
+        try:
+            self._finalize()
+        except Exception as e:
+            log.error('batch', 'Finalize failed', batch_id=self.id, error=str(e))
+            self.status = BATCH_FAILED
+            error = friendly_error_message(str(e))
+        finally:
+            # Everything worth keeping is in the ZIPs by now
+            for item in self.items:
+                if item.output_dir:
+                    shutil.rmtree(item.output_dir, ignore_errors=True)
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            try:
+                self.store.update_batch(self.id, status=self.status, zip_path=self.zip_path, error=error)
+            finally:
+                self._finished.set()
+                with _running_lock:
+                    _running.pop(self.id, None)
+
+    def _finalize(self):
+        # Duplicates take over the outcome of the item they duplicate
+        for item in self.items:
+            if item.duplicate_of is not None:
+                primary = self.items[item.duplicate_of]
+                self._save(
+                    item, status=primary.status, zip_path=primary.zip_path, total_segments=primary.total_segments,
+                    error=primary.error
+                )
+
+        if self._cancel.cancelled:
+            self.status = 'canceled'
+            return
+
+        completed = [item for item in self.items if item.duplicate_of is None and item.status == 'completed']
+        if not completed:
+            self.status = BATCH_FAILED
+            return
+
+        if self.output_mode == OUTPUT_COMBINED:
+            zip_path = f'segments_{self.id}.zip'
+            local_path = os.path.join(self.scratch_dir, zip_path)
+            with zipfile.ZipFile(local_path, 'w') as zipf:
+                # Identical files are stored once; batch.json maps every input to its folder
+                for item in completed:
+                    write_segments_to_zip(zipf, item.output_dir, prefix=item.folder_name)
+                manifest = []
+                for item in self.items:
+                    primary = item if item.duplicate_of is None else self.items[item.duplicate_of]
+                    folder = primary.folder_name if item.status == 'completed' else None
+                    manifest.append(dict(item.to_dict(), folder=folder))
+                zipf.writestr('batch.json', json.dumps(manifest, indent=2))
+            self.zip_path = self.store.artifacts.put(zip_path, local_path)
+
+        self.status = 'completed'
+
+
+def create_batch(store, upload_folder, api_key, max_duration, output_mode=OUTPUT_COMBINED,
+                 output_format=DEFAULT_OUTPUT_FORMAT, bitrate=None):
+    batch = Batch(store, upload_folder, api_key, max_duration, output_mode, output_format, bitrate)
+    os.makedirs(batch.scratch_dir, exist_ok=True)
+    return batch
+
+
+def discard_batch(batch):
+    """
+    Remove the uploads of a batch that was never started.
+    """
+    shutil.rmtree(batch.scratch_dir, ignore_errors=True)
+
+
+def get_batch(store, batch_id):
+    """
+    A batch's progress as /api/batch/<batch_id> reports it, whichever worker
+    runs it, or None.
+    """
+    batch = store.get_batch(batch_id, BATCH_KIND)
+    if batch is None:
+        return None
+    items = [_item_summary(item) for item in batch['items']]
+    return {
+        'batch_id': batch['id'],
+        'status': batch['status'],
+        'output': batch['output_mode'],
+        'output_format': batch['output_format'],
+        'bitrate': batch['bitrate'],
+        'total_files': len(items),
+        'unique_files': sum(1 for item in items if item['duplicate_of'] is None),
+        'completed_files': sum(1 for item in items if item['status'] == 'completed'),
+        'failed_files': sum(1 for item in items if item['status'] == 'failed'),
+        'download_url': f"/api/download/{batch['zip_path']}" if batch['zip_path'] else None,
+        'error': batch['error'],
+        'items': items
+    }
+
+
+def cancel_batch(store, batch_id):
+    """
+    Cancel a processing batch. One running in this process stops right away;
+    one running in another worker stops within CANCEL_POLL_INTERVAL.
+    Returns False if the batch isn't processing.
+    """
+    canceled = store.cancel_batch(batch_id)
+    with _running_lock:
+        batch = _running.get(batch_id)
+    if batch:
+        batch.cancel()
+    return canceled
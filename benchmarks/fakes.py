@@ -0,0 +1,422 @@
+"""
+Local stand-ins for the Replicate predictions API and the Kling video-to-lip
+API, so the app can be load tested without paid calls.
+
+Point the app at them with REPLICATE_BASE_URL (read by the replicate client)
+and AUDIO_SEGMENTER_KLING_API_BASE. Latency, failure rates and the shape of
+the Whisper output are configurable; transcripts are generated from the
+uploaded audio's duration with realistic word timings and punctuation.
+
+    python benchmarks/fakes.py --replicate-port 8701 --kling-port 8702 --prediction-rate 0.05
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OUTPUT_SHAPES = ('chunks', 'segments', 'srt', 'url')
+
+WORDS = (
+    'the', 'a', 'we', 'you', 'this', 'that', 'audio', 'segment', 'model', 'today', 'really', 'think', 'going',
+    'people', 'because', 'about', 'something', 'actually', 'question', 'right', 'know', 'time', 'work', 'just'
+)
+WORDS_PER_SECOND = 2.6
+
+
+class Behaviour:
+    """
+    How a fake service responds. Times are in seconds, rates are 0-1.
+    """
+
+    def __init__(self, request_latency=0.02, error_rate=0.0, prediction_base=1.0, prediction_rate=1 / 33,
+                 jitter=0.25, failure_rate=0.0, output_shape='chunks', default_duration=60.0, kling_time=5.0,
+                 kling_parallel=0, seed=None):
+        self.request_latency = request_latency  # Added to every HTTP response
+        self.error_rate = error_rate  # Share of requests answered with a 429/5xx
+        self.prediction_base = prediction_base  # Fixed seconds per prediction
+        self.prediction_rate = prediction_rate  # Seconds of processing per second of audio
+        self.jitter = jitter  # +/- share applied to processing times
+        self.failure_rate = failure_rate  # Share of predictions / lipsync tasks that fail
+        self.output_shape = output_shape
+        self.default_duration = default_duration  # When the upload's duration can't be read
+        self.kling_time = kling_time  # Seconds a lipsync task takes
+        self.kling_parallel = kling_parallel  # Running lipsync tasks allowed per key (0 for no limit)
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def chance(self, rate):
+        with self._lock:
+            return self.random.random() < rate
+
+    def jittered(self, seconds):
+        with self._lock:
+            return seconds * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def audio_duration(data, default):
+    """
+    Duration of WAV or FLAC bytes from the header, else `default`.
+    """
+    if data[:4] == b'fLaC':
+        # STREAMINFO: 20-bit sample rate, 3-bit channels, 5-bit depth, 36-bit sample count
+        packed = int.from_bytes(data[18:26], 'big')
+        sample_rate = packed >> 44
+        total_samples = packed & ((1 << 36) - 1)
+        if sample_rate and total_samples:
+            return total_samples / sample_rate
+    elif data[:4] == b'RIFF':
+        try:
+            with wave.open(io.BytesIO(data)) as wav_file:
+                return wav_file.getnframes() / wav_file.getframerate()
+        except (wave.Error, EOFError):
+            pass
+    return default
+
+
+def generate_words(duration, rng):
+    """
+    Word timings for `duration` seconds of speech: uneven word lengths, short
+    pauses, commas and sentence ends every few words.
+    """
+    words = []
+    t = rng.uniform(0, 0.5)
+    sentence_length = 0
+    while t < duration - 0.3:
+        length = min(rng.uniform(0.15, 0.6), duration - t)
+        text = rng.choice(WORDS)
+        sentence_length += 1
+        if sentence_length >= 6 and rng.random() < 0.18:
+            text += rng.choice('..?!')
+            sentence_length = 0
+        elif sentence_length >= 3 and rng.random() < 0.08:
+            text += ','
+        words.append((round(t, 2), round(t + length, 2), text))
+        # Longer pauses after sentences
+        t += length + rng.uniform(0.02, 0.12) + (rng.uniform(0.3, 0.9) if sentence_length == 0 else 0)
+    return words
+
+
+def _srt_time(seconds):
+    millis = int(round(seconds * 1000))
+    return f'{millis // 3600000:02d}:{millis // 60000 % 60:02d}:{millis // 1000 % 60:02d},{millis % 1000:03d}'
+
+
+def format_output(words, shape):
+    """
+    Whisper output in the shape of one of the models the parser supports.
+    """
+    text = ' '.join(word for _, _, word in words)
+    if shape == 'chunks':
+        # incredibly-fast-whisper
+        return {'text': text, 'chunks': [{'timestamp': [start, end], 'text': f' {word}'} for start, end, word in words]}
+    if shape == 'segments':
+        # openai/whisper with word timestamps: sentences holding their words
+        segments, current = [], []
+        for start, end, word in words:
+            current.append({'start': start, 'end': end, 'word': f' {word}'})
+            if word[-1] in '.?!':
+                segments.append(current)
+                current = []
+        if current:
+            segments.append(current)
+        return {
+            'transcription': text,
+            'segments': [
+                {'start': seg[0]['start'], 'end': seg[-1]['end'], 'text': ''.join(w['word'] for w in seg), 'words': seg}
+                for seg in segments
+            ]
+        }
+    if shape == 'srt':
+        return ''.join(
+            f'{i}\n{_srt_time(start)} --> {_srt_time(end)}\n{word}\n\n' for i, (start, end, word) in enumerate(words, 1)
+        )
+    raise ValueError(f'Unknown output shape: {shape}')
+
+
+class FakeService:
+    """
+    Base for the fakes: a threaded HTTP server with shared behaviour, request
+    counters and a route table of (method, regex, handler).
+    """
+    routes = ()
+
+    def __init__(self, behaviour, host='127.0.0.1', port=0):
+        self.behaviour = behaviour
+        self.counts = {}
+        self._lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                service._dispatch(self, 'GET')
+
+            def do_POST(self):
+                service._dispatch(self, 'POST')
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True, name=type(self).__name__).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _dispatch(self, handler, method):
+        body = b''
+        length = int(handler.headers.get('Content-Length') or 0)
+        if length:
+            body = handler.rfile.read(length)
+
+        time.sleep(self.behaviour.jittered(self.behaviour.request_latency))
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, handler.path.split('?')[0])
+            if route_method == method and match:
+                self.count(name)
+                if self.behaviour.chance(self.behaviour.error_rate):
+                    self.count('injected_errors')
+                    status = 429 if self.behaviour.chance(0.5) else 503
+                    return self._send(handler, status, {'detail': 'Injected error'})
+                status, payload = getattr(self, name)(handler, body, *match.groups())
+                return self._send(handler, status, payload)
+        self._send(handler, 404, {'detail': 'Not found'})
+
+    def _send(self, handler, status, payload):
+        if isinstance(payload, bytes):
+            data, content_type = payload, 'application/octet-stream'
+        else:
+            data, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+class FakeReplicate(FakeService):
+    """
+    /v1/predictions create, get and cancel. A prediction is 'starting' for a
+    moment, 'processing' until its processing time has passed, then succeeds
+    (or fails, at failure_rate) with a transcript of the uploaded audio.
+    """
+    routes = (
+        ('POST', r'/v1/predictions', 'create'),
+        ('GET', r'/v1/predictions/([\w-]+)', 'get'),
+        ('POST', r'/v1/predictions/([\w-]+)/cancel', 'cancel'),
+        ('GET', r'/files/([\w-]+)\.json', 'file'),
+    )
+
+    def __init__(self, behaviour, host='127.0.0.1', port=0):
+        super().__init__(behaviour, host, port)
+        self.predictions = {}
+
+    def create(self, handler, body):
+        request = json.loads(body or b'{}')
+        audio = (request.get('input') or {}).get('audio', '')
+        data = base64.b64decode(audio.split(',', 1)[1]) if audio.startswith('data:') else b''
+        duration = audio_duration(data, self.behaviour.default_duration)
+
+        now = time.time()
+        behaviour = self.behaviour
+        prediction = {
+            'id': uuid.uuid4().hex,
+            'model': 'fake/whisper',
+            'version': request.get('version', ''),
+            'input': {'task': (request.get('input') or {}).get('task')},
+            'logs': '',
+            'error': None,
+            'output': None,
+            'metrics': None,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now)),
+            'started_at': None,
+            'completed_at': None,
+            # Not part of the API response
+            '_duration': duration,
+            '_started': now + min(0.5, behaviour.prediction_base / 4),
+            '_done': now + behaviour.jittered(behaviour.prediction_base + duration * behaviour.prediction_rate),
+            '_fails': behaviour.chance(behaviour.failure_rate),
+            '_canceled': False,
+        }
+        with self._lock:
+            self.predictions[prediction['id']] = prediction
+        return 201, self._public(prediction)
+
+    def get(self, handler, body, prediction_id):
+        prediction = self.predictions.get(prediction_id)
+        if prediction is None:
+            return 404, {'detail': 'Not found.'}
+        return 200, self._public(prediction)
+
+    def cancel(self, handler, body, prediction_id):
+        prediction = self.predictions.get(prediction_id)
+        if prediction is None:
+            return 404, {'detail': 'Not found.'}
+        prediction['_canceled'] = True
+        return 200, self._public(prediction)
+
+    def file(self, handler, body, prediction_id):
+        prediction = self.predictions.get(prediction_id)
+        if prediction is None:
+            return 404, {'detail': 'Not found.'}
+        return 200, json.dumps(self._output(prediction, 'chunks')).encode('utf-8')
+
+    def _output(self, prediction, shape):
+        # Seeded by id, so every poll (and the URL file) returns the same transcript
+        return format_output(generate_words(prediction['_duration'], random.Random(prediction['id'])), shape)
+
+    def _public(self, prediction):
+        now = time.time()
+        result = {key: value for key, value in prediction.items() if not key.startswith('_')}
+        result['urls'] = {
+            'get': f'{self.url}/v1/predictions/{prediction["id"]}',
+            'cancel': f'{self.url}/v1/predictions/{prediction["id"]}/cancel',
+        }
+        if prediction['_canceled']:
+            result['status'] = 'canceled'
+        elif now < prediction['_started']:
+            result['status'] = 'starting'
+        elif now < prediction['_done']:
+            result['status'] = 'processing'
+        elif prediction['_fails']:
+            result['status'] = 'failed'
+            result['error'] = 'CUDA out of memory (injected failure)'
+        else:
+            result['status'] = 'succeeded'
+            result['completed_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(prediction['_done']))
+            if self.behaviour.output_shape == 'url':
+                result['output'] = f'{self.url}/files/{prediction["id"]}.json'
+            else:
+                result['output'] = self._output(prediction, self.behaviour.output_shape)
+        if result['status'] != 'starting':
+            result['started_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(prediction['_started']))
+        return result
+
+
+class FakeKling(FakeService):
+    """
+    /v1/videos/video-to-lip submit and status, answering in the envelope the
+    app expects ({'code': 0, 'data': ...}). Like Kling, a key over its
+    parallel task limit gets 429 with code 1303.
+    """
+    routes = (
+        ('POST', r'/v1/videos/video-to-lip', 'submit'),
+        ('GET', r'/v1/videos/video-to-lip/([\w-]+)', 'status'),
+        ('GET', r'/files/([\w-]+)\.mp4', 'file'),
+    )
+
+    def __init__(self, behaviour, host='127.0.0.1', port=0):
+        super().__init__(behaviour, host, port)
+        self.tasks = {}
+        self.peak_running = 0
+
+    def submit(self, handler, body):
+        key = handler.headers.get('Authorization', '')
+        if not key.startswith('Bearer '):
+            return 401, {'code': 1000, 'message': 'Authorization failed'}
+        request = json.loads(body or b'{}')
+        if not request.get('video') or not request.get('audio'):
+            return 400, {'code': 1201, 'message': 'video and audio are required'}
+
+        task_id = uuid.uuid4().hex
+        done = time.time() + self.behaviour.jittered(self.behaviour.kling_time)
+        with self._lock:
+            running = sum(1 for task in self.tasks.values() if task['key'] == key and task['done'] > time.time())
+            if self.behaviour.kling_parallel and running >= self.behaviour.kling_parallel:
+                self.counts['parallel_limit'] = self.counts.get('parallel_limit', 0) + 1
+                return 429, {'code': 1303, 'message': 'Parallel task limit reached'}
+            self.tasks[task_id] = {
+                'key': key,
+                'done': done,
+                'fails': self.behaviour.chance(self.behaviour.failure_rate),
+                'size': len(request['video']) * 3 // 4,
+            }
+            self.peak_running = max(self.peak_running, running + 1)
+        return 200, {'code': 0, 'message': 'SUCCEED', 'data': {'task_id': task_id, 'task_status': 'submitted'}}
+
+    def status(self, handler, body, task_id):
+        task = self.tasks.get(task_id)
+        if task is None:
+            return 200, {'code': 1203, 'message': 'Task not found'}
+        data = {'task_id': task_id, 'status': 'processing'}
+        if time.time() >= task['done']:
+            if task['fails']:
+                data.update(status='failed', task_status_msg='Face not detected (injected failure)')
+            else:
+                data.update(status='succeed', task_result={'videos': [{'id': task_id, 'url': f'{self.url}/files/{task_id}.mp4'}]})
+        return 200, {'code': 0, 'message': 'SUCCEED', 'data': {'task': data}}
+
+    def file(self, handler, body, task_id):
+        task = self.tasks.get(task_id)
+        if task is None:
+            return 404, {'code': 1203, 'message': 'Task not found'}
+        return 200, b'\0' * task['size']
+
+
+def add_behaviour_arguments(parser):
+    group = parser.add_argument_group('fake services')
+    group.add_argument('--request-latency', type=float, default=0.02, help='Seconds added to every fake API response')
+    group.add_argument('--error-rate', type=float, default=0.0, help='Share of fake API requests answered 429/503')
+    group.add_argument('--prediction-base', type=float, default=1.0, help='Fixed seconds per prediction')
+    group.add_argument('--prediction-rate', type=float, default=1 / 33, help='Prediction seconds per audio second')
+    group.add_argument('--jitter', type=float, default=0.25, help='+/- share applied to fake processing times')
+    group.add_argument('--failure-rate', type=float, default=0.0, help='Share of predictions/lipsync tasks that fail')
+    group.add_argument('--output-shape', choices=OUTPUT_SHAPES, default='chunks', help='Whisper output format')
+    group.add_argument('--kling-time', type=float, default=5.0, help='Seconds a lipsync task takes')
+    group.add_argument('--kling-parallel', type=int, default=0, help='Running lipsync tasks allowed per key (0: no limit)')
+    group.add_argument('--seed', type=int, default=None)
+
+
+def behaviour_from_args(args):
+    return Behaviour(
+        request_latency=args.request_latency, error_rate=args.error_rate, prediction_base=args.prediction_base,
+        prediction_rate=args.prediction_rate, jitter=args.jitter, failure_rate=args.failure_rate,
+        output_shape=args.output_shape, kling_time=args.kling_time, kling_parallel=args.kling_parallel, seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--replicate-port', type=int, default=8701)
+    parser.add_argument('--kling-port', type=int, default=8702)
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    behaviour = behaviour_from_args(args)
+    replicate = FakeReplicate(behaviour, args.host, args.replicate_port).start()
+    kling = FakeKling(behaviour, args.host, args.kling_port).start()
+    print(f'REPLICATE_BASE_URL={replicate.url}')
+    print(f'AUDIO_SEGMENTER_KLING_API_BASE={kling.url}')
+    try:
+        while True:
+            time.sleep(60)
+            print(f'replicate: {replicate.counts}  kling: {kling.counts}')
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
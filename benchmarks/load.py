@@ -0,0 +1,533 @@
+"""
+End-to-end load test against local fakes of Replicate and Kling.
+
+Starts the fake services (see fakes.py) and an app server pointed at them,
+then replays a weighted mix of requests from concurrent clients. Reports
+throughput, p50/p95/p99 latency and error rate per operation, plus the peak
+memory of every server process (Linux only).
+
+    python benchmarks/load.py --concurrency 16 --duration 60
+    python benchmarks/load.py --server gunicorn --mix process=3,estimate=1 --failure-rate 0.05 --json load.json
+    python benchmarks/load.py --url http://127.0.0.1:5003 --server-pid 1234   # an already running server
+
+Operations:
+    estimate   POST /api/estimate-time
+    process    POST /api/process, then download the ZIP and clean up
+    trim       POST /trim-videos-zip (needs ffmpeg)
+    combine    POST /combine-videos (needs ffmpeg)
+    lipsync    POST /api/kling-lipsync, then poll /api/kling-status until done
+    lipsync_batch
+               POST /api/kling-lipsync/batch with one video for LIPSYNC_BATCH_SIZE
+               clips, then poll the batch until every task is done (not in
+               the default mix)
+"""
+import argparse
+import array
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import FakeKling, FakeReplicate, add_behaviour_arguments, behaviour_from_args  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = 'estimate=4,process=3,trim=1,combine=1,lipsync=1'
+VIDEO_OPERATIONS = ('trim', 'combine')
+LIPSYNC_POLL_INTERVAL = 1.0
+LIPSYNC_BATCH_SIZE = 8
+REQUEST_TIMEOUT = 900
+MEMORY_SAMPLE_INTERVAL = 0.5
+SERVER_START_TIMEOUT = 30
+
+
+def write_sample_audio(path, seconds, rate=16000):
+    """
+    A quiet tone with a little noise, so encoders do real work.
+    """
+    rng = random.Random(0)
+    samples = array.array('h', (
+        int(3000 * math.sin(2 * math.pi * 220 * i / rate) + rng.randint(-300, 300)) for i in range(rate)
+    ))
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        for _ in range(int(seconds)):
+            wav_file.writeframes(samples.tobytes())
+
+
+def write_sample_video(path, seconds=3):
+    if not shutil.which('ffmpeg'):
+        return False
+    result = subprocess.run([
+        'ffmpeg', '-y', '-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size=320x240:rate=25',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}', '-shortest',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac', path
+    ], capture_output=True)
+    return result.returncode == 0
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown operations: {", ".join(sorted(unknown))}')
+    return mix
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Workload:
+    """
+    Sample files, API keys and the server URL shared by every client.
+    """
+
+    def __init__(self, url, audio_path, video_paths, api_keys, max_duration):
+        self.url = url
+        self.audio_path = audio_path
+        self.video_paths = video_paths
+        self.api_keys = api_keys
+        self.max_duration = max_duration
+
+    def audio(self):
+        return open(self.audio_path, 'rb')
+
+    def videos(self):
+        return [('videos', (f'segment_{i + 1:03d}.mp4', open(path, 'rb'), 'video/mp4'))
+                for i, path in enumerate(self.video_paths)]
+
+
+def _check(response, expected=200):
+    if response.status_code != expected:
+        raise Exception(f'{response.request.method} {response.url}: {response.status_code} {response.text[:200]}')
+    return response
+
+
+def op_estimate(session, workload):
+    with workload.audio() as audio:
+        _check(session.post(f'{workload.url}/api/estimate-time', files={'audio': ('sample.wav', audio)},
+                            timeout=REQUEST_TIMEOUT))
+
+
+def op_process(session, workload):
+    with workload.audio() as audio:
+        result = _check(session.post(
+            f'{workload.url}/api/process', files={'audio': ('sample.wav', audio)},
+            data={'api_key': random.choice(workload.api_keys), 'max_duration': workload.max_duration, 'prerender': '1'},
+            timeout=REQUEST_TIMEOUT
+        )).json()
+    try:
+        _check(session.get(f'{workload.url}{result["download_url"]}', timeout=REQUEST_TIMEOUT))
+    finally:
+        session.post(f'{workload.url}{result["cleanup_url"]}', timeout=REQUEST_TIMEOUT)
+
+
+def op_trim(session, workload):
+    files = workload.videos()
+    try:
+        durations = {name: 1.5 for _, (name, _, _) in files}
+        _check(session.post(f'{workload.url}/trim-videos-zip', files=files,
+                            data={'durations': json.dumps(durations)}, timeout=REQUEST_TIMEOUT))
+    finally:
+        for _, (_, f, _) in files:
+            f.close()
+
+
+def op_combine(session, workload):
+    files = workload.videos()
+    try:
+        _check(session.post(f'{workload.url}/combine-videos', files=files, timeout=REQUEST_TIMEOUT))
+    finally:
+        for _, (_, f, _) in files:
+            f.close()
+
+
+def op_lipsync(session, workload):
+    keys = {'kling_access_key': 'load-test-access', 'kling_secret_key': 'load-test-secret'}
+    with workload.audio() as audio, open(workload.video_paths[0] if workload.video_paths else workload.audio_path, 'rb') as video:
+        task = _check(session.post(
+            f'{workload.url}/api/kling-lipsync', files={'video': ('face.mp4', video), 'audio': ('speech.wav', audio)},
+            data=keys, timeout=REQUEST_TIMEOUT
+        )).json()
+    while True:
+        time.sleep(LIPSYNC_POLL_INTERVAL)
+        status = _check(session.get(
+            f'{workload.url}/api/kling-status/{task["task_id"]}',
+            params={'access_key': keys['kling_access_key'], 'secret_key': keys['kling_secret_key']},
+            timeout=REQUEST_TIMEOUT
+        )).json()
+        if status['status'] == 'completed':
+            return
+        if status['status'] == 'failed':
+            raise Exception(f'Lipsync failed: {status.get("error")}')
+
+
+def op_lipsync_batch(session, workload):
+    keys = {'kling_access_key': 'load-test-access', 'kling_secret_key': 'load-test-secret'}
+    with open(workload.video_paths[0] if workload.video_paths else workload.audio_path, 'rb') as video, \
+            workload.audio() as audio:
+        clip = audio.read()
+        files = [('video', ('face.mp4', video))]
+        files += [('audio', (f'segment_{i + 1:03d}.wav', clip)) for i in range(LIPSYNC_BATCH_SIZE)]
+        batch = _check(session.post(
+            f'{workload.url}/api/kling-lipsync/batch', files=files, data=keys, timeout=REQUEST_TIMEOUT
+        ), expected=202).json()
+    while True:
+        time.sleep(LIPSYNC_POLL_INTERVAL)
+        status = _check(session.get(f'{workload.url}{batch["status_url"]}', timeout=REQUEST_TIMEOUT)).json()
+        if status['status'] == 'completed':
+            if status['counts']['failed']:
+                raise Exception(f'{status["counts"]["failed"]} of {status["total_tasks"]} lipsync tasks failed')
+            return
+
+
+OPERATIONS = {
+    'estimate': op_estimate,
+    'process': op_process,
+    'trim': op_trim,
+    'combine': op_combine,
+    'lipsync': op_lipsync,
+    'lipsync_batch': op_lipsync_batch,
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # operation -> [seconds] of successful runs
+        self.errors = {}  # operation -> count
+        self.error_samples = {}  # operation -> first few messages
+        self._lock = threading.Lock()
+
+    def record(self, operation, elapsed, error=None):
+        with self._lock:
+            self.latencies.setdefault(operation, [])
+            self.errors.setdefault(operation, 0)
+            if error is None:
+                self.latencies[operation].append(elapsed)
+            else:
+                self.errors[operation] += 1
+                samples = self.error_samples.setdefault(operation, [])
+                if len(samples) < 3:
+                    samples.append(str(error)[:300])
+
+    def summary(self, wall_time):
+        result = {}
+        for operation in sorted(self.latencies):
+            latencies = sorted(self.latencies[operation])
+            total = len(latencies) + self.errors[operation]
+            result[operation] = {
+                'requests': total,
+                'errors': self.errors[operation],
+                'error_rate': self.errors[operation] / total if total else 0,
+                'throughput': len(latencies) / wall_time,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'error_samples': self.error_samples.get(operation, []),
+            }
+        return result
+
+
+def _process_tree(pid):
+    """
+    pid and all its descendants, from /proc.
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name can contain spaces; the parent pid follows its closing paren
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, ()))
+    return tree
+
+
+def _rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _command(pid):
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return f.read().replace(b'\0', b' ').decode('utf-8', 'replace').strip()[:80]
+    except OSError:
+        return '?'
+
+
+class MemorySampler:
+    """
+    Samples the RSS of a server process and its children (workers, process
+    pools, ffmpeg) until stopped. Linux only.
+    """
+
+    def __init__(self, pid, interval=MEMORY_SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.processes = {}  # pid -> {'command', 'peak', 'last'}
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='memory-sampler')
+
+    @property
+    def supported(self):
+        return os.path.isdir('/proc')
+
+    def start(self):
+        if self.supported:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            total = 0
+            for pid in _process_tree(self.pid):
+                rss = _rss_bytes(pid)
+                if rss is None:
+                    continue
+                total += rss
+                process = self.processes.setdefault(pid, {'command': _command(pid), 'peak': 0, 'last': 0})
+                process['peak'] = max(process['peak'], rss)
+                process['last'] = rss
+            self.peak_total = max(self.peak_total, total)
+            self._stop.wait(self.interval)
+
+    def summary(self):
+        return {
+            'peak_total': self.peak_total,
+            'processes': {str(pid): process for pid, process in sorted(self.processes.items())},
+        }
+
+
+def _log_tail(log_path, lines=20):
+    with open(log_path, errors='replace') as f:
+        return ''.join(f.readlines()[-lines:])
+
+
+def start_server(kind, port, env, log_path):
+    if kind == 'gunicorn':
+        env = dict(env, GUNICORN_BIND=f'127.0.0.1:{port}')
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app']
+    else:
+        command = [sys.executable, '-c', f'from app import create_app; create_app().run(port={port}, threaded=True)']
+    log = open(log_path, 'w')
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with {process.returncode}:\n{_log_tail(log_path)}')
+        try:
+            requests.get(url, timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'Server did not start within {SERVER_START_TIMEOUT}s:\n{_log_tail(log_path)}')
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_clients(workload, mix, concurrency, duration, total_requests, recorder):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    deadline = time.monotonic() + duration if duration else None
+    remaining = [total_requests]
+    remaining_lock = threading.Lock()
+
+    def take():
+        if deadline and time.monotonic() >= deadline:
+            return False
+        if total_requests:
+            with remaining_lock:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+        return True
+
+    def client():
+        session = requests.Session()
+        while take():
+            operation = random.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                OPERATIONS[operation](session, workload)
+                recorder.record(operation, time.perf_counter() - start)
+            except Exception as e:
+                recorder.record(operation, time.perf_counter() - start, e)
+
+    threads = [threading.Thread(target=client, daemon=True, name=f'client-{i}') for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def print_report(results, memory, wall_time):
+    print(f'\nWall time: {wall_time:.1f}s')
+    print(f'{"operation":<14}{"requests":>9}{"errors":>8}{"err %":>7}{"req/s":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    ms = lambda value: f'{value * 1000:>10.0f}' if value is not None else f'{"-":>10}'
+    for operation, stats in results.items():
+        print(f'{operation:<14}{stats["requests"]:>9}{stats["errors"]:>8}{stats["error_rate"] * 100:>7.1f}'
+              f'{stats["throughput"]:>8.2f}{ms(stats["p50"])}{ms(stats["p95"])}{ms(stats["p99"])}')
+    for operation, stats in results.items():
+        for sample in stats['error_samples']:
+            print(f'  {operation} error: {sample}')
+
+    if memory:
+        print(f'\nServer memory (peak total {memory["peak_total"] / 2 ** 20:.0f} MB)')
+        print(f'{"pid":>8}{"peak MB":>9}{"last MB":>9}  command')
+        for pid, process in memory['processes'].items():
+            print(f'{pid:>8}{process["peak"] / 2 ** 20:>9.0f}{process["last"] / 2 ** 20:>9.0f}  {process["command"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Test a running server instead of starting one (point it at the fakes yourself)')
+    parser.add_argument('--server-pid', type=int, help='With --url, the server pid to sample memory from')
+    parser.add_argument('--server', choices=('flask', 'gunicorn'), default='flask', help='Server to start')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to keep starting requests (0: no limit)')
+    parser.add_argument('--requests', type=int, default=0, help='Stop after this many requests (0: no limit)')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help=f'Operation weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--audio-seconds', type=int, default=120, help='Length of the sample audio')
+    parser.add_argument('--max-duration', type=float, default=30, help='Segment length for process requests')
+    parser.add_argument('--api-keys', type=int, default=4, help='Distinct fake Replicate keys to spread jobs over')
+    parser.add_argument('--json', help='Also write the results to this file')
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+    if not args.duration and not args.requests:
+        parser.error('set --duration or --requests')
+
+    scratch = tempfile.mkdtemp(prefix='audio-segmenter-load-')
+    server = fakes = sampler = None
+    try:
+        audio_path = os.path.join(scratch, 'sample.wav')
+        write_sample_audio(audio_path, args.audio_seconds)
+        video_paths = [os.path.join(scratch, f'clip_{i}.mp4') for i in range(2)]
+        if not all(write_sample_video(path) for path in video_paths):
+            video_paths = []
+            dropped = [name for name in VIDEO_OPERATIONS if name in args.mix]
+            if dropped:
+                print(f'ffmpeg could not create sample videos; skipping {", ".join(dropped)}')
+            for name in VIDEO_OPERATIONS:
+                args.mix.pop(name, None)
+        if not args.mix:
+            parser.error('no operations left to run')
+
+        if args.url:
+            url = args.url.rstrip('/')
+            server_pid = args.server_pid
+        else:
+            behaviour = behaviour_from_args(args)
+            fakes = [FakeReplicate(behaviour).start(), FakeKling(behaviour).start()]
+            env = dict(
+                os.environ,
+                REPLICATE_BASE_URL=fakes[0].url,
+                AUDIO_SEGMENTER_KLING_API_BASE=fakes[1].url,
+                AUDIO_SEGMENTER_KLING_POLL_INTERVAL=str(LIPSYNC_POLL_INTERVAL),
+                AUDIO_SEGMENTER_UPLOAD_FOLDER=os.path.join(scratch, 'uploads'),
+            )
+            log_path = os.path.join(scratch, 'server.log')
+            server, url = start_server(args.server, free_port(), env, log_path)
+            server_pid = server.pid
+            print(f'Started {args.server} server at {url} (log: {log_path})')
+
+        if server_pid:
+            sampler = MemorySampler(server_pid).start()
+
+        workload = Workload(url, audio_path, video_paths, [f'r8_load_test_{i}' for i in range(args.api_keys)],
+                            args.max_duration)
+        print(f'Running {args.concurrency} clients, mix {args.mix}, '
+              f'{f"{args.duration:.0f}s" if args.duration else f"{args.requests} requests"}...')
+        recorder = Recorder()
+        wall_time = run_clients(workload, args.mix, args.concurrency, args.duration, args.requests, recorder)
+
+        results = recorder.summary(wall_time)
+        memory = None
+        if sampler:
+            sampler.stop()
+            memory = sampler.summary() if sampler.supported else None
+        print_report(results, memory, wall_time)
+        if fakes:
+            print(f'\nFake Replicate requests: {fakes[0].counts}\nFake Kling requests: {fakes[1].counts}')
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({
+                    'python': sys.version.split()[0],
+                    'server': 'external' if args.url else args.server,
+                    'concurrency': args.concurrency,
+                    'mix': args.mix,
+                    'audio_seconds': args.audio_seconds,
+                    'wall_time': wall_time,
+                    'results': results,
+                    'memory': memory,
+                    'fake_requests': {'replicate': fakes[0].counts, 'kling': fakes[1].counts} if fakes else None,
+                }, f, indent=2)
+    finally:
+        if sampler:
+            sampler.stop()
+        if server:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if fakes:
+            for fake in fakes:
+                fake.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
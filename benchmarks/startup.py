@@ -0,0 +1,106 @@
+"""
+Cold start benchmark: time from a fresh interpreter to the first response.
+
+Each run starts a new Python process (as a serverless cold start would),
+imports the app, creates it and sends one request. Reported times are the
+median over all runs, plus the slowest run.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20 --json results.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the child process; prints its own timings as JSON
+CHILD = '''
+import io, json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app as app_module
+imported = time.perf_counter()
+app = app_module.create_app({{'UPLOAD_FOLDER': {upload_folder!r}}})
+created = time.perf_counter()
+client = app.test_client()
+if {endpoint!r} == '/':
+    response = client.get('/')
+else:
+    with open({sample!r}, 'rb') as f:
+        response = client.post({endpoint!r}, data={{'audio': (io.BytesIO(f.read()), 'sample.wav')}})
+responded = time.perf_counter()
+assert response.status_code == 200, response.data
+print(json.dumps({{
+    'import': imported - started,
+    'create_app': created - imported,
+    'first_response': responded - created,
+}}))
+'''
+
+ENDPOINTS = ('/', '/api/estimate-time')
+
+
+def write_sample(path, seconds=5, rate=16000):
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(b'\0\0' * rate * seconds)
+
+
+def run_once(endpoint, upload_folder, sample):
+    code = CHILD.format(root=ROOT, upload_folder=upload_folder, endpoint=endpoint, sample=sample)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=ROOT)
+    total = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'{endpoint} run failed:\n{result.stderr}')
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    # Includes interpreter startup, which the child can't measure itself
+    timings['total'] = total
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        sample = os.path.join(scratch, 'sample.wav')
+        write_sample(sample)
+
+        for endpoint in ENDPOINTS:
+            runs = []
+            for i in range(args.runs):
+                # A fresh upload folder per run, so nothing carries over between cold starts
+                runs.append(run_once(endpoint, os.path.join(scratch, f'run_{endpoint.strip("/") or "index"}_{i}'), sample))
+            results[endpoint] = {
+                phase: {
+                    'median': statistics.median(run[phase] for run in runs),
+                    'max': max(run[phase] for run in runs)
+                }
+                for phase in runs[0]
+            }
+
+    print(f'{"endpoint":<22}{"phase":<16}{"median ms":>10}{"max ms":>10}')
+    for endpoint, phases in results.items():
+        for phase, stats in phases.items():
+            print(f'{endpoint:<22}{phase:<16}{stats["median"] * 1000:>10.1f}{stats["max"] * 1000:>10.1f}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'runs': args.runs, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Cooperative cancellation for long-running work.
+
+A CancelToken is passed down through a job. Loops check it between steps,
+and its waits end as soon as it fires. Work that can be stopped from outside,
+such as an ffmpeg process or a Replicate prediction, registers a callback
+that runs the moment the token is cancelled. Tokens fire on an explicit
+cancel request, or when the client that is waiting for the result hangs up.
+"""
+import select
+import socket
+import subprocess
+import threading
+from contextlib import contextmanager
+
+import log
+
+DISCONNECT_POLL_INTERVAL = 1.0
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason='Canceled'):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        log.info('cancel', 'Cancelling', reason=reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                log.error('cancel', 'Cancel callback error', error=str(e))
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def wait(self, seconds):
+        """
+        Sleep for `seconds`, raising Cancelled as soon as the token fires.
+        """
+        if self._event.wait(seconds):
+            raise Cancelled(self.reason)
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """
+        Run callback if the token fires while the block runs (or already has).
+        """
+        with self._lock:
+            fired = self._event.is_set()
+            if not fired:
+                self._callbacks.append(callback)
+        if fired:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+def run_subprocess(cmd, timeout, cancel=None):
+    """
+    subprocess.run(cmd, capture_output=True, text=True, timeout=timeout) that
+    kills the process as soon as `cancel` fires and raises Cancelled.
+    """
+    if cancel is None:
+        return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+
+    cancel.raise_if_cancelled()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        with cancel.on_cancel(process.kill):
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                raise
+    cancel.raise_if_cancelled()
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+def client_disconnected(environ):
+    """
+    Whether the client behind a WSGI request has closed its connection. Only
+    works on servers that expose the socket (gunicorn, werkzeug); otherwise
+    always False.
+    """
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A closed connection reads as EOF; anything else (a pipelined request) is left unread
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+@contextmanager
+def cancel_on_disconnect(environ, cancel, interval=DISCONNECT_POLL_INTERVAL):
+    """
+    Cancel `cancel` if the client hangs up while the block runs.
+    """
+    done = threading.Event()
+
+    def watch():
+        while not done.wait(interval):
+            if client_disconnected(environ):
+                cancel.cancel('Client disconnected')
+                return
+
+    threading.Thread(target=watch, daemon=True, name='disconnect-watch').start()
+    try:
+        yield
+    finally:
+        done.set()
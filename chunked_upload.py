@@ -0,0 +1,149 @@
+"""
+Resumable uploads sent as raw binary chunks.
+
+Clients (the Chrome extension in particular) PUT a file a piece at a time,
+with no base64 or multipart encoding, and can pick up where they left off
+after a dropped connection. Partial files and their details live on disk, so
+any worker process can take the next chunk.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+from pipeline import place_upload
+
+CHUNK_SIZE = 8 * 1024 * 1024  # Suggested to clients; any size up to MAX_CONTENT_LENGTH works
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+UPLOAD_TTL = 24 * 60 * 60  # Seconds an unfinished upload is kept after its last chunk
+COPY_CHUNK_SIZE = 1024 * 1024
+
+UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+
+
+class UploadNotFound(Exception):
+    pass
+
+
+class OffsetMismatch(Exception):
+    """
+    The chunk doesn't continue the upload; `received` is where it should start.
+    """
+
+    def __init__(self, received):
+        super().__init__(f'Upload has {received} bytes; send the chunk at that offset')
+        self.received = received
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class ChunkedUploads:
+    def __init__(self, directory, max_bytes=MAX_UPLOAD_BYTES, ttl=UPLOAD_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, upload_id):
+        if not UPLOAD_ID.fullmatch(upload_id or ''):
+            raise UploadNotFound(upload_id)
+        base = os.path.join(self.directory, upload_id)
+        return f'{base}.part', f'{base}.json'
+
+    def _info(self, upload_id):
+        data_path, info_path = self._paths(upload_id)
+        try:
+            with open(info_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadNotFound(upload_id)
+
+    def create(self, filename, size=None):
+        """
+        Start an upload. `size`, when known, is checked on completion.
+        """
+        if size is not None and size > self.max_bytes:
+            raise UploadTooLarge(f'Uploads are limited to {self.max_bytes} bytes')
+        self._sweep()
+        upload_id = uuid.uuid4().hex
+        data_path, info_path = self._paths(upload_id)
+        open(data_path, 'wb').close()
+        with open(info_path, 'w', encoding='utf-8') as f:
+            json.dump({'filename': filename, 'size': size, 'created_at': time.time()}, f)
+        return upload_id
+
+    def status(self, upload_id):
+        info = self._info(upload_id)
+        data_path, _ = self._paths(upload_id)
+        return dict(info, upload_id=upload_id, received=os.path.getsize(data_path))
+
+    def append(self, upload_id, offset, stream):
+        """
+        Write a chunk that starts at `offset`. A retried chunk that overlaps
+        what was already received only has its new bytes appended. Returns the
+        number of bytes received so far.
+        """
+        info = self._info(upload_id)
+        limit = min(self.max_bytes, info['size']) if info['size'] is not None else self.max_bytes
+        data_path, _ = self._paths(upload_id)
+
+        with open(data_path, 'r+b') as f:
+            # One writer at a time per upload, across worker processes
+            fcntl.flock(f, fcntl.LOCK_EX)
+            received = f.seek(0, os.SEEK_END)
+            if offset > received:
+                raise OffsetMismatch(received)
+
+            skip = received - offset
+            written = 0
+            try:
+                for chunk in iter(lambda: stream.read(COPY_CHUNK_SIZE), b''):
+                    if skip:
+                        dropped = min(skip, len(chunk))
+                        chunk = chunk[dropped:]
+                        skip -= dropped
+                    if received + written + len(chunk) > limit:
+                        raise UploadTooLarge(f'Upload is larger than {limit} bytes')
+                    f.write(chunk)
+                    written += len(chunk)
+            except Exception:
+                # Don't keep half a chunk; the client resends it from `received`
+                f.truncate(received)
+                raise
+        return received + written
+
+    def complete(self, upload_id, folder):
+        """
+        Finish an upload: move it to its content-addressed name in folder.
+        Returns (path, content_hash, filename).
+        """
+        info = self._info(upload_id)
+        data_path, info_path = self._paths(upload_id)
+        received = os.path.getsize(data_path)
+        if info['size'] is not None and received != info['size']:
+            raise OffsetMismatch(received)
+
+        digest = hashlib.sha256()
+        with open(data_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        ext = os.path.splitext(info['filename'])[1].lower()
+        path = place_upload(data_path, folder, content_hash, ext)
+        os.remove(info_path)
+        return path, content_hash, info['filename']
+
+    def _sweep(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,192 @@
+"""
+Offline batch runner: transcribe, split and export many files without the web app.
+
+    python cli.py ~/archive/*.mp3 --output-dir segments/
+    python cli.py ~/archive --recursive --transcribers 8 --workers 4 --format opus
+
+Each input gets its own folder in the output directory, named after the file
+and its content hash. A folder only appears once the file is fully exported,
+and transcripts are cached on disk, so rerunning a killed run skips finished
+files and doesn't transcribe anything twice.
+"""
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+import workers
+from pipeline import OUTPUT_FORMATS, export_segments, friendly_error_message, normalize_output_options
+from transcript_cache import TranscriptCache
+
+AUDIO_EXTENSIONS = {'.mp3', '.wav', '.ogg', '.m4a', '.flac', '.aac', '.wma'}
+
+DEFAULT_TRANSCRIBERS = 4  # Concurrent Replicate predictions
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def find_inputs(patterns, recursive=False):
+    """
+    Expand files, directories and glob patterns into a sorted list of audio files.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            walk = os.walk(pattern) if recursive else [(pattern, [], os.listdir(pattern))]
+            for root, dirs, files in walk:
+                paths.update(os.path.join(root, name) for name in files)
+        else:
+            paths.update(glob.glob(pattern, recursive=recursive) or [pattern])
+    return sorted(
+        os.path.abspath(path) for path in paths
+        if os.path.isfile(path) and os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS
+    )
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Runner:
+    def __init__(self, output_dir, api_key, max_duration, output_format, bitrate, transcribers, cache):
+        self.output_dir = output_dir
+        self.api_key = api_key
+        self.max_duration = max_duration
+        self.output_format = output_format
+        self.bitrate = bitrate
+        self.cache = cache
+        self.transcribe_pool = ThreadPoolExecutor(max_workers=transcribers, thread_name_prefix='transcribe')
+        self.results = {'completed': 0, 'skipped': 0, 'failed': 0}
+        self._total = 0
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def _record(self, outcome, path, message=''):
+        with self._lock:
+            print(f"[{outcome}] {path}{': ' + message if message else ''}")
+            self.results[outcome] += 1
+            if sum(self.results.values()) == self._total:
+                self._finished.set()
+
+    def output_path(self, path, content_hash):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.output_dir, f'{stem}-{content_hash[:8]}')
+
+    def submit(self, path):
+        self.transcribe_pool.submit(self._transcribe, path)
+
+    def _transcribe(self, path):
+        # Every path must end in _record, or run() waits for it forever
+        partial_dir = None
+        try:
+            content_hash = hash_file(path)
+            final_dir = self.output_path(path, content_hash)
+            if os.path.exists(os.path.join(final_dir, 'metadata.json')):
+                self._record('skipped', path, 'already exported')
+                return
+
+            transcript = self.cache.transcribe(path, content_hash, self.api_key)
+            if not transcript:
+                raise Exception('No transcript segments received from Whisper')
+
+            # Encoding runs in the process pool; this thread moves on to the next transcription
+            partial_dir = f'{final_dir}.partial'
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            future = workers.get_process_pool().submit(
+                export_segments, path, transcript, self.max_duration, partial_dir, os.path.basename(path),
+                self.output_format, self.bitrate
+            )
+        except Exception as e:
+            if partial_dir:
+                shutil.rmtree(partial_dir, ignore_errors=True)
+            self._record('failed', path, friendly_error_message(str(e)))
+            return
+
+        future.add_done_callback(lambda f: self._exported(f, path, partial_dir, final_dir))
+
+    def _exported(self, future, path, partial_dir, final_dir):
+        try:
+            metadata = future.result()
+            # Publish the folder in one step, so a killed run never leaves a half-written one behind
+            shutil.rmtree(final_dir, ignore_errors=True)
+            os.replace(partial_dir, final_dir)
+            self._record('completed', path, f"{metadata['total_segments']} segments")
+        except Exception as e:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            self._record('failed', path, friendly_error_message(str(e)))
+
+    def run(self, paths):
+        """
+        Process every path and return the outcome counts once each file has
+        been exported, skipped or has failed.
+        """
+        self._total = len(paths)
+        if not paths:
+            self._finished.set()
+        for path in paths:
+            self.submit(path)
+        self.transcribe_pool.shutdown(wait=True)
+        self._finished.wait()
+        return self.results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='Audio files, directories or glob patterns')
+    parser.add_argument('-o', '--output-dir', default='segments', help='Where per-file folders are written')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Descend into directories / match ** in globs')
+    parser.add_argument('--api-key', default=os.environ.get('REPLICATE_API_TOKEN'),
+                        help='Replicate API token (default: $REPLICATE_API_TOKEN)')
+    parser.add_argument('--max-duration', type=float, default=60.0, help='Max segment length in seconds (10-300)')
+    parser.add_argument('--format', dest='output_format', default=None, choices=sorted(OUTPUT_FORMATS))
+    parser.add_argument('--bitrate', default=None, help='e.g. 128k; ignored for lossless formats')
+    parser.add_argument('--transcribers', type=int, default=DEFAULT_TRANSCRIBERS, help='Concurrent transcriptions')
+    parser.add_argument('--workers', type=int, default=None, help='Processes for splitting/encoding (default: CPU count)')
+    parser.add_argument('--cache-dir', default=None, help='Transcript cache (default: <output-dir>/.transcripts)')
+    parser.add_argument('--log-level', default='WARNING', help='Level of the JSON pipeline log (default: WARNING)')
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error('a Replicate API key is required (--api-key or REPLICATE_API_TOKEN)')
+    if args.max_duration < 10 or args.max_duration > 300:
+        parser.error('--max-duration must be between 10 and 300 seconds')
+    try:
+        output_format, bitrate = normalize_output_options(args.output_format, args.bitrate)
+    except ValueError as e:
+        parser.error(str(e))
+
+    paths = find_inputs(args.inputs, recursive=args.recursive)
+    if not paths:
+        parser.error('no audio files found')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    cache = TranscriptCache(args.cache_dir or os.path.join(args.output_dir, '.transcripts'))
+    workers.configure(args.workers)
+    log.configure(args.log_level)
+
+    print(f"Processing {len(paths)} files into {args.output_dir}")
+    runner = Runner(
+        args.output_dir, args.api_key, args.max_duration, output_format, bitrate, args.transcribers, cache
+    )
+    start = time.monotonic()
+    try:
+        results = runner.run(paths)
+    finally:
+        workers.shutdown()
+
+    print(f"Done in {time.monotonic() - start:.1f}s: {results['completed']} completed, "
+          f"{results['skipped']} skipped, {results['failed']} failed")
+    return 1 if results['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
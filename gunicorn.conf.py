@@ -0,0 +1,16 @@
+# Gunicorn settings for `gunicorn -c gunicorn.conf.py wsgi:app`
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5003')
+
+# Request threads mostly wait on Replicate; decoding and encoding run in each
+# worker's process pool, so a few workers with many threads go a long way.
+workers = int(os.environ.get('GUNICORN_WORKERS', max(2, multiprocessing.cpu_count() // 2)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Transcription polls Replicate for up to 10 minutes
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 900))
+graceful_timeout = 60
+keepalive = 5
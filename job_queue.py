@@ -0,0 +1,115 @@
+"""
+The job queue: accepted jobs wait in it until a worker on any node claims
+one, so the node that took an upload needn't be the one that transcribes it.
+
+The default queue is the job store itself. A submitted job is saved with no
+worker; workers poll for unclaimed jobs and take one with a compare-and-swap,
+then keep a heartbeat on it while it runs (see jobs). If the heartbeat stops
+for `lease` seconds, because the worker died or lost its connection, the job
+is handed to the next worker that asks, and resumes from its last saved stage.
+Another queue can be plugged in with the JOB_QUEUE setting as 'module:Class'.
+It is constructed with the job store and the lease, and must provide
+submit, claim, wait and depth; submit(job, waiter) records the submitting
+request as a waiter in the store, which is what cancels count.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+from cancellation import Cancelled
+
+JOB_LEASE = 30.0  # Seconds without a heartbeat before a running job is given to another worker
+POLL_INTERVAL = 1.0  # How often idle workers look for jobs submitted on other nodes
+
+
+class SqliteJobQueue:
+    def __init__(self, store, lease=JOB_LEASE):
+        self.store = store
+        self.lease = lease
+        self._submitted = threading.Event()
+
+    def submit(self, job, waiter):
+        """
+        Queue a job, or join an identical one already queued or running, and
+        wait on it as `waiter`. Returns (job, created) as JobStore.add_or_join
+        does.
+        """
+        job.worker = None
+        job, created = self.store.add_or_join(job, waiter)
+        if created:
+            self._submitted.set()
+        return job, created
+
+    def claim(self):
+        """
+        Take the oldest job no live worker is running, or return None.
+        """
+        for job in self.store.unclaimed(time.time() - self.lease):
+            if self.store.claim(job):
+                return job
+        return None
+
+    def wait(self, timeout):
+        """
+        Sleep until a job is submitted on this node, or for `timeout` seconds.
+        """
+        self._submitted.wait(timeout)
+        self._submitted.clear()
+
+    def depth(self):
+        return self.store.depth()
+
+
+class JobWorkers:
+    """
+    Runs up to `count` queued jobs at a time in this process, each with
+    run(job) inside the app context. The queue comes from open_queue(),
+    called in the app context on the dispatcher thread.
+    """
+
+    def __init__(self, app, open_queue, count, run, poll_interval=POLL_INTERVAL):
+        self.app = app
+        self.open_queue = open_queue
+        self.queue = None
+        self.run = run
+        self.poll_interval = poll_interval
+        self._slots = threading.BoundedSemaphore(count)
+        self._pool = ThreadPoolExecutor(max_workers=count, thread_name_prefix='job-worker')
+
+    def start(self):
+        threading.Thread(target=self._dispatch, daemon=True, name='job-dispatcher').start()
+
+    def _dispatch(self):
+        while self.queue is None:
+            try:
+                with self.app.app_context():
+                    self.queue = self.open_queue()
+            except Exception as e:
+                log.error('job', 'Failed to open the job queue', error=str(e))
+                time.sleep(self.poll_interval)
+        while True:
+            self._slots.acquire()
+            job = None
+            try:
+                job = self.queue.claim()
+            except Exception as e:
+                log.error('job', 'Failed to claim a job', error=str(e))
+            if job is None:
+                self._slots.release()
+                self.queue.wait(self.poll_interval)
+                continue
+            log.info('job', 'Job claimed', job_id=job.id, status=job.status)
+            self._pool.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            with self.app.app_context():
+                self.run(job)
+            log.info('job', 'Job finished', job_id=job.id)
+        except Cancelled as e:
+            log.info('job', 'Job stopped', job_id=job.id, reason=str(e))
+        except Exception as e:
+            log.error('job', 'Job failed', job_id=job.id, error=str(e))
+        finally:
+            self._slots.release()
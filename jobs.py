@@ -0,0 +1,919 @@
+"""
+Jobs: an uploaded file, its transcription and its split plan.
+
+Job state lives in SQLite (WAL mode), and each stage is saved as soon as it
+completes. After a crash or restart, unfinished jobs re-attach to their
+Replicate prediction instead of paying for a new one. Long files are
+transcribed in chunks and segments are planned as each chunk comes in, so the
+first segments are available while the rest is still transcribing. Segment
+audio is only encoded when something asks for it (see segment_cache).
+Cancelling a job marks it in the store, which stops the worker running it.
+Jobs are queued in the store and claimed by whichever worker is free (see
+job_queue); a running job's worker keeps a heartbeat on it, and a job whose
+heartbeat stops is picked up by another worker.
+Identical requests (same audio, same parameters) made while a job is
+unfinished join that job instead of starting their own.
+Batches (see batch and kling) are saved in the same store, with one row per
+item, so any worker can report or cancel a batch whichever one runs it.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import log
+from artifacts import FilesystemArtifactStore
+from cancellation import Cancelled, CancelToken
+from pipeline import DEFAULT_SPLIT_MODE, IncrementalPlanner, friendly_error_message, transcribe_chunked
+
+JOB_TTL = 6 * 60 * 60  # Seconds a finished job is kept after its last update
+
+STATUS_QUEUED = 'queued'  # Uploaded, no prediction yet
+STATUS_TRANSCRIBING = 'transcribing'  # Prediction created; segments planned so far are saved
+STATUS_READY = 'ready'  # Split plan saved; segments render on demand
+STATUS_FAILED = 'failed'
+STATUS_CANCELED = 'canceled'  # Stopped on request or because its client went away
+JOB_STATUSES = (STATUS_QUEUED, STATUS_TRANSCRIBING, STATUS_READY, STATUS_FAILED, STATUS_CANCELED)
+UNFINISHED_STATUSES = (STATUS_QUEUED, STATUS_TRANSCRIBING)
+
+CANCEL_POLL_INTERVAL = 2.0  # How often a running job or batch checks the store for a cancel from another worker
+JOIN_POLL_INTERVAL = 1.0  # How often a request that joined another's job checks whether it has finished
+
+BATCH_PROCESSING = 'processing'
+BATCH_FAILED = 'failed'
+BATCH_LEASE = 30.0  # Seconds without a heartbeat before a processing batch is taken for abandoned
+FINISHED_ITEM_STATUSES = ('completed', 'failed', 'canceled', 'duplicate')
+
+HOSTNAME = socket.gethostname()
+# Identifies this process in the jobs it runs; the pid alone can repeat after a restart
+WORKER_ID = f'{HOSTNAME}:{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    audio_path TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    original_file TEXT NOT NULL,
+    max_duration REAL NOT NULL,
+    output_format TEXT NOT NULL,
+    bitrate TEXT,
+    audio_duration REAL NOT NULL,
+    api_key TEXT,
+    prediction_id TEXT,
+    worker TEXT,
+    segments TEXT,
+    full_transcript TEXT,
+    zip_path TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    split_mode TEXT,
+    profiles TEXT,
+    pipeline_key TEXT,
+    subscribers INTEGER NOT NULL DEFAULT 1,
+    waiters INTEGER NOT NULL DEFAULT 1,
+    prerender INTEGER NOT NULL DEFAULT 0,
+    heartbeat_at REAL,
+    chunks TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_audio_path ON jobs (audio_path);
+CREATE TABLE IF NOT EXISTS job_waiters (
+    job_id TEXT NOT NULL,
+    waiter TEXT NOT NULL,
+    PRIMARY KEY (job_id, waiter)
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    output_mode TEXT,
+    output_format TEXT,
+    bitrate TEXT,
+    zip_path TEXT,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    heartbeat_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS batches_status ON batches (status, updated_at);
+CREATE TABLE IF NOT EXISTS batch_items (
+    batch_id TEXT NOT NULL,
+    item_index INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duplicate_of INTEGER,
+    total_segments INTEGER,
+    zip_path TEXT,
+    task_id TEXT,
+    video_url TEXT,
+    error TEXT,
+    PRIMARY KEY (batch_id, item_index)
+);
+'''
+
+COLUMNS = (
+    'id', 'status', 'audio_path', 'content_hash', 'original_file', 'max_duration', 'output_format', 'bitrate',
+    'audio_duration', 'api_key', 'prediction_id', 'worker', 'segments', 'full_transcript', 'zip_path', 'error',
+    'created_at', 'updated_at', 'split_mode', 'profiles', 'pipeline_key', 'subscribers', 'waiters', 'prerender',
+    'heartbeat_at', 'chunks'
+)
+# Columns added after the first release, with their types, for upgrading existing databases
+ADDED_COLUMNS = {
+    'split_mode': 'TEXT', 'profiles': 'TEXT', 'pipeline_key': 'TEXT',
+    'subscribers': 'INTEGER NOT NULL DEFAULT 1', 'waiters': 'INTEGER NOT NULL DEFAULT 1',
+    'prerender': 'INTEGER NOT NULL DEFAULT 0', 'heartbeat_at': 'REAL', 'chunks': 'TEXT'
+}
+JSON_COLUMNS = ('segments', 'profiles', 'chunks')
+
+
+def profile_name(max_duration, split_mode=DEFAULT_SPLIT_MODE):
+    """
+    Folder name for a split profile, e.g. '60s' or '30s-sentence'.
+    """
+    name = f'{max_duration:g}s'
+    return name if split_mode == DEFAULT_SPLIT_MODE else f'{name}-{split_mode}'
+
+
+class Job:
+    """
+    One upload and its split plans. The first (max_duration, split_mode)
+    profile is the job's own; `profiles` holds any others, planned from the
+    same transcript, as {'name', 'max_duration', 'split_mode', 'segments'}.
+    audio_path and zip_path are artifact names (see artifacts).
+    """
+
+    def __init__(self, audio_path, content_hash, original_file, max_duration, output_format, bitrate,
+                 audio_duration, api_key, split_mode=DEFAULT_SPLIT_MODE, extra_profiles=(), prerender=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.status = STATUS_QUEUED
+        self.audio_path = audio_path
+        self.content_hash = content_hash
+        self.original_file = original_file
+        self.max_duration = max_duration
+        self.output_format = output_format
+        self.bitrate = bitrate
+        self.audio_duration = audio_duration
+        # Only kept until the transcript is in, so the job can be resumed
+        self.api_key = api_key
+        self.prediction_id = None
+        # A long file's per-chunk predictions and transcripts, until the whole transcript is in
+        self.chunks = None
+        self.worker = WORKER_ID
+        self.segments = None
+        self.full_transcript = None
+        self.zip_path = None
+        self.error = None
+        self.created_at = self.updated_at = time.time()
+        self.split_mode = split_mode
+        self.profiles = [
+            {'name': profile_name(duration, mode), 'max_duration': duration, 'split_mode': mode, 'segments': None}
+            for duration, mode in extra_profiles
+        ] or None
+        # Requests that were given this job: its files go with the last one's cleanup
+        self.subscribers = 1
+        # Requests still waiting for it: it is only abandoned once all have gone
+        self.waiters = 1
+        self.pipeline_key = self.compute_pipeline_key()
+        # Encode segments as soon as they are planned, on whichever worker runs the job
+        self.prerender = prerender
+        self.heartbeat_at = None
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls.__new__(cls)
+        for column in COLUMNS:
+            setattr(job, column, row[column])
+        for column in JSON_COLUMNS:
+            if getattr(job, column) is not None:
+                setattr(job, column, json.loads(getattr(job, column)))
+        job.split_mode = job.split_mode or DEFAULT_SPLIT_MODE
+        job.pipeline_key = job.pipeline_key or job.compute_pipeline_key()
+        job.prerender = bool(job.prerender)
+        return job
+
+    def compute_pipeline_key(self):
+        """
+        What the job's output depends on: the audio and every parameter
+        that changes the transcript, the cuts or the encoding. The API key
+        (hashed) is part of it too, so a job is only joined by requests that
+        would be billed to the same Replicate account.
+        """
+        profiles = [[profile['max_duration'], profile['split_mode']] for profile in self.all_profiles()]
+        key_hash = hashlib.sha256((self.api_key or '').encode('utf-8')).hexdigest()
+        key = json.dumps([self.content_hash, self.output_format, self.bitrate, profiles, key_hash])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def column_value(self, column):
+        value = getattr(self, column)
+        if column in JSON_COLUMNS and value is not None:
+            return json.dumps(value)
+        return value
+
+    @property
+    def profile(self):
+        return profile_name(self.max_duration, self.split_mode)
+
+    def all_profiles(self):
+        """
+        Every split profile, the job's own first.
+        """
+        own = {'name': self.profile, 'max_duration': self.max_duration, 'split_mode': self.split_mode,
+               'segments': self.segments}
+        return [own] + (self.profiles or [])
+
+    def profile_segments(self, name=None):
+        """
+        Segments planned so far for a profile (default: the job's own), or None for an unknown profile.
+        """
+        if name is None:
+            return self.segments or []
+        for profile in self.all_profiles():
+            if profile['name'] == name:
+                return profile['segments'] or []
+        return None
+
+    @property
+    def download_url(self):
+        return f'/api/jobs/{self.id}/download'
+
+    def segment_urls(self, number, profile=None):
+        base = f'/api/jobs/{self.id}/segments/{number}'
+        query = f'?profile={profile}' if profile else ''
+        return {'audio_url': base + query, 'transcript_url': f'{base}/transcript{query}'}
+
+    def metadata(self, urls=True, profile=None):
+        """
+        metadata.json for one profile. By default, the job's own profile with
+        any others listed under 'profiles'.
+        """
+        listed = profile is None
+        if listed:
+            profile = self.all_profiles()[0]
+        segments = profile['segments'] or []
+        if urls:
+            name = None if profile['name'] == self.profile else profile['name']
+            segments = [dict(seg, **self.segment_urls(i + 1, name)) for i, seg in enumerate(segments)]
+        metadata = {
+            'original_file': self.original_file,
+            'total_segments': len(segments),
+            'max_duration': profile['max_duration'],
+            'split_mode': profile['split_mode'],
+            'output_format': self.output_format,
+            'bitrate': self.bitrate,
+            'segments': segments,
+            'full_transcript': self.full_transcript
+        }
+        if listed and self.profiles:
+            metadata['profiles'] = []
+            for other in self.profiles:
+                entry = dict(self.metadata(urls, other), name=other['name'])
+                del entry['full_transcript']
+                metadata['profiles'].append(entry)
+        return metadata
+
+    def summary(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'original_file': self.original_file,
+            'audio_duration': self.audio_duration,
+            'max_duration': self.max_duration,
+            'split_mode': self.split_mode,
+            'profiles': [profile['name'] for profile in self.all_profiles()],
+            'output_format': self.output_format,
+            'bitrate': self.bitrate,
+            'total_segments': len(self.segments) if self.segments is not None else None,
+            'download_url': self.download_url if self.status == STATUS_READY else None,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+
+def worker_alive(worker):
+    """
+    Whether a worker process is still running, as far as this host can
+    tell. Workers on other hosts count as alive; their heartbeat decides.
+    """
+    if worker == WORKER_ID:
+        return True
+    host, _, process = (worker or '').rpartition(':')
+    if host and host != HOSTNAME:
+        return True
+    try:
+        pid = int(process.split('-')[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        # Our pid, but an earlier run of it (e.g. pid 1 in a restarted container)
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobLock:
+    """
+    Exclusive lock on one job across threads and processes: a thread lock,
+    then an flock on the job's lock file, which every process sharing the
+    store can see.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            if self._file:
+                self._file.close()
+                self._file = None
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self._file.close()  # Releases the flock
+            self._file = None
+        finally:
+            self._thread_lock.release()
+
+
+class JobStore:
+    """
+    SQLite job registry. Finished jobs not updated for JOB_TTL seconds are
+    removed along with their files, which live in `artifacts` (by default,
+    the database's directory).
+    """
+
+    def __init__(self, path, ttl=JOB_TTL, artifacts=None):
+        self.path = path
+        self.ttl = ttl
+        self.artifacts = artifacts or FilesystemArtifactStore(os.path.dirname(os.path.abspath(path)))
+        self.lock_directory = os.path.join(os.path.dirname(os.path.abspath(path)), 'locks')
+        os.makedirs(self.lock_directory, exist_ok=True)
+        self._local = threading.local()
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        db = self._db()
+        db.executescript(SCHEMA)
+        existing = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in existing:
+                db.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+
+    def _db(self):
+        # One connection per thread; WAL lets readers proceed while a job is being saved
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def lock(self, job_id):
+        """
+        Held while a job's files are read or written, so cleanup never races a
+        download, whichever processes they run in.
+        """
+        with self._locks_lock:
+            lock = self._locks.get(job_id)
+            if lock is None:
+                lock = self._locks[job_id] = JobLock(os.path.join(self.lock_directory, f'{job_id}.lock'))
+            return lock
+
+    @contextmanager
+    def _transaction(self):
+        # Taken for writing up front, so a read-then-write can't interleave with another worker's
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _insert(self, db, job):
+        placeholders = ', '.join('?' for _ in COLUMNS)
+        db.execute(
+            f'INSERT INTO jobs ({", ".join(COLUMNS)}) VALUES ({placeholders})',
+            [job.column_value(column) for column in COLUMNS]
+        )
+
+    def add(self, job):
+        self._sweep()
+        self._insert(self._db(), job)
+        return job
+
+    def add_or_join(self, job, waiter):
+        """
+        Add a job, unless an unfinished job with the same pipeline key exists
+        (in any worker). In that case, join it instead. Returns
+        (job, created): the new job, or the existing one with this request
+        counted as a subscriber. Either way the request waits on the job as
+        `waiter`, a token only it knows, until it leaves.
+        """
+        self._sweep()
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATUSES)
+        with self._transaction() as db:
+            row = db.execute(
+                f'SELECT id FROM jobs WHERE pipeline_key = ? AND status IN ({placeholders}) '
+                f'ORDER BY created_at LIMIT 1',
+                (job.pipeline_key, *UNFINISHED_STATUSES)
+            ).fetchone()
+            if row is None:
+                self._insert(db, job)
+                db.execute('INSERT INTO job_waiters (job_id, waiter) VALUES (?, ?)', (job.id, waiter))
+                return job, True
+            db.execute('INSERT OR IGNORE INTO job_waiters (job_id, waiter) VALUES (?, ?)', (row['id'], waiter))
+            db.execute(
+                'UPDATE jobs SET subscribers = subscribers + 1, '
+                'waiters = (SELECT COUNT(*) FROM job_waiters WHERE job_id = jobs.id) WHERE id = ?', (row['id'],)
+            )
+            joined = Job.from_row(db.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+        log.info('job', 'Joined identical job', job_id=joined.id, waiters=joined.waiters)
+        return joined, False
+
+    def leave(self, job_id, waiter):
+        """
+        The request waiting on a job as `waiter` has gone. Returns how many
+        are still waiting, or None if that waiter had already left: leaving
+        twice (a cancel, then a disconnect) only counts once.
+        """
+        with self._transaction() as db:
+            cursor = db.execute('DELETE FROM job_waiters WHERE job_id = ? AND waiter = ?', (job_id, waiter))
+            if not cursor.rowcount:
+                return None
+            db.execute(
+                'UPDATE jobs SET waiters = (SELECT COUNT(*) FROM job_waiters WHERE job_id = jobs.id) WHERE id = ?',
+                (job_id,)
+            )
+            row = db.execute('SELECT waiters FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row['waiters'] if row else 0
+
+    def release(self, job):
+        """
+        One subscriber is done with a job. The job and its files are removed
+        with the last one. Returns whether it was removed.
+        """
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET subscribers = subscribers - 1 WHERE id = ?', (job.id,))
+            row = db.execute('SELECT subscribers FROM jobs WHERE id = ?', (job.id,)).fetchone()
+        if row is not None and row['subscribers'] > 0:
+            return False
+        self.remove(job)
+        return True
+
+    def update(self, job, **fields):
+        fields['updated_at'] = time.time()
+        for column, value in fields.items():
+            setattr(job, column, value)
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        self._db().execute(
+            f'UPDATE jobs SET {assignments} WHERE id = ?',
+            [job.column_value(column) for column in fields] + [job.id]
+        )
+
+    def get(self, job_id):
+        row = self._db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return Job.from_row(row) if row else None
+
+    def list(self, status=None, limit=100, offset=0):
+        if status:
+            rows = self._db().execute(
+                'SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ? OFFSET ?',
+                (status, limit, offset)
+            )
+        else:
+            rows = self._db().execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ? OFFSET ?', (limit, offset))
+        return [Job.from_row(row) for row in rows]
+
+    def in_use(self, audio_path, exclude=None):
+        row = self._db().execute(
+            'SELECT 1 FROM jobs WHERE audio_path = ? AND id IS NOT ? LIMIT 1', (audio_path, exclude)
+        ).fetchone()
+        return row is not None
+
+    def remove(self, job):
+        """
+        Forget a job and delete its files. The source audio is content-addressed
+        and may be shared by other jobs, so it is only deleted with its last job.
+        """
+        with self.lock(job.id):
+            cursor = self._db().execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+            self._db().execute('DELETE FROM job_waiters WHERE job_id = ?', (job.id,))
+            if cursor.rowcount:
+                self.artifacts.delete(job.zip_path)
+                if not self.in_use(job.audio_path):
+                    self.artifacts.delete(job.audio_path)
+                # Anyone who locks the job after this finds it gone anyway
+                try:
+                    os.remove(os.path.join(self.lock_directory, f'{job.id}.lock'))
+                except FileNotFoundError:
+                    pass
+        with self._locks_lock:
+            self._locks.pop(job.id, None)
+
+    def issued(self, name):
+        """
+        Whether `name` is a ZIP saved for a job, batch or batch item: the only
+        artifacts handed out by name.
+        """
+        db = self._db()
+        for table in ('jobs', 'batches', 'batch_items'):
+            if db.execute(f'SELECT 1 FROM {table} WHERE zip_path = ? LIMIT 1', (name,)).fetchone():
+                return True
+        return False
+
+    def cancel(self, job_id):
+        """
+        Mark an unfinished job canceled; the worker running it stops (see
+        run_job). Returns False if the job isn't unfinished.
+        """
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATUSES)
+        cursor = self._db().execute(
+            f'UPDATE jobs SET status = ?, error = ?, api_key = NULL, updated_at = ? '
+            f'WHERE id = ? AND status IN ({placeholders})',
+            (STATUS_CANCELED, 'Canceled', time.time(), job_id, *UNFINISHED_STATUSES)
+        )
+        return bool(cursor.rowcount)
+
+    def depth(self):
+        """
+        Number of unfinished jobs, running or waiting for a worker.
+        """
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATUSES)
+        row = self._db().execute(f'SELECT COUNT(*) FROM jobs WHERE status IN ({placeholders})', UNFINISHED_STATUSES)
+        return row.fetchone()[0]
+
+    def add_batch(self, batch_id, kind, items, **fields):
+        """
+        Save a batch this worker has started, with its items as dicts of
+        batch_items columns.
+        """
+        self._sweep()
+        now = time.time()
+        row = dict(
+            fields, id=batch_id, kind=kind, status=BATCH_PROCESSING, worker=WORKER_ID, heartbeat_at=now,
+            created_at=now, updated_at=now
+        )
+        with self._transaction() as db:
+            db.execute(
+                f'INSERT INTO batches ({", ".join(row)}) VALUES ({", ".join("?" for _ in row)})', list(row.values())
+            )
+            for item in items:
+                item = dict(item, batch_id=batch_id)
+                db.execute(
+                    f'INSERT INTO batch_items ({", ".join(item)}) VALUES ({", ".join("?" for _ in item)})',
+                    list(item.values())
+                )
+
+    def update_batch(self, batch_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        self._db().execute(f'UPDATE batches SET {assignments} WHERE id = ?', [*fields.values(), batch_id])
+
+    def update_batch_item(self, batch_id, index, **fields):
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        self._db().execute(
+            f'UPDATE batch_items SET {assignments} WHERE batch_id = ? AND item_index = ?',
+            [*fields.values(), batch_id, index]
+        )
+
+    def get_batch(self, batch_id, kind):
+        """
+        A batch of this kind as a dict of its columns, with its items in
+        order under 'items', or None.
+        """
+        db = self._db()
+        row = db.execute('SELECT * FROM batches WHERE id = ? AND kind = ?', (batch_id, kind)).fetchone()
+        if row is None:
+            return None
+        if row['status'] == BATCH_PROCESSING and row['heartbeat_at'] < time.time() - BATCH_LEASE:
+            # Its worker is gone; the sweep marks it failed
+            self._sweep()
+            row = db.execute('SELECT * FROM batches WHERE id = ?', (batch_id,)).fetchone()
+            if row is None:
+                return None
+        items = db.execute('SELECT * FROM batch_items WHERE batch_id = ? ORDER BY item_index', (batch_id,))
+        return dict(row, items=[dict(item) for item in items])
+
+    def cancel_batch(self, batch_id):
+        """
+        Ask the worker running a batch to cancel it. Returns False if the
+        batch isn't processing.
+        """
+        cursor = self._db().execute(
+            'UPDATE batches SET cancel_requested = 1, updated_at = ? WHERE id = ? AND status = ?',
+            (time.time(), batch_id, BATCH_PROCESSING)
+        )
+        return bool(cursor.rowcount)
+
+    def batch_heartbeat(self, batch_id):
+        """
+        Renew this worker's hold on a batch. Returns whether it has been canceled.
+        """
+        db = self._db()
+        db.execute(
+            'UPDATE batches SET heartbeat_at = ? WHERE id = ? AND worker = ?', (time.time(), batch_id, WORKER_ID)
+        )
+        row = db.execute('SELECT cancel_requested FROM batches WHERE id = ?', (batch_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+    def remove_batch(self, batch_id):
+        """
+        Forget a batch and delete its ZIPs.
+        """
+        db = self._db()
+        names = [row['zip_path'] for row in db.execute('SELECT zip_path FROM batches WHERE id = ?', (batch_id,))]
+        names += [row['zip_path'] for row in db.execute('SELECT zip_path FROM batch_items WHERE batch_id = ?', (batch_id,))]
+        with self._transaction() as db:
+            db.execute('DELETE FROM batch_items WHERE batch_id = ?', (batch_id,))
+            db.execute('DELETE FROM batches WHERE id = ?', (batch_id,))
+        for name in names:
+            self.artifacts.delete(name)
+
+    def unclaimed(self, stale_before, limit=100):
+        """
+        Unfinished jobs that no live worker is running, oldest first: never
+        claimed, with no heartbeat since `stale_before`, or claimed by a
+        process on this host that has exited.
+        """
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATUSES)
+        rows = self._db().execute(
+            f'SELECT * FROM jobs WHERE status IN ({placeholders}) ORDER BY created_at LIMIT ?',
+            (*UNFINISHED_STATUSES, limit)
+        )
+        jobs = []
+        for job in [Job.from_row(row) for row in rows]:
+            if job.worker is None or not worker_alive(job.worker):
+                jobs.append(job)
+            elif job.heartbeat_at is not None and job.heartbeat_at < stale_before:
+                jobs.append(job)
+        return jobs
+
+    def claim(self, job, worker=WORKER_ID):
+        """
+        Take a job from unclaimed(). Claims are compare-and-swap on the worker
+        column, so each job is claimed by one process.
+        """
+        now = time.time()
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATUSES)
+        cursor = self._db().execute(
+            f'UPDATE jobs SET worker = ?, heartbeat_at = ? WHERE id = ? AND worker IS ? AND status IN ({placeholders})',
+            (worker, now, job.id, job.worker, *UNFINISHED_STATUSES)
+        )
+        if not cursor.rowcount:
+            return False
+        job.worker = worker
+        job.heartbeat_at = now
+        return True
+
+    def heartbeat(self, job):
+        """
+        Renew this worker's claim on a job. Returns False if another worker
+        has taken it over.
+        """
+        cursor = self._db().execute(
+            'UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ?', (time.time(), job.id, job.worker)
+        )
+        return bool(cursor.rowcount)
+
+    def _sweep(self):
+        placeholders = ', '.join('?' for _ in UNFINISHED_STATUSES)
+        rows = self._db().execute(
+            f'SELECT * FROM jobs WHERE updated_at < ? AND status NOT IN ({placeholders})',
+            (time.time() - self.ttl, *UNFINISHED_STATUSES)
+        )
+        for job in [Job.from_row(row) for row in rows]:
+            log.info('job', 'Job expired', job_id=job.id)
+            self.remove(job)
+
+        now = time.time()
+        db = self._db()
+        # A batch whose worker died stops heartbeating; report it failed instead of processing forever
+        stale = [row['id'] for row in db.execute(
+            'SELECT id FROM batches WHERE status = ? AND heartbeat_at < ?', (BATCH_PROCESSING, now - BATCH_LEASE)
+        )]
+        placeholders = ', '.join('?' for _ in FINISHED_ITEM_STATUSES)
+        for batch_id in stale:
+            log.warning('batch', 'Batch abandoned by its worker', batch_id=batch_id)
+            with self._transaction() as db:
+                db.execute(
+                    'UPDATE batches SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status = ?',
+                    (BATCH_FAILED, 'The worker running this batch stopped', now, batch_id, BATCH_PROCESSING)
+                )
+                db.execute(
+                    f'UPDATE batch_items SET status = ?, error = ? '
+                    f'WHERE batch_id = ? AND status NOT IN ({placeholders})',
+                    (BATCH_FAILED, 'The worker running this batch stopped', batch_id, *FINISHED_ITEM_STATUSES)
+                )
+        expired = [row['id'] for row in self._db().execute(
+            'SELECT id FROM batches WHERE updated_at < ? AND status != ?', (now - self.ttl, BATCH_PROCESSING)
+        )]
+        for batch_id in expired:
+            log.info('batch', 'Batch expired', batch_id=batch_id)
+            self.remove_batch(batch_id)
+
+
+_running = {}  # job id -> CancelToken, for jobs this process is running
+_running_lock = threading.Lock()
+
+
+def cancel_job(store, job_id):
+    """
+    Cancel an unfinished job. A job running in this process stops right away;
+    one running in another worker stops within CANCEL_POLL_INTERVAL.
+    Returns False if the job isn't unfinished.
+    """
+    canceled = store.cancel(job_id)
+    with _running_lock:
+        cancel = _running.get(job_id)
+    if cancel:
+        cancel.cancel(f'Job {job_id} canceled')
+    return canceled
+
+
+def watch_batch(store, batch_id, finished, on_cancel):
+    """
+    Keep a heartbeat on a batch this process runs until `finished` is set,
+    and call on_cancel() once it is canceled from any worker.
+    """
+    def watch():
+        canceled = False
+        # The heartbeat goes on while a canceled batch winds down
+        while not finished.wait(CANCEL_POLL_INTERVAL):
+            try:
+                if store.batch_heartbeat(batch_id) and not canceled:
+                    canceled = True
+                    on_cancel()
+            except Exception as e:
+                log.error('batch', 'Batch heartbeat failed', batch_id=batch_id, error=str(e))
+
+    threading.Thread(target=watch, daemon=True, name=f'batch-watch-{batch_id}').start()
+
+
+def leave_job(store, job_id, waiter):
+    """
+    The request waiting on a job as `waiter` has gone (e.g. its client
+    disconnected or canceled). The job is canceled once no request is
+    waiting for it any more. Returns how many still are, or None if this
+    waiter had already left.
+    """
+    waiters = store.leave(job_id, waiter)
+    if waiters == 0:
+        cancel_job(store, job_id)
+    return waiters
+
+
+def wait_for_job(store, job_id, cancel=None):
+    """
+    Wait for a job joined with add_or_join, which may be running in another
+    worker, to finish. Returns the finished job, or None if it was removed.
+    Raises Cancelled as soon as `cancel` fires.
+    """
+    cancel = cancel or CancelToken()
+    while True:
+        job = store.get(job_id)
+        if job is None or job.status not in UNFINISHED_STATUSES:
+            return job
+        cancel.wait(JOIN_POLL_INTERVAL)
+
+
+def _watch_store(store, job, cancel, finished, lost):
+    # A cancel from another worker only reaches this one through the store
+    while not finished.wait(CANCEL_POLL_INTERVAL):
+        if job.worker and not store.heartbeat(job):
+            # Our heartbeat lapsed and another worker claimed the job. The token
+            # isn't fired: that would cancel the prediction the new worker picks up.
+            log.warning('job', 'Job taken over by another worker')
+            lost.set()
+            return
+        current = store.get(job.id)
+        if current is None or current.status == STATUS_CANCELED:
+            cancel.cancel(f'Job {job.id} canceled')
+            return
+
+
+def run_job(store, job, on_segments=None, cancel=None):
+    """
+    Take a job from its last saved stage to ready, saving each stage as it
+    completes. Every profile is planned from the one transcript. Segments
+    are saved as soon as their boundaries are final, and
+    on_segments(job, segments) is called with each new batch (from any
+    profile). Failures are recorded on the job and re-raised. When `cancel`
+    fires, or the job is canceled in the store, the prediction is cancelled,
+    the job is marked canceled, its source file is removed and Cancelled is
+    raised. If the job is claimed by another worker meanwhile, this run stops
+    with Cancelled and leaves the job to it.
+    """
+    with log.context(job_id=job.id):
+        return _run_job(store, job, on_segments, cancel)
+
+
+def _run_job(store, job, on_segments, cancel):
+    planners = [
+        IncrementalPlanner(profile['max_duration'], job.output_format, profile['split_mode'])
+        for profile in job.all_profiles()
+    ]
+
+    def prediction_created(prediction_id):
+        store.update(job, status=STATUS_TRANSCRIBING, prediction_id=prediction_id)
+
+    def chunks_saved(chunks):
+        if lost.is_set():
+            raise Cancelled(f'Job {job.id} taken over by another worker')
+        store.update(job, chunks=chunks)
+
+    def save(**fields):
+        if lost.is_set():
+            raise Cancelled(f'Job {job.id} taken over by another worker')
+        profiles = None
+        if job.profiles:
+            profiles = [dict(profile, segments=list(planner.segments))
+                        for profile, planner in zip(job.profiles, planners[1:])]
+        store.update(job, segments=list(planners[0].segments), profiles=profiles, **fields)
+
+    def planned(new):
+        if not new:
+            return
+        save()
+        if on_segments:
+            on_segments(job, new)
+
+    def feed(words):
+        cancel.raise_if_cancelled()
+        planned([seg for planner in planners for seg in planner.feed(words)])
+
+    cancel = cancel or CancelToken()
+    finished = threading.Event()
+    lost = threading.Event()  # Set if another worker claims the job from under this one
+    with _running_lock:
+        _running[job.id] = cancel
+    threading.Thread(
+        target=_watch_store, args=(store, job, cancel, finished, lost), daemon=True, name=f'watch-{job.id}'
+    ).start()
+    try:
+        # Steps 1-4: Transcribe (or pick up the prediction a previous run started),
+        # planning segments as the transcript comes in. Audio is only encoded when
+        # a segment or the ZIP is requested.
+        transcript = transcribe_chunked(
+            store.artifacts.path(job.audio_path), job.api_key, job.audio_duration, on_words=feed,
+            prediction_id=job.prediction_id, on_prediction=prediction_created, cancel=cancel,
+            chunks=job.chunks, on_chunks=chunks_saved
+        )
+        cancel.raise_if_cancelled()
+        if not transcript:
+            raise Exception('No transcript segments received from Whisper')
+
+        new = [seg for planner in planners for seg in planner.finish(job.audio_duration)]
+        log.info('plan', 'Segments planned', segments=[len(planner.segments) for planner in planners])
+        save(status=STATUS_READY, full_transcript=transcript.text, api_key=None, chunks=None)
+        if on_segments:
+            on_segments(job, new)
+    except Exception as e:
+        # A cancel can also surface as some other error, e.g. from a killed ffmpeg
+        canceled = isinstance(e, Cancelled) or cancel.cancelled
+        if lost.is_set():
+            # The job is the other worker's now; leave its record and files alone
+            raise Cancelled(f'Job {job.id} taken over by another worker') from e
+        if canceled:
+            log.info('job', 'Job canceled', reason=cancel.reason)
+            store.update(job, status=STATUS_CANCELED, error='Canceled', api_key=None, chunks=None)
+        else:
+            store.update(job, status=STATUS_FAILED, error=friendly_error_message(str(e)), api_key=None, chunks=None)
+        # Free the upload now rather than when the job expires
+        if not store.in_use(job.audio_path, exclude=job.id):
+            store.artifacts.delete(job.audio_path)
+        if canceled and not isinstance(e, Cancelled):
+            raise Cancelled(cancel.reason) from e
+        raise
+    finally:
+        finished.set()
+        with _running_lock:
+            _running.pop(job.id, None)
+    return job
+
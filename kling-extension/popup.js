@@ -575,12 +575,18 @@ startSegmentationBtn.addEventListener('click', async () => {
     
     console.log('Audio file:', currentAudioFile.name, 'Size:', currentAudioFile.size, 'Duration:', currentAudioBuffer.duration);
     
+    // Prefer the local server: no size limit and no in-browser encoding
+    if (await isSegmenterServerAvailable()) {
+      await segmentOnServer(currentAudioFile, apiKey, maxDuration);
+      return;
+    }
+    
     // Validate file size - Replicate has a limit around 25MB for data URLs
     const fileSizeMB = currentAudioFile.size / (1024 * 1024);
     const maxSizeMB = 20; // Conservative limit to account for base64 encoding overhead
     
     if (fileSizeMB > maxSizeMB) {
-      throw new Error(`Audio file is too large (${fileSizeMB.toFixed(1)}MB). Maximum size for direct upload is ${maxSizeMB}MB. Please use the webapp at localhost:5001 for larger files, or compress your audio file.`);
+      throw new Error(`Audio file is too large (${fileSizeMB.toFixed(1)}MB). Maximum size for direct upload is ${maxSizeMB}MB. Please use the webapp at localhost:5003 for larger files, or compress your audio file.`);
     }
     
     // Step 1: Get audio data URL (use cached version if available)
@@ -603,7 +609,7 @@ startSegmentationBtn.addEventListener('click', async () => {
     // Check data URL size (base64 adds ~33% overhead)
     const dataUrlSizeMB = audioDataUrl.length / (1024 * 1024);
     if (dataUrlSizeMB > 25) {
-      throw new Error(`Audio data is too large for API (${dataUrlSizeMB.toFixed(1)}MB encoded). Please use the webapp at localhost:5001 for this file.`);
+      throw new Error(`Audio data is too large for API (${dataUrlSizeMB.toFixed(1)}MB encoded). Please use the webapp at localhost:5003 for this file.`);
     }
     
     // Mark segmentation as in-progress with all necessary data
@@ -643,7 +649,7 @@ startSegmentationBtn.addEventListener('click', async () => {
       // Provide helpful error messages
       let errorMessage = `Replicate API error: ${predictionResponse.status}`;
       if (predictionResponse.status === 413) {
-        errorMessage = `Audio file is too large for Replicate API (413 Payload Too Large). Please use the webapp at localhost:5001 instead, which can handle larger files.`;
+        errorMessage = `Audio file is too large for Replicate API (413 Payload Too Large). Please use the webapp at localhost:5003 instead, which can handle larger files.`;
       } else if (predictionResponse.status === 401) {
         errorMessage = 'Invalid API key. Please check your Replicate API key.';
       } else if (predictionResponse.status === 429) {
@@ -948,6 +954,113 @@ async function processTranscriptionResult(transcriptData, maxDuration) {
   startSegmentationBtn.disabled = false;
 }
 
+// Local segmenter server (python app.py), used when it is running
+const SEGMENTER_SERVER = 'http://localhost:5003';
+
+async function isSegmenterServerAvailable() {
+  try {
+    const response = await fetch(`${SEGMENTER_SERVER}/api/jobs?limit=1`, { signal: AbortSignal.timeout(1500) });
+    return response.ok;
+  } catch (error) {
+    return false;
+  }
+}
+
+async function serverJson(response) {
+  const result = await response.json();
+  if (!response.ok) {
+    throw new Error(result.error || `Server error: ${response.status}`);
+  }
+  return result;
+}
+
+// Send the file as raw binary chunks; a failed chunk resumes from what the server has
+async function uploadToServer(file) {
+  const upload = await serverJson(await fetch(`${SEGMENTER_SERVER}/api/uploads/chunked`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ filename: file.name, size: file.size })
+  }));
+  
+  let offset = 0;
+  let retries = 0;
+  while (offset < file.size) {
+    const chunk = file.slice(offset, offset + upload.chunk_size);
+    updateSegmentationProgress(5 + Math.round(25 * offset / file.size), 'Uploading to local server...',
+      `${(offset / (1024 * 1024)).toFixed(1)} of ${(file.size / (1024 * 1024)).toFixed(1)} MB`);
+    try {
+      const response = await fetch(`${SEGMENTER_SERVER}${upload.upload_url}?offset=${offset}`, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/octet-stream' },
+        body: chunk
+      });
+      const result = await response.json();
+      if (!response.ok && response.status !== 409) {
+        throw new Error(result.error || `Upload failed: ${response.status}`);
+      }
+      offset = result.received;
+      retries = 0;
+    } catch (error) {
+      if (++retries > 3) throw error;
+      console.warn('Chunk upload failed, resuming:', error);
+      const status = await serverJson(await fetch(`${SEGMENTER_SERVER}${upload.upload_url}`));
+      offset = status.received;
+    }
+  }
+  
+  return serverJson(await fetch(`${SEGMENTER_SERVER}${upload.upload_url}/complete`, { method: 'POST' }));
+}
+
+async function segmentOnServer(file, apiKey, maxDuration) {
+  console.log('Segmenting on local server:', SEGMENTER_SERVER);
+  const artifact = await uploadToServer(file);
+  
+  updateSegmentationProgress(30, 'Starting transcription...', 'Local server is transcribing with Whisper');
+  const form = new FormData();
+  form.append('artifact_id', artifact.artifact_id);
+  form.append('filename', file.name);
+  form.append('api_key', apiKey);
+  form.append('max_duration', maxDuration);
+  form.append('prerender', '1');
+  const job = await serverJson(await fetch(`${SEGMENTER_SERVER}/api/jobs`, { method: 'POST', body: form }));
+  
+  chrome.storage.local.set({ segmentationState: 'in-progress', segmentationStartTime: Date.now() });
+  
+  let status;
+  do {
+    await new Promise(resolve => setTimeout(resolve, 2000));
+    status = await serverJson(await fetch(`${SEGMENTER_SERVER}${job.status_url}`));
+    const planned = status.metadata.segments.length;
+    updateSegmentationProgress(Math.min(85, 30 + planned), 'Transcribing...', `${planned} segments planned so far`);
+  } while (status.status === 'queued' || status.status === 'transcribing');
+  
+  if (status.status !== 'ready') {
+    throw new Error(status.error || `Job ${status.status}`);
+  }
+  
+  updateSegmentationProgress(90, 'Downloading segments...', 'Streaming ZIP from local server');
+  const zipResponse = await fetch(`${SEGMENTER_SERVER}${job.download_url}?stream=1`);
+  if (!zipResponse.ok) {
+    throw new Error(`Download failed: ${zipResponse.status}`);
+  }
+  generatedSegmentsZip = await zipResponse.blob();
+  fetch(`${SEGMENTER_SERVER}${job.cleanup_url}`, { method: 'POST' }).catch(() => {});
+  
+  const segmentCount = status.metadata.segments.length;
+  chrome.storage.local.set({
+    segmentationState: 'complete',
+    generatedZip: await blobToDataUrl(generatedSegmentsZip),
+    segmentCount: segmentCount,
+    segmentationStartTime: Date.now()
+  });
+  
+  updateSegmentationProgress(100, 'Complete!', `Generated ${segmentCount} segments`);
+  segmentationStatus.style.display = 'none';
+  segmentationResult.style.display = 'block';
+  document.getElementById('totalSegments').textContent = segmentCount;
+  startSegmentationBtn.disabled = false;
+}
+
 // Helper functions for segmenter
 function updateSegmentationProgress(percent, status, detail) {
   document.getElementById('segmentationProgressFill').style.width = percent + '%';
@@ -1802,7 +1915,7 @@ startDownloadBtn.addEventListener('click', async () => {
         }
         
         // Send to Flask backend
-        const response = await fetch(`http://localhost:5001/${endpoint}`, {
+        const response = await fetch(`${SEGMENTER_SERVER}/${endpoint}`, {
           method: 'POST',
           body: formData
         });
@@ -1831,7 +1944,7 @@ startDownloadBtn.addEventListener('click', async () => {
         
       } catch (error) {
         console.error('Error combining videos:', error);
-        showWarning('Failed to combine videos. Make sure the local server is running at http://localhost:5001 (python app.py)');
+        showWarning(`Failed to combine videos. Make sure the local server is running at ${SEGMENTER_SERVER} (python app.py)`);
       }
       
     } else if (downloadAsZip) {
@@ -1892,7 +2005,7 @@ startDownloadBtn.addEventListener('click', async () => {
           formData.append('durations', JSON.stringify(durationsMap));
           
           // Send to Flask backend for trimming
-          const response = await fetch('http://localhost:5001/trim-videos-zip', {
+          const response = await fetch(`${SEGMENTER_SERVER}/trim-videos-zip`, {
             method: 'POST',
             body: formData
           });
@@ -1921,7 +2034,7 @@ startDownloadBtn.addEventListener('click', async () => {
           
         } catch (error) {
           console.error('Error trimming videos:', error);
-          showWarning('Failed to trim videos. Make sure the local server is running at http://localhost:5001 (python app.py)');
+          showWarning(`Failed to trim videos. Make sure the local server is running at ${SEGMENTER_SERVER} (python app.py)`);
         }
       } else {
         // No trimming needed, create ZIP directly
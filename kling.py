@@ -0,0 +1,352 @@
+"""
+Batched lipsync: many video/audio pairs submitted to Kling's video-to-lip API
+and tracked under one batch id.
+
+Kling limits how many tasks an account runs at once and how fast it is
+called. Each access key gets one shared client. The client caps running
+tasks, paces requests, and retries 429/5xx responses and dropped connections
+with jittered exponential backoff. Submitting a task is only retried when
+Kling provably never saw the request, since each task is billed. A batch fans its pairs out to a small
+pool. Each pair holds one of the key's task slots from submission until Kling
+reports the task finished. A batch runs in the process that accepted it, and
+its tasks' progress is saved in the job store, so any worker can report it.
+"""
+import base64
+import hashlib
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+from jobs import BATCH_PROCESSING, watch_batch
+from scheduler import TokenBucket
+
+MAX_CONCURRENT_TASKS = 4  # Per access key
+REQUESTS_PER_SECOND = 2.0  # Per access key, sustained
+REQUEST_BURST = 4  # Per access key
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+REQUEST_TIMEOUT = 180
+POLL_INTERVAL = 5.0
+TASK_TIMEOUT = 30 * 60  # Give up on a task Kling hasn't finished by then
+
+MAX_CACHED_CLIENTS = 128
+
+TASK_STATUSES = ('queued', 'submitting', 'processing', 'completed', 'failed')
+
+BATCH_KIND = 'lipsync'  # Kind of these batches in the job store
+
+
+class KlingError(Exception):
+    def __init__(self, message, retryable=False, status=None, unsent=False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status = status
+        self.unsent = unsent  # The connection was never made, so Kling didn't see the request
+
+
+def _is_retryable(error):
+    return error.retryable
+
+
+def _is_retryable_submit(error):
+    # Only failures that mean Kling never saw the request, or turned it away
+    return error.status == 429 or error.unsent
+
+
+def _backoff(attempt):
+    # "Full jitter", as for Replicate: retries from many tasks spread out instead of colliding
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class KlingClient:
+    def __init__(self, api_base, access_key, secret_key, max_concurrent=MAX_CONCURRENT_TASKS,
+                 requests_per_second=REQUESTS_PER_SECOND, burst=REQUEST_BURST):
+        import requests
+
+        self.api_base = api_base
+        self._session = requests.Session()
+        self._session.headers['Authorization'] = f'Bearer {access_key}:{secret_key}'
+        self._tasks = threading.BoundedSemaphore(max_concurrent)
+        self._bucket = TokenBucket(requests_per_second, burst)
+
+    def task_slot(self):
+        """
+        One of this key's concurrent task slots, as a context manager.
+        """
+        return self._tasks
+
+    def _request(self, method, path, **kwargs):
+        import requests
+        from urllib3.exceptions import NewConnectionError
+
+        try:
+            response = self._session.request(method, f'{self.api_base}{path}', timeout=REQUEST_TIMEOUT, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            unsent = isinstance(e, requests.ConnectTimeout) or isinstance(
+                getattr(e.args[0] if e.args else None, 'reason', None), NewConnectionError
+            )
+            raise KlingError(f'Request failed: {str(e)}', retryable=True, unsent=unsent)
+
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+        if response.status_code != 200:
+            message = f"Kling API error: {response.status_code} - {result.get('message') or response.text[:200]}"
+            raise KlingError(
+                message, retryable=response.status_code == 429 or response.status_code >= 500,
+                status=response.status_code
+            )
+        if result.get('code') != 0:
+            raise KlingError(f"Kling API error ({result.get('code')}): {result.get('message', 'Unknown error')}")
+        return result['data']
+
+    def _call(self, method, path, retryable=_is_retryable, **kwargs):
+        """
+        Rate-limit and retry one API call on errors `retryable` accepts.
+        Returns the response's `data`.
+        """
+        for attempt in range(MAX_ATTEMPTS):
+            self._bucket.acquire()
+            try:
+                return self._request(method, path, **kwargs)
+            except KlingError as e:
+                if attempt == MAX_ATTEMPTS - 1 or not retryable(e):
+                    raise
+                delay = _backoff(attempt)
+                log.warning('kling', 'Request failed, retrying', error=str(e), delay=round(delay, 1))
+                time.sleep(delay)
+
+    def submit(self, video_base64, audio_base64):
+        payload = {'model_name': 'kling-v1', 'video': video_base64, 'audio': audio_base64, 'cfg_scale': 0.5}
+        return self._call('POST', '/v1/videos/video-to-lip', retryable=_is_retryable_submit, json=payload)['task_id']
+
+    def status(self, task_id):
+        """
+        (status, video_url, error), with status as /api/kling-status reports it:
+        processing, completed or failed.
+        """
+        task = self._call('GET', f'/v1/videos/video-to-lip/{task_id}')['task']
+        if task['status'] == 'succeed':
+            return 'completed', task['task_result']['videos'][0]['url'], None
+        if task['status'] == 'failed':
+            return 'failed', None, task.get('task_status_msg', 'Task failed')
+        return 'processing', None, None
+
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def get_kling_client(api_base, access_key, secret_key, max_concurrent=MAX_CONCURRENT_TASKS,
+                     requests_per_second=REQUESTS_PER_SECOND):
+    """
+    Shared client for a key pair, so every batch from one account shares its
+    task and rate limits. The least recently used clients are dropped beyond
+    MAX_CACHED_CLIENTS.
+    """
+    key = hashlib.sha256(f'{api_base}\0{access_key}\0{secret_key}'.encode('utf-8')).hexdigest()
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = KlingClient(
+                api_base, access_key, secret_key, max_concurrent, requests_per_second,
+                max(REQUEST_BURST, int(requests_per_second))
+            )
+            if len(_clients) > MAX_CACHED_CLIENTS:
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(key)
+        return client
+
+
+class LipsyncTask:
+    def __init__(self, index, name, video_path, open_audio):
+        self.index = index
+        self.name = name
+        self.video_path = video_path
+        self.open_audio = open_audio  # Returns a binary file; segments may be rendered on demand
+        self.status = 'queued'
+        self.task_id = None
+        self.video_url = None
+        self.error = None
+
+    def to_row(self):
+        """
+        The task as saved in the job store's batch_items.
+        """
+        return {
+            'item_index': self.index,
+            'name': self.name,
+            'status': self.status,
+            'task_id': self.task_id,
+            'video_url': self.video_url,
+            'error': self.error
+        }
+
+
+class LipsyncBatch:
+    """
+    One batch of video/audio pairs. Videos shared by several pairs (usually
+    one face video for every segment) are read and encoded once.
+    """
+
+    def __init__(self, store, upload_folder, client, concurrency, poll_interval=POLL_INTERVAL):
+        self.id = uuid.uuid4().hex[:12]
+        self.store = store
+        self.upload_folder = upload_folder
+        self.client = client
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.tasks = []
+        self.status = 'queued'
+        self._videos = {}  # path -> [base64, pairs still to submit, lock held while encoding]
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    @property
+    def scratch_dir(self):
+        """Directory for the videos and audio uploaded with this batch"""
+        return os.path.join(self.upload_folder, f'lipsync_{self.id}')
+
+    def add_task(self, name, video_path, open_audio):
+        task = LipsyncTask(len(self.tasks), name, video_path, open_audio)
+        self.tasks.append(task)
+        self._videos.setdefault(video_path, [None, 0, threading.Lock()])[1] += 1
+        return task
+
+    def start(self):
+        self._pending = len(self.tasks)
+        self.status = BATCH_PROCESSING
+        self.store.add_batch(self.id, BATCH_KIND, [task.to_row() for task in self.tasks])
+        # Lipsync batches can't be canceled; the heartbeat shows the batch is still running
+        watch_batch(self.store, self.id, self._finished, lambda: None)
+        pool = ThreadPoolExecutor(max_workers=min(self.concurrency, len(self.tasks)), thread_name_prefix=f'lipsync-{self.id}')
+        for task in self.tasks:
+            pool.submit(self._run, task)
+        pool.shutdown(wait=False)
+
+    def _video_base64(self, path):
+        with self._lock:
+            entry = self._videos[path]
+        # Encoded once per video; only pairs sharing this video wait for it
+        with entry[2]:
+            if entry[0] is None:
+                with open(path, 'rb') as f:
+                    entry[0] = base64.b64encode(f.read()).decode('ascii')
+            return entry[0]
+
+    def _video_submitted(self, path):
+        with self._lock:
+            entry = self._videos[path]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._videos[path]
+
+    def _save(self, task, **fields):
+        # A store error only loses this update, not the task
+        for field, value in fields.items():
+            setattr(task, field, value)
+        try:
+            self.store.update_batch_item(self.id, task.index, **fields)
+        except Exception as e:
+            log.error('lipsync', 'Failed to save task progress', batch_id=self.id, task=task.index, error=str(e))
+
+    def _run(self, task):
+        try:
+            with self.client.task_slot():
+                self._save(task, status='submitting')
+                try:
+                    with task.open_audio() as f:
+                        audio_base64 = base64.b64encode(f.read()).decode('ascii')
+                    task_id = self.client.submit(self._video_base64(task.video_path), audio_base64)
+                finally:
+                    self._video_submitted(task.video_path)
+                self._save(task, status='processing', task_id=task_id)
+                log.info('lipsync', 'Kling task submitted', batch_id=self.id, task=task.name, task_id=task.task_id)
+
+                deadline = time.monotonic() + TASK_TIMEOUT
+                while True:
+                    time.sleep(self.poll_interval)
+                    status, video_url, error = self.client.status(task.task_id)
+                    if status == 'failed':
+                        raise KlingError(error)
+                    if status == 'completed':
+                        break
+                    if time.monotonic() > deadline:
+                        raise KlingError(f'Kling task {task.task_id} did not finish in {TASK_TIMEOUT // 60} minutes')
+                self._save(task, status='completed', video_url=video_url)
+        except Exception as e:
+            log.error('lipsync', 'Task failed', batch_id=self.id, task=task.name, task_id=task.task_id, error=str(e))
+            self._save(task, status='failed', error=str(e))
+        finally:
+            self._task_done()
+
+    def _task_done(self):
+        with self._lock:
+            self._pending -= 1
+            finished = not self._pending
+        if finished:
+            self.status = 'completed'
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            try:
+                self.store.update_batch(self.id, status=self.status)
+            finally:
+                self._finished.set()
+
+
+def create_lipsync_batch(store, upload_folder, client, concurrency, poll_interval=POLL_INTERVAL):
+    batch = LipsyncBatch(store, upload_folder, client, concurrency, poll_interval)
+    os.makedirs(batch.scratch_dir, exist_ok=True)
+    return batch
+
+
+def discard_lipsync_batch(batch):
+    """
+    Remove the uploads of a batch that was never started.
+    """
+    shutil.rmtree(batch.scratch_dir, ignore_errors=True)
+
+
+def get_lipsync_batch(store, batch_id):
+    """
+    A batch's progress as /api/kling-lipsync/batch/<batch_id> reports it,
+    whichever worker runs it, or None.
+    """
+    batch = store.get_batch(batch_id, BATCH_KIND)
+    if batch is None:
+        return None
+    counts = {status: 0 for status in TASK_STATUSES}
+    for task in batch['items']:
+        counts[task['status']] += 1
+    finished = counts['completed'] + counts['failed']
+    total = len(batch['items'])
+    return {
+        'batch_id': batch['id'],
+        'status': batch['status'],
+        'total_tasks': total,
+        'counts': counts,
+        'progress': finished / total if total else 1.0,
+        'error': batch['error'],
+        'tasks': [
+            {
+                'index': task['item_index'],
+                'name': task['name'],
+                'status': task['status'],
+                'task_id': task['task_id'],
+                'video_url': task['video_url'],
+                'error': task['error']
+            }
+            for task in batch['items']
+        ]
+    }
@@ -0,0 +1,194 @@
+"""
+Structured logging that stays off the request path.
+
+Each call puts a record on a bounded queue and returns. A background thread
+turns records into JSON lines on stdout, with the stage, the message, the job
+or batch ids bound by `context`, and any extra fields. Field values are
+clipped where the call is made, so a multi-hour transcript costs no more to
+log than a short one. Raw payload dumps are debug level and sampled. If the
+writer falls behind, records are dropped and counted rather than blocking
+the caller.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+LEVEL = 'INFO'
+DEBUG_SAMPLE_RATE = 0.01  # Share of debug dumps written
+MAX_FIELD_CHARS = 1000  # Longer strings are cut to this
+MAX_FIELD_ITEMS = 10  # Longer lists and dicts keep only their first items
+MAX_FIELD_DEPTH = 4
+QUEUE_SIZE = 10000
+
+_logger = logging.getLogger('audio_segmenter')
+_logger.propagate = False
+_logger.setLevel(LEVEL)
+
+_context = contextvars.ContextVar('log_context', default={})
+_sample_rate = DEBUG_SAMPLE_RATE
+_max_chars = MAX_FIELD_CHARS
+_listener = None
+_listener_lock = threading.Lock()
+_dropped = 0
+
+
+class _Handler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Formatting happens on the writer thread
+        return record
+
+    def enqueue(self, record):
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped += 1
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        global _dropped
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname.lower(),
+            'stage': record.stage,
+            'message': record.getMessage()
+        }
+        entry.update(record.fields)
+        if _dropped:
+            entry['dropped'], _dropped = _dropped, 0
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure(level=LEVEL, sample_rate=DEBUG_SAMPLE_RATE, max_chars=MAX_FIELD_CHARS):
+    global _sample_rate, _max_chars
+    _logger.setLevel(level.upper() if isinstance(level, str) else level)
+    _sample_rate = sample_rate
+    _max_chars = max_chars
+
+
+def _start():
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            records = queue.Queue(QUEUE_SIZE)
+            output = logging.StreamHandler(sys.stdout)
+            output.setFormatter(_JsonFormatter())
+            _listener = logging.handlers.QueueListener(records, output)
+            _listener.start()
+            _logger.handlers = [_Handler(records)]
+
+
+def flush():
+    """
+    Write out everything queued so far and stop the writer thread; the
+    next record starts it again.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+            _logger.handlers = []
+
+
+def _forget_listener():
+    # A forked worker inherits the queue but not the thread that drains it
+    global _listener
+    _listener = None
+    _logger.handlers = []
+
+
+atexit.register(flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_listener)
+
+
+def clip(value, depth=0):
+    """
+    Copy of value small enough to log: long strings are cut, long
+    containers keep their first items, and anything else becomes a short
+    string. Costs the same however big value is.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        if len(value) <= _max_chars:
+            return value
+        return f'{value[:_max_chars]}... [{len(value)} chars]'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f'<{len(value)} bytes>'
+    if depth >= MAX_FIELD_DEPTH:
+        return f'<{type(value).__name__}>'
+    if isinstance(value, dict):
+        clipped = {}
+        for i, key in enumerate(value):
+            if i == MAX_FIELD_ITEMS:
+                clipped['...'] = f'{len(value)} keys'
+                break
+            clipped[str(key)] = clip(value[key], depth + 1)
+        return clipped
+    if isinstance(value, (list, tuple)):
+        clipped = [clip(item, depth + 1) for item in value[:MAX_FIELD_ITEMS]]
+        if len(value) > MAX_FIELD_ITEMS:
+            clipped.append(f'... [{len(value)} items]')
+        return clipped
+    return clip(f'<{type(value).__name__}>', depth)
+
+
+@contextmanager
+def context(**fields):
+    """
+    Add fields (job_id, batch_id, ...) to every record logged in this block,
+    on this thread.
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def _log(level, stage, message, fields):
+    if not _logger.isEnabledFor(level):
+        return
+    if _listener is None:
+        _start()
+    record_fields = dict(_context.get())
+    for key, value in fields.items():
+        record_fields[key] = clip(value)
+    _logger.log(level, message, extra={'stage': stage, 'fields': record_fields})
+
+
+def debug(stage, message, **fields):
+    _log(logging.DEBUG, stage, message, fields)
+
+
+def info(stage, message, **fields):
+    _log(logging.INFO, stage, message, fields)
+
+
+def warning(stage, message, **fields):
+    _log(logging.WARNING, stage, message, fields)
+
+
+def error(stage, message, **fields):
+    _log(logging.ERROR, stage, message, fields)
+
+
+def dump(stage, message, payload, **fields):
+    """
+    Debug record carrying a raw payload (an API response, a transcript),
+    written for only a DEBUG_SAMPLE_RATE share of calls.
+    """
+    if _logger.isEnabledFor(logging.DEBUG) and random.random() < _sample_rate:
+        _log(logging.DEBUG, stage, message, dict(fields, payload=payload))
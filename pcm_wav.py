@@ -0,0 +1,177 @@
+"""
+Slicing uncompressed PCM WAV files without decoding them.
+
+For PCM, a cut point is just a byte offset: the frame index times the block
+size. So a WAV segment of a WAV upload is a fresh header followed by a byte
+range of the source's data chunk. The header keeps the source's format:
+WAVE_FORMAT_EXTENSIBLE inputs (usually more than 2 channels or more than 16
+bits) keep their extensible fmt chunk, with its channel mask and valid bits. The range is copied
+file-to-file in the kernel (copy_file_range, else sendfile). Where neither is
+available, it is written straight from a memory map of the source. No
+samples pass through Python, so splitting a multi-GB recording is bound by
+disk I/O and uses next to no memory.
+"""
+import mmap
+import os
+import struct
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# KSDATAFORMAT_SUBTYPE_PCM, the SubFormat GUID of integer PCM in an extensible fmt chunk
+PCM_SUBFORMAT = b'\x01\x00\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Bytes per kernel copy call
+
+
+class PcmWav:
+    """
+    Layout of a PCM WAV file: its format and where the samples are.
+    """
+
+    def __init__(self, path, channels, frame_rate, sample_width, data_offset, data_size, extension=None):
+        self.path = path
+        self.channels = channels
+        self.frame_rate = frame_rate
+        self.sample_width = sample_width
+        self.data_offset = data_offset
+        self.data_size = data_size
+        self.extension = extension  # cbSize and the rest of an extensible fmt chunk, else None
+
+    @property
+    def block_align(self):
+        return self.channels * self.sample_width
+
+    @property
+    def frame_count(self):
+        return self.data_size // self.block_align
+
+    @property
+    def duration(self):
+        # Rounded to the millisecond, as pydub's len() is
+        return round(1000 * self.frame_count / self.frame_rate) / 1000
+
+    def frame_at(self, seconds):
+        """
+        Frame index of a cut point: whole milliseconds, as in the ffmpeg and
+        pydub paths, then the frame pydub would slice at. A cut at or past the
+        (rounded) duration is the end of the file, so the last segment keeps
+        every frame.
+        """
+        if seconds >= self.duration:
+            return self.frame_count
+        milliseconds = max(int(seconds * 1000), 0)
+        return min(milliseconds * self.frame_rate // 1000, self.frame_count)
+
+    def header(self, frames):
+        """
+        Canonical header for `frames` frames in this format: 44 bytes, or 68
+        with an extensible fmt chunk.
+        """
+        data_size = frames * self.block_align
+        extension = self.extension or b''
+        fmt = struct.pack(
+            '<HHIIHH', WAVE_FORMAT_EXTENSIBLE if extension else WAVE_FORMAT_PCM, self.channels,
+            self.frame_rate, self.frame_rate * self.block_align, self.block_align, self.sample_width * 8
+        ) + extension
+        return struct.pack(
+            f'<4sI4s4sI{len(fmt)}s4sI',
+            b'RIFF', 20 + len(fmt) + data_size + (data_size & 1), b'WAVE',
+            b'fmt ', len(fmt), fmt,
+            b'data', data_size
+        )
+
+
+def read_pcm_wav(path):
+    """
+    Parse a WAV file's RIFF chunks. Returns a PcmWav, or None if the file
+    isn't integer PCM WAV (compressed, float, RF64, or not WAV at all).
+    """
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+                return None
+
+            fmt = None
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    return None
+                chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+                if chunk_id == b'fmt ':
+                    fmt = f.read(chunk_size)
+                    if chunk_size & 1:
+                        f.seek(1, os.SEEK_CUR)
+                elif chunk_id == b'data':
+                    if fmt is None or len(fmt) < 16:
+                        return None
+                    format_tag, channels, frame_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+                    extension = None
+                    if format_tag == WAVE_FORMAT_EXTENSIBLE:
+                        if len(fmt) < 40 or fmt[24:40] != PCM_SUBFORMAT:
+                            return None
+                        extension = fmt[16:40]
+                    elif format_tag != WAVE_FORMAT_PCM:
+                        return None
+                    sample_width = (bits + 7) // 8
+                    if not channels or not frame_rate or block_align != channels * sample_width:
+                        return None
+                    data_offset = f.tell()
+                    # Streamed recordings can leave the size unset or too large
+                    data_size = min(chunk_size, file_size - data_offset)
+                    return PcmWav(path, channels, frame_rate, sample_width, data_offset, data_size, extension)
+                else:
+                    f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+
+def _copy_range(src, dest, offset, count, source_map):
+    """
+    Copy `count` bytes from `offset` in src to dest's current position.
+    """
+    position = dest.tell()
+    dest.flush()
+    while count:
+        length = min(count, COPY_CHUNK_SIZE)
+        copied = 0
+        try:
+            if hasattr(os, 'copy_file_range'):
+                copied = os.copy_file_range(src.fileno(), dest.fileno(), length, offset, position)
+            else:
+                os.lseek(dest.fileno(), position, os.SEEK_SET)
+                copied = os.sendfile(dest.fileno(), src.fileno(), offset, length)
+        except OSError:
+            # Cross-filesystem on older kernels, or an unsupported filesystem
+            copied = 0
+        if not copied:
+            os.lseek(dest.fileno(), position, os.SEEK_SET)
+            with memoryview(source_map)[offset:offset + length] as view:
+                copied = os.write(dest.fileno(), view)
+        offset += copied
+        position += copied
+        count -= copied
+    dest.seek(position)
+
+
+def write_slices(wav, cuts, output_paths):
+    """
+    Write one WAV file per (start_seconds, end_seconds) in `cuts`.
+    """
+    with open(wav.path, 'rb') as src:
+        # Only touched if the kernel can't copy between these two files
+        source_map = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) if wav.data_size else None
+        try:
+            for (start, end), output_path in zip(cuts, output_paths):
+                start_frame, end_frame = wav.frame_at(start), wav.frame_at(end)
+                frames = max(end_frame - start_frame, 0)
+                size = frames * wav.block_align
+                with open(output_path, 'wb') as dest:
+                    dest.write(wav.header(frames))
+                    _copy_range(src, dest, wav.data_offset + start_frame * wav.block_align, size, source_map)
+                    if size & 1:
+                        dest.write(b'\0')
+        finally:
+            if source_map is not None:
+                source_map.close()
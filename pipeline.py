@@ -0,0 +1,790 @@
+"""
+Transcribe -> split -> export stages shared by the web endpoints and batch jobs.
+Nothing in here depends on Flask.
+
+pydub and the Replicate client are imported by the stages that use them, so
+importing this module (and starting the app) stays cheap.
+"""
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+import wave
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+from cancellation import Cancelled, run_subprocess
+from pcm_wav import read_pcm_wav, write_slices
+from scheduler import throughput
+from transcript import Transcript, TranscriptBuilder
+from transcript_parser import parse_output
+
+WHISPER_VERSION = "3ab86df6c8f54c11309d4d1f930ac292bad43ace52d10c80d87eb258b3c9f79c"
+
+# incredibly-fast-whisper with batch_size=4: ~33x real-time speed (30 min in 54 sec).
+# Only used until timings from completed jobs have been learned.
+TRANSCRIPTION_SPEED = 33
+
+TRANSCRIPTION_MAX_WAIT = 600  # 10 minutes maximum wait
+TRANSCRIPTION_POLL_INTERVAL = 2  # Poll every 2 seconds
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Whisper resamples everything to 16 kHz mono, so anything more is wasted upload
+TRANSCRIPTION_SAMPLE_RATE = 16000
+TRANSCODE_TIMEOUT = 600
+
+# Long files are transcribed as chunks of this many seconds, so words become
+# final (and segments can be encoded) while later chunks are still running
+TRANSCRIPTION_CHUNK_SECONDS = 600
+CHUNK_OVERLAP = 2.0  # Extra audio at the end of each chunk, so boundary words are heard whole
+TRANSCRIPTION_CHUNK_WORKERS = 4  # Chunks of one file in flight at once, like a key's prediction slots
+
+# Segment output formats. 'format'/'codec' are passed to pydub's ffmpeg export;
+# WAV skips the encoder entirely and writes the decoded PCM as-is. 'encoder' is
+# the ffmpeg codec used when a single segment is rendered straight from the source.
+OUTPUT_FORMATS = {
+    'mp3': {'extension': 'mp3', 'format': 'mp3', 'codec': None, 'encoder': 'libmp3lame', 'default_bitrate': '192k', 'bitrate_range': (32, 320)},
+    'opus': {'extension': 'opus', 'format': 'opus', 'codec': 'libopus', 'encoder': 'libopus', 'default_bitrate': '96k', 'bitrate_range': (6, 510)},
+    'aac': {'extension': 'm4a', 'format': 'ipod', 'codec': 'aac', 'encoder': 'aac', 'default_bitrate': '192k', 'bitrate_range': (32, 512)},
+    'flac': {'extension': 'flac', 'format': 'flac', 'codec': None, 'encoder': 'flac', 'default_bitrate': None, 'bitrate_range': None},
+    'wav': {'extension': 'wav', 'format': 'wav', 'codec': None, 'encoder': 'pcm_s16le', 'default_bitrate': None, 'bitrate_range': None},
+}
+DEFAULT_OUTPUT_FORMAT = 'mp3'
+
+AUDIO_OUTPUT_EXTENSIONS = {f'.{spec["extension"]}' for spec in OUTPUT_FORMATS.values()}
+
+RENDER_TIMEOUT = 300  # Seconds allowed to render one segment
+
+# Where a segment may end: last character of a word -> priority (higher wins).
+# 'fixed' has no break points, so segments are cut every max_duration seconds.
+SPLIT_MODES = {
+    'punctuation': {'.': 3, '?': 3, '!': 3, ',': 2, ';': 2},  # Sentence endings, else phrase breaks
+    'sentence': {'.': 3, '?': 3, '!': 3},
+    'fixed': {},
+}
+DEFAULT_SPLIT_MODE = 'punctuation'
+
+
+def estimate_transcription_time(audio_duration_seconds):
+    """
+    Seconds a transcription is expected to take once it starts, learned from
+    completed jobs of similar length.
+    """
+    return int(throughput.estimate('transcribe', WHISPER_VERSION, audio_duration_seconds, 1 / TRANSCRIPTION_SPEED))
+
+
+def estimate_export_time(audio_duration_seconds, output_format=DEFAULT_OUTPUT_FORMAT):
+    """
+    Seconds to split and encode a whole file, or None before any export has been timed.
+    """
+    estimate = throughput.estimate('export', output_format, audio_duration_seconds)
+    return None if estimate is None else int(estimate)
+
+
+def friendly_error_message(error_message):
+    """
+    Provide helpful error messages for common issues.
+    """
+    if "cuda" in error_message.lower() or "out of memory" in error_message.lower() or "memory" in error_message.lower():
+        return "GPU memory limit exceeded. Your audio file is too long for Replicate's GPU. Please try splitting your audio into smaller files (10-15 minutes each) and processing them separately."
+    elif "timeout" in error_message.lower():
+        return "Processing timed out. This usually happens with very large files. Try splitting your audio into smaller files first."
+    elif "404" in error_message or "not found" in error_message.lower():
+        return "Replicate model not found. Please check your internet connection and try again."
+    return error_message
+
+
+def normalize_output_options(output_format=None, bitrate=None):
+    """
+    Validate an output format and bitrate ("128k" or "128").
+    Returns (output_format, bitrate); bitrate is None for lossless formats.
+    Raises ValueError for unsupported values.
+    """
+    output_format = (output_format or DEFAULT_OUTPUT_FORMAT).lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Output format must be one of: {", ".join(OUTPUT_FORMATS)}')
+
+    spec = OUTPUT_FORMATS[output_format]
+    if spec['bitrate_range'] is None:
+        return output_format, None
+    if not bitrate:
+        return output_format, spec['default_bitrate']
+
+    try:
+        kbps = int(str(bitrate).lower().rstrip('k'))
+    except ValueError:
+        raise ValueError(f'Invalid bitrate: {bitrate}')
+
+    low, high = spec['bitrate_range']
+    if kbps < low or kbps > high:
+        raise ValueError(f'Bitrate for {output_format} must be between {low}k and {high}k')
+    return output_format, f'{kbps}k'
+
+
+def write_wav(segment_audio, path):
+    """
+    Write decoded PCM straight into a WAV container, no encoder involved.
+    """
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(segment_audio.channels)
+        wav_file.setsampwidth(segment_audio.sample_width)
+        wav_file.setframerate(segment_audio.frame_rate)
+        wav_file.writeframesraw(segment_audio.raw_data)
+
+
+def get_audio_duration(audio_path):
+    wav = read_pcm_wav(audio_path)
+    if wav is not None:
+        return wav.duration
+
+    from pydub import AudioSegment
+
+    audio = AudioSegment.from_file(audio_path)
+    return len(audio) / 1000.0
+
+
+def probe_audio_duration(audio_path):
+    """
+    Duration from the file header, without decoding. WAV headers are read
+    directly and everything else goes through ffprobe. Compressed formats
+    without a length header give an estimate, so this is for time estimates;
+    segment plans use get_audio_duration.
+    """
+    try:
+        with wave.open(audio_path, 'rb') as wav_file:
+            return wav_file.getnframes() / wav_file.getframerate()
+    except (wave.Error, EOFError):
+        pass
+
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', audio_path],
+        capture_output=True, text=True, timeout=30
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        raise Exception(f'Could not determine duration: {result.stderr.strip() or result.stdout.strip()}')
+
+
+def store_upload(stream, folder, filename):
+    """
+    Save an uploaded stream under a content-addressed name, hashing it as it is
+    written. Identical uploads end up as the same file.
+    Returns (path, content_hash).
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    temp_path = os.path.join(folder, f'incoming_{uuid.uuid4().hex}{ext}')
+    digest = hashlib.sha256()
+
+    with open(temp_path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+
+    content_hash = digest.hexdigest()
+    return place_upload(temp_path, folder, content_hash, ext), content_hash
+
+
+def place_upload(temp_path, folder, content_hash, ext):
+    """
+    Move a fully received file to its content-addressed name in folder, or
+    drop it if identical content is already there. Returns the final path.
+    """
+    path = os.path.join(folder, f'upload_{content_hash}{ext}')
+    if os.path.exists(path):
+        os.remove(temp_path)
+    else:
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            # Received on another filesystem (e.g. a chunked upload): copy alongside, then swap in
+            incoming_path = f'{path}.incoming'
+            shutil.copyfile(temp_path, incoming_path)
+            os.replace(incoming_path, path)
+            os.remove(temp_path)
+    return path
+
+
+def _transcode(audio_path, output_path, start_time=None, duration=None, cancel=None):
+    """
+    Write 16 kHz mono FLAC, optionally of just [start_time, start_time + duration).
+    """
+    ffmpeg_cmd = ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error']
+    if start_time:
+        ffmpeg_cmd += ['-ss', f'{start_time:.3f}']
+    ffmpeg_cmd += ['-i', audio_path]
+    if duration:
+        ffmpeg_cmd += ['-t', f'{duration:.3f}']
+    ffmpeg_cmd += [
+        '-vn', '-ac', '1', '-ar', str(TRANSCRIPTION_SAMPLE_RATE),
+        '-sample_fmt', 's16', '-c:a', 'flac', '-compression_level', '8',
+        output_path
+    ]
+
+    result = run_subprocess(ffmpeg_cmd, TRANSCODE_TIMEOUT, cancel)
+    if result.returncode != 0:
+        raise Exception(f'FFmpeg failed: {result.stderr}')
+
+
+def transcode_for_transcription(audio_path, cancel=None):
+    """
+    Downmix and resample to 16 kHz mono FLAC for upload. FLAC is lossless and
+    has no encoder delay, so timestamps line up with the original exactly.
+    Returns the path to upload: the transcoded file, or audio_path itself when
+    transcoding fails or wouldn't make the upload smaller.
+    """
+    output_path = f'{os.path.splitext(audio_path)[0]}_{uuid.uuid4().hex[:8]}_16k.flac'
+    try:
+        _transcode(audio_path, output_path, cancel=cancel)
+    except Cancelled:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    except Exception as e:
+        log.warning('transcode', 'Transcoding for upload failed, sending the original', error=str(e))
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return audio_path
+
+    original_size = os.path.getsize(audio_path)
+    transcoded_size = os.path.getsize(output_path)
+    if transcoded_size >= original_size:
+        # Already-compact input, e.g. a low bitrate MP3
+        os.remove(output_path)
+        return audio_path
+
+    log.info('transcode', 'Transcoded for upload', original_bytes=original_size, transcoded_bytes=transcoded_size)
+    return output_path
+
+
+def transcribe(audio_path, api_key, prediction_id=None, on_prediction=None, audio_duration=None, cancel=None):
+    """
+    Transcribe with incredibly-fast-whisper (with word-level timestamps).
+    Pass prediction_id to pick up a prediction started earlier, e.g. before a
+    restart, instead of creating a new one. on_prediction(id) is called as soon
+    as a new prediction exists. With audio_duration, shorter files get the
+    key's prediction slots first and the timing refines future estimates.
+    When the `cancel` token fires, the prediction is cancelled and Cancelled
+    is raised.
+    """
+    from replicate_client import get_client
+
+    # Per-key client: no shared REPLICATE_API_TOKEN between concurrent users
+    client = get_client(api_key)
+
+    if prediction_id:
+        return _transcribe(client, audio_path, prediction_id, on_prediction, audio_duration, cancel)
+
+    upload_path = transcode_for_transcription(audio_path, cancel)
+    try:
+        return _transcribe(client, upload_path, None, on_prediction, audio_duration, cancel)
+    finally:
+        if upload_path != audio_path:
+            os.remove(upload_path)
+
+
+def _transcribe(client, audio_path, prediction_id, on_prediction, audio_duration, cancel=None, prepare=None):
+    # prepare() writes audio_path once a slot is held, so waiting chunks keep no files around
+    from replicate_client import TERMINAL_STATUSES
+
+    estimate = estimate_transcription_time(audio_duration) if audio_duration else 0
+    with client.prediction_slot(estimate, cancel):
+        slot_acquired = time.monotonic()
+        if prepare and not prediction_id:
+            prepare()
+        if prediction_id:
+            log.info('transcribe', 'Resuming prediction', prediction_id=prediction_id)
+            prediction = client.get_prediction(prediction_id)
+        else:
+            log.info('transcribe', 'Starting transcription', model='incredibly-fast-whisper', audio_duration=audio_duration)
+
+            # Using incredibly-fast-whisper with conservative settings to avoid GPU memory issues
+            # Use prediction API with polling to avoid timeouts
+            with open(audio_path, 'rb') as audio_file:
+                prediction = client.create_prediction(
+                    WHISPER_VERSION,
+                    {
+                        "audio": audio_file,
+                        "task": "transcribe",
+                        "batch_size": 4,  # Very low batch size to avoid GPU memory overflow
+                        "timestamp": "word"  # Word-level timestamps for accurate splitting
+                    }
+                )
+
+            log.info('transcribe', 'Prediction created', prediction_id=prediction.id)
+            if on_prediction:
+                on_prediction(prediction.id)
+
+        # Poll for completion with periodic status updates
+        start_time = time.time()
+
+        try:
+            while prediction.status not in TERMINAL_STATUSES:
+                elapsed = time.time() - start_time
+
+                if elapsed > TRANSCRIPTION_MAX_WAIT:
+                    raise Exception(f'Transcription timed out after {TRANSCRIPTION_MAX_WAIT} seconds')
+
+                if cancel:
+                    cancel.wait(TRANSCRIPTION_POLL_INTERVAL)
+                else:
+                    time.sleep(TRANSCRIPTION_POLL_INTERVAL)
+                client.reload(prediction)
+                log.debug('transcribe', 'Prediction status', prediction_id=prediction.id, status=prediction.status,
+                          elapsed=round(elapsed, 1))
+        finally:
+            # Don't leave a billed prediction running when this job is abandoned or cancelled
+            if prediction.status not in TERMINAL_STATUSES:
+                client.cancel(prediction)
+
+    if prediction.status == 'failed':
+        error_msg = getattr(prediction, 'error', 'Unknown error')
+        raise Exception(f'Replicate prediction failed: {error_msg}')
+
+    if prediction.status == 'canceled':
+        raise Exception('Prediction was canceled')
+
+    output = prediction.output
+    log.info('transcribe', 'Transcription completed', prediction_id=prediction.id,
+             seconds=round(time.time() - start_time, 1))
+    log.dump('transcribe', 'Whisper output', output, prediction_id=prediction.id)
+
+    # Parse output - incredibly-fast-whisper returns JSON with word-level timestamps,
+    # or a URL to a JSON/SRT/VTT transcript, which is parsed as it streams in
+    transcript = parse_output(output)
+
+    log.info('transcribe', 'Transcript parsed', prediction_id=prediction.id, words=len(transcript),
+             duration=transcript.duration)
+    log.dump('transcribe', 'First words', list(transcript[:3]), prediction_id=prediction.id)
+
+    # A resumed prediction started before slot_acquired, so its timing would be misleading
+    if audio_duration and not prediction_id:
+        throughput.observe('transcribe', WHISPER_VERSION, audio_duration, time.monotonic() - slot_acquired)
+
+    return transcript
+
+
+def transcribe_chunked(audio_path, api_key, audio_duration, on_words=None, prediction_id=None, on_prediction=None,
+                       chunk_seconds=TRANSCRIPTION_CHUNK_SECONDS, cancel=None, chunks=None, on_chunks=None):
+    """
+    Transcribe long audio as consecutive chunks, one prediction each, so the
+    transcript becomes final a chunk at a time instead of all at the end.
+    on_words(piece) is called with each chunk's words, in order and already
+    shifted to file time. Short files, and resumed single predictions, are
+    transcribed in one piece. For a chunked run on_prediction is called once,
+    with None, and on_chunks(chunks) with the progress of every chunk (its
+    prediction id, then its words) each time a chunk starts or finishes.
+    Passing those chunks back resumes the run: finished chunks are reused and
+    running ones re-attach to their predictions. `cancel` stops every chunk,
+    as for transcribe.
+    """
+    if prediction_id or not audio_duration or audio_duration < 2 * chunk_seconds:
+        transcript = transcribe(
+            audio_path, api_key, prediction_id=prediction_id, on_prediction=on_prediction,
+            audio_duration=audio_duration, cancel=cancel
+        )
+        if on_words and transcript:
+            on_words(transcript)
+        return transcript
+
+    from replicate_client import get_client
+
+    client = get_client(api_key)
+    boundaries = [i * chunk_seconds for i in range(int(audio_duration // chunk_seconds))]
+    boundaries.append(audio_duration)
+    count = len(boundaries) - 1
+    # Progress saved by a run with other chunk boundaries can't be reused
+    if not chunks or chunks.get('chunk_seconds') != chunk_seconds or len(chunks.get('chunks', ())) != count:
+        chunks = {'chunk_seconds': chunk_seconds, 'chunks': [{'prediction_id': None, 'words': None} for _ in range(count)]}
+    chunks_lock = threading.Lock()
+    log.info('transcribe', 'Transcribing in chunks', chunks=count, chunk_seconds=chunk_seconds,
+             resumed=sum(1 for chunk in chunks['chunks'] if chunk['prediction_id'] or chunk['words']))
+    if on_prediction:
+        on_prediction(None)
+
+    def progress(i, **fields):
+        # Saved in order, so the last save holds every chunk's latest state
+        with chunks_lock:
+            chunks['chunks'][i].update(fields)
+            if on_chunks:
+                on_chunks(json.loads(json.dumps(chunks)))
+
+    def transcribe_chunk(i):
+        saved = chunks['chunks'][i]
+        if saved['words'] is not None:
+            return Transcript.from_segments(saved['words'])
+        start = boundaries[i]
+        length = boundaries[i + 1] - start + (CHUNK_OVERLAP if i + 2 < len(boundaries) else 0)
+        if saved['prediction_id']:
+            transcript = _transcribe(client, None, saved['prediction_id'], None, length, cancel)
+        else:
+            chunk_path = f'{os.path.splitext(audio_path)[0]}_{uuid.uuid4().hex[:8]}_chunk{i:03d}.flac'
+
+            def created(chunk_prediction):
+                # Uploaded with the prediction; not needed while it runs
+                os.remove(chunk_path)
+                progress(i, prediction_id=chunk_prediction)
+
+            try:
+                transcript = _transcribe(
+                    client, chunk_path, None, created, length, cancel,
+                    prepare=lambda: _transcode(audio_path, chunk_path, start, length, cancel)
+                )
+            finally:
+                if os.path.exists(chunk_path):
+                    os.remove(chunk_path)
+        progress(i, words=transcript.to_segments())
+        return transcript
+
+    builder = TranscriptBuilder()
+    last_end = 0.0
+    # Chunks queue for the key's prediction slots like any other job; results are merged in order
+    pool = ThreadPoolExecutor(max_workers=min(count, TRANSCRIPTION_CHUNK_WORKERS), thread_name_prefix='transcribe-chunk')
+    try:
+        # Each chunk thread logs with the caller's job id
+        futures = [pool.submit(contextvars.copy_context().run, transcribe_chunk, i) for i in range(count)]
+        for i, future in enumerate(futures):
+            offset = boundaries[i]
+            piece = TranscriptBuilder()
+            for start, end, text in future.result():
+                start += offset
+                end += offset
+                # Words starting in the overlap belong to the next chunk; words the
+                # previous chunk already covered (the tail of a cut word) are dropped
+                if start < last_end or (i + 2 < len(boundaries) and start >= boundaries[i + 1]):
+                    continue
+                piece.append(start, end, text)
+                builder.append(start, end, text)
+                last_end = end
+            if on_words:
+                on_words(piece.build())
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return builder.build()
+
+
+def _next_split(transcript, current_start, max_duration, split_mode=DEFAULT_SPLIT_MODE):
+    """
+    One step of find_split_points: the next cut after current_start, and
+    whether it falls on punctuation (otherwise it is just max_duration on).
+    """
+    target_time = current_start + max_duration
+    breaks = SPLIT_MODES[split_mode]
+    if not breaks:
+        return target_time, False
+
+    # Find the best split point before target_time
+    best_split = None
+    best_priority = -1
+    word_count = 0
+
+    # Only consider words in the current segment window
+    for word_start, word_end, text in transcript.ending_within(current_start, target_time):
+        # Running count of words since current_start
+        word_count += len(text.split())
+
+        # Check last character for punctuation (ONLY punctuation, no spaces).
+        # Only consider punctuation if we have 3+ words.
+        # No priority for spaces/word boundaries - people speak continuously
+        priority = breaks.get(text[-1], 0) if word_count >= 3 else 0
+
+        # Take the highest priority break point, or the latest one if same priority
+        if priority > 0 and priority >= best_priority:
+            best_split = word_end
+            best_priority = priority
+
+    # If we found a good split point, use it
+    if best_split and best_split > current_start:
+        return best_split, True
+    # No good split found, just move forward by max_duration
+    return target_time, False
+
+
+def find_split_points(transcript, max_duration=60.0, split_mode=DEFAULT_SPLIT_MODE):
+    """
+    Find optimal split points in transcript based on punctuation marks.
+    Ensures each segment is as long as possible without exceeding max_duration.
+    Only splits at punctuation if there are 3+ words before it. split_mode
+    picks which punctuation counts (see SPLIT_MODES).
+    """
+    if not isinstance(transcript, Transcript):
+        transcript = Transcript.from_segments(transcript)
+
+    split_points = []
+    if not transcript:
+        return split_points
+
+    total_duration = transcript.duration
+
+    # Find split points by looking for the best break before max_duration
+    current_start = 0.0
+
+    while current_start < total_duration:
+        current_start, at_punctuation = _next_split(transcript, current_start, max_duration, split_mode)
+        if at_punctuation or current_start < total_duration:
+            split_points.append(current_start)
+
+    return split_points
+
+
+def segment_filename(index, output_format=DEFAULT_OUTPUT_FORMAT):
+    return f"segment_{index + 1:03d}.{OUTPUT_FORMATS[output_format]['extension']}"
+
+
+def split_audio_file(audio_path, split_points, output_dir, output_format=DEFAULT_OUTPUT_FORMAT, bitrate=None):
+    """
+    Split audio file at specified timestamps. PCM WAV into WAV segments is
+    sliced byte for byte, without decoding.
+    """
+    spec = OUTPUT_FORMATS[output_format]
+    wav = read_pcm_wav(audio_path) if output_format == 'wav' else None
+    if wav is not None:
+        audio = None
+        duration = wav.duration
+    else:
+        from pydub import AudioSegment
+
+        audio = AudioSegment.from_file(audio_path)
+        duration = len(audio) / 1000.0
+    segments = []
+
+    # Add start and end points
+    all_points = [0.0] + split_points + [duration]
+
+    for i in range(len(all_points) - 1):
+        segments.append({
+            'filename': segment_filename(i, output_format),
+            'start_time': all_points[i],
+            'end_time': all_points[i + 1],
+            'duration': all_points[i + 1] - all_points[i]
+        })
+
+    if wav is not None:
+        write_slices(wav, [(seg['start_time'], seg['end_time']) for seg in segments],
+                     [os.path.join(output_dir, seg['filename']) for seg in segments])
+        return segments
+
+    for seg in segments:
+        start_ms = int(seg['start_time'] * 1000)
+        end_ms = int(seg['end_time'] * 1000)
+
+        segment_audio = audio[start_ms:end_ms]
+        segment_path = os.path.join(output_dir, seg['filename'])
+
+        # Export segment
+        if output_format == 'wav':
+            write_wav(segment_audio, segment_path)
+        else:
+            segment_audio.export(segment_path, format=spec['format'], codec=spec['codec'], bitrate=bitrate)
+
+    return segments
+
+
+def plan_segments(transcript, max_duration, audio_duration, output_format=DEFAULT_OUTPUT_FORMAT,
+                  split_mode=DEFAULT_SPLIT_MODE):
+    """
+    Work out the segments split_audio_file would write, with their text,
+    without touching the audio. Segments can then be rendered one at a time.
+    """
+    split_points = find_split_points(transcript, max_duration=max_duration, split_mode=split_mode)
+    all_points = [0.0] + split_points + [audio_duration]
+
+    segments = []
+    for i in range(len(all_points) - 1):
+        segments.append({
+            'filename': segment_filename(i, output_format),
+            'start_time': all_points[i],
+            'end_time': all_points[i + 1],
+            'duration': all_points[i + 1] - all_points[i]
+        })
+
+    return extract_text_for_segments(transcript, segments)
+
+
+class IncrementalPlanner:
+    """
+    plan_segments for a transcript that arrives in pieces. A cut is only
+    emitted once a later word proves it can't change (a final word ends past
+    the cut's window), so the segments match plan_segments on the whole
+    transcript, and each one can be encoded as soon as it is emitted.
+    """
+
+    def __init__(self, max_duration, output_format=DEFAULT_OUTPUT_FORMAT, split_mode=DEFAULT_SPLIT_MODE):
+        self.max_duration = max_duration
+        self.output_format = output_format
+        self.split_mode = split_mode
+        self.segments = []
+        self._builder = TranscriptBuilder()
+        self._current_start = 0.0
+        self._segment_start = 0.0
+
+    def feed(self, words):
+        """
+        Add final words, in time order. Returns the segments that became final.
+        """
+        for start, end, text in words:
+            self._builder.append(start, end, text)
+        return self._advance(final=False)
+
+    def finish(self, audio_duration):
+        """
+        The transcript is complete; returns the remaining segments, the last
+        one running to the end of the audio.
+        """
+        new = self._advance(final=True)
+        new.append(self._emit(self._builder.build(), audio_duration))
+        return new
+
+    def _advance(self, final):
+        transcript = self._builder.build()
+        total_duration = transcript.duration
+        new = []
+        while self._current_start < total_duration:
+            # Until a word ends past this window, later words could still change the cut
+            if not final and total_duration <= self._current_start + self.max_duration:
+                break
+            self._current_start, at_punctuation = _next_split(
+                transcript, self._current_start, self.max_duration, self.split_mode
+            )
+            if at_punctuation or self._current_start < total_duration:
+                new.append(self._emit(transcript, self._current_start))
+        return new
+
+    def _emit(self, transcript, end_time):
+        start_time = self._segment_start
+        segment = {
+            'filename': segment_filename(len(self.segments), self.output_format),
+            'start_time': start_time,
+            'end_time': end_time,
+            'duration': end_time - start_time,
+            'text': transcript.slice_time(start_time, end_time).text
+        }
+        self.segments.append(segment)
+        self._segment_start = end_time
+        return segment
+
+
+def render_segment(audio_path, start_time, end_time, output_path, output_format=DEFAULT_OUTPUT_FORMAT, bitrate=None,
+                   cancel=None):
+    """
+    Encode one segment straight from the source file. Seeking on the input side
+    means ffmpeg only decodes this segment's audio, not everything before it.
+    ffmpeg is killed if `cancel` fires. PCM WAV into WAV is sliced instead.
+    """
+    if output_format == 'wav':
+        wav = read_pcm_wav(audio_path)
+        if wav is not None:
+            write_slices(wav, [(start_time, end_time)], [output_path])
+            return
+
+    spec = OUTPUT_FORMATS[output_format]
+    # Same millisecond cut points as split_audio_file
+    start_ms = int(start_time * 1000)
+    end_ms = int(end_time * 1000)
+
+    ffmpeg_cmd = [
+        'ffmpeg', '-nostdin', '-y', '-loglevel', 'error',
+        '-ss', f'{start_ms / 1000:.3f}',
+        '-i', audio_path,
+        '-t', f'{(end_ms - start_ms) / 1000:.3f}',
+        '-vn', '-c:a', spec['encoder']
+    ]
+    if bitrate:
+        ffmpeg_cmd += ['-b:a', bitrate]
+    ffmpeg_cmd += ['-f', spec['format'], output_path]
+
+    result = run_subprocess(ffmpeg_cmd, RENDER_TIMEOUT, cancel)
+    if result.returncode != 0:
+        raise Exception(f'FFmpeg failed: {result.stderr}')
+
+
+def extract_text_for_segments(transcript, audio_segments):
+    """
+    Extract transcript text for each audio segment.
+    """
+    if not isinstance(transcript, Transcript):
+        transcript = Transcript.from_segments(transcript)
+
+    for audio_seg in audio_segments:
+        # Words that overlap the audio segment, as one slice of the text buffer
+        audio_seg['text'] = transcript.slice_time(audio_seg['start_time'], audio_seg['end_time']).text
+
+    return audio_segments
+
+
+def export_segments(audio_path, transcript, max_duration, output_dir, original_file,
+                    output_format=DEFAULT_OUTPUT_FORMAT, bitrate=None):
+    """
+    Split the audio along the transcript and write segments, per-segment
+    transcripts and metadata.json into output_dir. Returns the metadata.
+    """
+    output_format, bitrate = normalize_output_options(output_format, bitrate)
+
+    # Step 2: Find split points
+    split_points = find_split_points(transcript, max_duration=max_duration)
+    log.info('split', 'Split points found', segments=len(split_points) + 1)
+    log.dump('split', 'Split points', split_points)
+
+    # Step 3: Split audio
+    os.makedirs(output_dir, exist_ok=True)
+
+    audio_segments = split_audio_file(audio_path, split_points, output_dir, output_format, bitrate)
+
+    # Step 4: Extract text for each segment
+    audio_segments = extract_text_for_segments(transcript, audio_segments)
+
+    # Save transcript files
+    for seg in audio_segments:
+        txt_filename = os.path.splitext(seg['filename'])[0] + '.txt'
+        txt_path = os.path.join(output_dir, txt_filename)
+        with open(txt_path, 'w', encoding='utf-8') as f:
+            f.write(seg['text'])
+
+    # Save metadata
+    metadata = {
+        'original_file': original_file,
+        'total_segments': len(audio_segments),
+        'max_duration': max_duration,
+        'output_format': output_format,
+        'bitrate': bitrate,
+        'segments': audio_segments,
+        'full_transcript': transcript.text
+    }
+
+    metadata_path = os.path.join(output_dir, 'metadata.json')
+    with open(metadata_path, 'w', encoding='utf-8') as f:
+        json.dump(metadata, indent=2, fp=f)
+
+    return metadata
+
+
+def write_segments_to_zip(zipf, output_dir, prefix=''):
+    """
+    Add an export directory to an open ZIP with organized folders.
+    """
+    for root, dirs, files in os.walk(output_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+
+            # Organize files into subfolders
+            if os.path.splitext(file)[1] in AUDIO_OUTPUT_EXTENSIONS:
+                arcname = os.path.join(prefix, 'audio', file)
+            elif file.endswith('.txt'):
+                arcname = os.path.join(prefix, 'transcripts', file)
+            else:
+                arcname = os.path.join(prefix, file)
+
+            zipf.write(file_path, arcname)
+
+
+def zip_segments(output_dir, zip_path):
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        write_segments_to_zip(zipf, output_dir)
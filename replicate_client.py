@@ -0,0 +1,140 @@
+"""
+Per-API-key Replicate clients.
+
+Each key gets its own replicate.Client, so concurrent jobs from different
+users never share a token and HTTP connections are reused across that key's
+requests. Each client also limits how many predictions the key runs at once
+(queued jobs get slots shortest first) and how fast it calls the API, and
+retries 429/5xx responses with jittered exponential backoff. Creating a
+prediction is only retried when the request provably created nothing, since
+a second attempt after the server accepted the first is a second bill.
+"""
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import log
+
+import httpx
+import replicate
+from replicate.exceptions import ReplicateError
+
+from scheduler import ShortestJobFirst, TokenBucket
+
+MAX_CONCURRENT_PREDICTIONS = 4  # Per key
+REQUESTS_PER_SECOND = 5.0  # Per key, sustained
+REQUEST_BURST = 10  # Per key
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+MAX_CACHED_CLIENTS = 128
+
+TERMINAL_STATUSES = ('succeeded', 'failed', 'canceled')
+
+
+def _is_retryable(error):
+    if isinstance(error, ReplicateError):
+        return error.status == 429 or (error.status or 0) >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _is_retryable_create(error):
+    # Only failures that mean the request never reached the API, or was turned away
+    if isinstance(error, ReplicateError):
+        return error.status == 429
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def _backoff(attempt):
+    # "Full jitter": spreads retries from many jobs instead of having them collide
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class ReplicateClient:
+    def __init__(self, api_key, max_concurrent=MAX_CONCURRENT_PREDICTIONS,
+                 requests_per_second=REQUESTS_PER_SECOND, burst=REQUEST_BURST):
+        self._client = replicate.Client(api_token=api_key)
+        self._predictions = ShortestJobFirst(max_concurrent)
+        self._bucket = TokenBucket(requests_per_second, burst)
+
+    @contextmanager
+    def prediction_slot(self, estimate=0, cancel=None):
+        """
+        Hold one of this key's concurrent prediction slots. `estimate` is the
+        expected seconds of work; shorter jobs are let in first. Waiting ends
+        with Cancelled if `cancel` fires.
+        """
+        with self._predictions.slot(estimate, cancel):
+            yield
+
+    def expected_wait(self, estimate=0):
+        return self._predictions.expected_wait(estimate)
+
+    def _call(self, fn, rewind=(), retryable=_is_retryable):
+        """
+        Rate-limit and retry one API call on errors `retryable` accepts. Files
+        in `rewind` are seeked back to the start before each attempt, since a
+        failed upload may have read them.
+        """
+        for attempt in range(MAX_ATTEMPTS):
+            for f in rewind:
+                f.seek(0)
+            self._bucket.acquire()
+            try:
+                return fn()
+            except Exception as e:
+                if attempt == MAX_ATTEMPTS - 1 or not retryable(e):
+                    raise
+                delay = _backoff(attempt)
+                log.warning('replicate', 'Request failed, retrying', error=repr(e), delay=round(delay, 1))
+                time.sleep(delay)
+
+    def create_prediction(self, version, input):
+        files = [value for value in input.values() if hasattr(value, 'seek')]
+        return self._call(
+            lambda: self._client.predictions.create(version=version, input=input), rewind=files,
+            retryable=_is_retryable_create
+        )
+
+    def get_prediction(self, prediction_id):
+        return self._call(lambda: self._client.predictions.get(prediction_id))
+
+    def reload(self, prediction):
+        self._call(prediction.reload)
+        return prediction
+
+    def cancel(self, prediction):
+        """
+        Best-effort cancel, e.g. when the job waiting on it is abandoned.
+        """
+        try:
+            self._call(prediction.cancel)
+            log.info('replicate', 'Prediction canceled', prediction_id=prediction.id)
+        except Exception as e:
+            log.error('replicate', 'Failed to cancel prediction', prediction_id=prediction.id, error=str(e))
+
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key):
+    """
+    Shared client for an API key. Keys are indexed by hash, and the least
+    recently used clients are dropped beyond MAX_CACHED_CLIENTS.
+    """
+    key = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = ReplicateClient(api_key)
+            if len(_clients) > MAX_CACHED_CLIENTS:
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(key)
+        return client
@@ -0,0 +1,164 @@
+"""
+Job ordering and time estimates learned from completed work.
+
+ThroughputModel keeps an EWMA of seconds of work per second of audio for each
+stage, keyed by model version (or output format) and input size, since short
+files carry proportionally more fixed overhead. ShortestJobFirst uses those
+estimates to hand out scarce slots, such as a key's concurrent Replicate
+predictions, shortest job first. Waiting jobs age so long ones still run.
+TokenBucket paces calls to rate-limited APIs.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+RATE_SMOOTHING = 0.2
+# Input size buckets, by audio duration in seconds: <1 min, <5 min, <15 min, <30 min, <1 h, longer
+SIZE_BUCKETS = (60, 300, 900, 1800, 3600)
+# Seconds of estimated work forgiven per second spent waiting
+AGING_RATE = 1.0
+
+
+def size_bucket(input_seconds):
+    return bisect.bisect_right(SIZE_BUCKETS, input_seconds)
+
+
+class ThroughputModel:
+    def __init__(self):
+        self._rates = {}  # (stage, variant) -> {bucket: seconds of work per input second}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, variant, input_seconds, elapsed):
+        if not input_seconds or input_seconds <= 0:
+            return
+        rate = elapsed / input_seconds
+        bucket = size_bucket(input_seconds)
+        with self._lock:
+            rates = self._rates.setdefault((stage, variant), {})
+            if bucket in rates:
+                rates[bucket] += RATE_SMOOTHING * (rate - rates[bucket])
+            else:
+                rates[bucket] = rate
+
+    def rate(self, stage, variant, input_seconds):
+        """
+        Learned rate for this size, else the rate of the nearest size seen. None until anything is learned.
+        """
+        bucket = size_bucket(input_seconds)
+        with self._lock:
+            rates = self._rates.get((stage, variant))
+            if not rates:
+                return None
+            nearest = min(rates, key=lambda b: (abs(b - bucket), b))
+            return rates[nearest]
+
+    def estimate(self, stage, variant, input_seconds, default_rate=None):
+        rate = self.rate(stage, variant, input_seconds)
+        if rate is None:
+            rate = default_rate
+        return None if rate is None else rate * input_seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {f'{stage}:{variant}': dict(rates) for (stage, variant), rates in self._rates.items()}
+
+
+# Shared by every job in this process
+throughput = ThroughputModel()
+
+
+class ShortestJobFirst:
+    """
+    A counting semaphore that gives each free slot to the waiter with the
+    smallest estimated job. A waiter's estimate shrinks by AGING_RATE for every
+    second it waits, so a long job is never starved. Equal estimates are
+    served first come, first served.
+    """
+
+    def __init__(self, slots, aging_rate=AGING_RATE):
+        self.slots = slots
+        self.aging_rate = aging_rate
+        self._running = {}  # token -> (estimate, started)
+        self._waiting = {}  # token -> (estimate, enqueued), in arrival order
+        self._cond = threading.Condition()
+
+    def _score(self, estimate, enqueued, now):
+        return estimate - self.aging_rate * (now - enqueued)
+
+    def _next(self):
+        now = time.monotonic()
+        return min(self._waiting, key=lambda token: self._score(*self._waiting[token], now))
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, estimate=0, cancel=None):
+        """
+        Hold a slot for the block. A waiter whose `cancel` token fires leaves
+        the queue with Cancelled.
+        """
+        token = object()
+        with cancel.on_cancel(self._wake) if cancel else nullcontext(), self._cond:
+            self._waiting[token] = (estimate or 0, time.monotonic())
+            try:
+                while len(self._running) >= self.slots or self._next() is not token:
+                    if cancel:
+                        cancel.raise_if_cancelled()
+                    self._cond.wait()
+            finally:
+                del self._waiting[token]
+                # Either way the head of the queue changed; let the others re-check
+                self._cond.notify_all()
+            self._running[token] = (estimate or 0, time.monotonic())
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                del self._running[token]
+                self._cond.notify_all()
+
+    def expected_wait(self, estimate=0):
+        """
+        Rough seconds before a job with this estimate would get a slot: the
+        remaining work of running jobs plus the waiting jobs it would queue
+        behind, spread over the slots.
+        """
+        with self._cond:
+            now = time.monotonic()
+            ahead = [est for est, enqueued in self._waiting.values() if self._score(est, enqueued, now) <= estimate]
+            if len(self._running) < self.slots and not ahead:
+                return 0
+            remaining = [max(0, est - (now - started)) for est, started in self._running.values()]
+            return (sum(remaining) + sum(ahead)) / self.slots
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, holding at most `capacity`.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
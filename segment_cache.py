@@ -0,0 +1,139 @@
+"""
+On-disk LRU cache of rendered audio segments.
+
+Entries are keyed by (content hash, start, end, format, bitrate), so the same
+cut of the same audio is encoded once no matter which job, preview or ZIP
+asks for it. File names are derived from the key, so processes sharing the
+directory also share hits.
+
+The directory is the index: a file's mtime is its last use, and each new
+entry is followed by a scan that evicts the least recently used files until
+the directory is back within max_bytes. So the budget holds for every
+process and node sharing the directory together, and no process keeps a
+stale view of what the others have written or evicted.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+STALE_TEMP_SECONDS = 60 * 60  # Unfinished renders older than this were abandoned by a dead process
+EVICT_LOCK = '.evict.lock'
+
+
+def segment_key(content_hash, start_time, end_time, output_format, bitrate):
+    # Millisecond resolution, matching how segments are cut
+    return (content_hash, int(start_time * 1000), int(end_time * 1000), output_format, bitrate or '')
+
+
+class SegmentCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._rendering = {}  # filename -> Event, so concurrent misses in this process render once
+
+        os.makedirs(directory, exist_ok=True)
+        self._evict()
+
+    @staticmethod
+    def _filename(key, extension):
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + f'.{extension}'
+
+    def _scan(self):
+        """
+        (mtime, name, size) of every entry, and remove renders abandoned by
+        a process that died. Another process's render in progress is left alone.
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.startswith('tmp_'):
+                    if stat.st_mtime < now - STALE_TEMP_SECONDS:
+                        os.remove(entry.path)
+                elif entry.is_file() and entry.name != EVICT_LOCK:
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    @property
+    def size(self):
+        return sum(size for _, _, size in self._scan())
+
+    def __len__(self):
+        return len(self._scan())
+
+    def open(self, key, extension, render):
+        """
+        Return an open binary file for the segment, calling render(dest_path)
+        on a miss. An open file stays readable if another process evicts it.
+        """
+        filename = self._filename(key, extension)
+        path = os.path.join(self.directory, filename)
+
+        while True:
+            with self._lock:
+                try:
+                    f = open(path, 'rb')
+                except FileNotFoundError:
+                    f = None
+                if f is not None:
+                    self._touch(path)
+                    return f
+
+                waiting = self._rendering.get(filename)
+                if waiting is None:
+                    self._rendering[filename] = threading.Event()
+                    break
+
+            # Someone else in this process is rendering this segment; wait and try again
+            waiting.wait()
+
+        try:
+            temp_path = os.path.join(self.directory, f'tmp_{uuid.uuid4().hex}.{extension}')
+            try:
+                render(temp_path)
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+            f = open(path, 'rb')
+            self._evict(keep=filename)
+            return f
+        finally:
+            with self._lock:
+                self._rendering.pop(filename).set()
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict(self, keep=None):
+        # One process evicts at a time; the others' new entries are seen by its scan
+        with open(os.path.join(self.directory, EVICT_LOCK), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = sorted(self._scan())
+            size = sum(entry_size for _, _, entry_size in entries)
+            for _, filename, entry_size in entries:
+                if size <= self.max_bytes:
+                    break
+                if filename == keep:
+                    continue
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
@@ -0,0 +1,175 @@
+"""
+Compact columnar storage for word-level transcript timings.
+
+Whisper returns one record per word, so a multi-hour transcript is hundreds of
+thousands of entries. Instead of a list of dicts, word timings are kept as two
+parallel array('d') columns plus a single text buffer with offsets.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class Transcript:
+    """
+    Word timings stored as parallel arrays, ordered by end time.
+
+    All word texts live in one string separated by single spaces. offsets[i] is
+    where word i begins and offsets[n] is len(text) + 1, so the joined text of
+    any run of words is a single slice of the buffer.
+
+    Slicing (by index or by time range) returns a view over the same arrays and
+    text buffer; nothing is copied.
+    """
+
+    __slots__ = ('_starts', '_ends', '_offsets', '_buffer', '_lo', '_hi')
+
+    def __init__(self, starts=None, ends=None, offsets=None, buffer='', lo=0, hi=None):
+        self._starts = starts if starts is not None else array('d')
+        self._ends = ends if ends is not None else array('d')
+        self._offsets = offsets if offsets is not None else array('q', [0])
+        self._buffer = buffer
+        self._lo = lo
+        self._hi = len(self._starts) if hi is None else hi
+
+    def __len__(self):
+        return self._hi - self._lo
+
+    def __bool__(self):
+        return self._hi > self._lo
+
+    def __iter__(self):
+        starts, ends, offsets, buffer = self._starts, self._ends, self._offsets, self._buffer
+        for i in range(self._lo, self._hi):
+            yield starts[i], ends[i], buffer[offsets[i]:offsets[i + 1] - 1]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            lo, hi, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('Transcript views do not support a step')
+            return self._view(self._lo + lo, self._lo + max(lo, hi))
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('Transcript index out of range')
+        i = self._lo + key
+        return self._starts[i], self._ends[i], self._word(i)
+
+    def __repr__(self):
+        return f'<Transcript {len(self)} words, {self.duration:.1f}s>'
+
+    def _view(self, lo, hi):
+        return Transcript(self._starts, self._ends, self._offsets, self._buffer, lo, hi)
+
+    def _word(self, i):
+        return self._buffer[self._offsets[i]:self._offsets[i + 1] - 1]
+
+    @property
+    def starts(self):
+        """Zero-copy view of the start times in this transcript"""
+        return memoryview(self._starts)[self._lo:self._hi]
+
+    @property
+    def ends(self):
+        """Zero-copy view of the end times in this transcript"""
+        return memoryview(self._ends)[self._lo:self._hi]
+
+    @property
+    def duration(self):
+        """End time of the last word, or 0 for an empty transcript"""
+        return self._ends[self._hi - 1] if self else 0.0
+
+    @property
+    def text(self):
+        """All words in this transcript joined by single spaces"""
+        if not self:
+            return ''
+        return self._buffer[self._offsets[self._lo]:self._offsets[self._hi] - 1]
+
+    def ending_within(self, after, until):
+        """
+        View of the words whose end time falls in (after, until].
+        """
+        lo = bisect_right(self._ends, after, self._lo, self._hi)
+        hi = bisect_right(self._ends, until, lo, self._hi)
+        return self._view(lo, hi)
+
+    def slice_time(self, start, end):
+        """
+        View of the words that overlap the closed interval [start, end].
+        Whisper emits words in time order, so starts are ordered as well as ends.
+        """
+        lo = bisect_left(self._ends, start, self._lo, self._hi)
+        hi = bisect_right(self._starts, end, lo, self._hi)
+        return self._view(lo, hi)
+
+    def to_segments(self):
+        """
+        Expand back into the list-of-dicts shape, for JSON output.
+        """
+        return [{'start': start, 'end': end, 'text': text} for start, end, text in self]
+
+    @classmethod
+    def from_segments(cls, segments):
+        """
+        Build a transcript from dicts with 'start', 'end' and 'text' keys.
+        Missing or None timestamps are treated the same way Whisper output is.
+        """
+        builder = TranscriptBuilder()
+        for seg in segments:
+            builder.append(seg.get('start', 0), seg.get('end'), seg.get('text', ''))
+        return builder.build()
+
+
+class TranscriptBuilder:
+    """
+    Accumulates words into the columnar layout without building dicts.
+    """
+
+    def __init__(self):
+        self._starts = array('d')
+        self._ends = array('d')
+        self._offsets = array('q', [0])
+        self._parts = []
+        self._length = 0
+        self._ordered = True
+
+    def __len__(self):
+        return len(self._starts)
+
+    def append(self, start, end, text):
+        """
+        Add one word. Empty text is skipped; None timestamps become 0 / start.
+        """
+        text = (text or '').strip()
+        if not text:
+            return
+
+        if start is None:
+            start = 0
+        if end is None:
+            end = start
+
+        if self._ends and end < self._ends[-1]:
+            self._ordered = False
+
+        self._starts.append(start)
+        self._ends.append(end)
+        self._parts.append(text)
+        self._length += len(text) + 1
+        self._offsets.append(self._length)
+
+    def build(self):
+        """
+        Freeze the accumulated words into a Transcript.
+        """
+        if self._ordered:
+            return Transcript(self._starts, self._ends, self._offsets, ' '.join(self._parts))
+
+        # Rare: out-of-order timestamps. Re-sort by end time once, here.
+        order = sorted(range(len(self._ends)), key=self._ends.__getitem__)
+        builder = TranscriptBuilder()
+        for i in order:
+            builder.append(self._starts[i], self._ends[i], self._parts[i])
+        return builder.build()
@@ -0,0 +1,50 @@
+"""
+On-disk cache of Whisper transcripts, keyed by audio content hash.
+
+Transcription is the slow, billed stage, so a rerun over the same files (or a
+run that was killed halfway) only pays for files it hasn't transcribed yet.
+"""
+import json
+import os
+import uuid
+
+from pipeline import WHISPER_VERSION, transcribe
+from transcript import Transcript
+
+
+class TranscriptCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, content_hash):
+        # Keyed by model version too, so switching models doesn't serve stale transcripts
+        return os.path.join(self.directory, f'{WHISPER_VERSION[:12]}_{content_hash}.json')
+
+    def get(self, content_hash):
+        try:
+            with open(self._path(content_hash), encoding='utf-8') as f:
+                return Transcript.from_segments(json.load(f))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Unreadable entry, e.g. from a disk that filled up; transcribe again
+            return None
+
+    def put(self, content_hash, transcript):
+        path = self._path(content_hash)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(transcript.to_segments(), f)
+        os.replace(temp_path, path)
+
+    def transcribe(self, audio_path, content_hash, api_key):
+        """
+        Cached transcript for the file, transcribing it on a miss.
+        """
+        transcript = self.get(content_hash)
+        if transcript is None:
+            transcript = transcribe(audio_path, api_key)
+            if transcript:
+                self.put(content_hash, transcript)
+        return transcript
@@ -0,0 +1,371 @@
+"""
+Single-pass parsers for Whisper transcripts in SRT, WebVTT and JSON form.
+
+Every parser feeds words straight into a TranscriptBuilder, so a transcript is
+never held as a full string plus a full dict tree at the same time. URL
+outputs are parsed incrementally as the response streams in.
+"""
+import io
+import json
+import re
+from itertools import chain
+
+from transcript import TranscriptBuilder
+
+# SRT uses "00:00:01,000", WebVTT uses "00:01.000" or "00:00:01.000"
+CUE_TIMING = re.compile(
+    r'(?:(\d+):)?(\d{2}):(\d{2})[,.](\d{3})\s*-->\s*(?:(\d+):)?(\d{2}):(\d{2})[,.](\d{3})'
+)
+CUE_TAG = re.compile(r'<[^>]*>')
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_STRUCTURAL = re.compile(r'["{}\[\]]')
+JSON_STRING_SPECIAL = re.compile(r'["\\]')
+JSON_SCALAR_END = re.compile(r'[,}\]\s]')
+
+# Top-level JSON keys that hold word timings, in the order the old parser preferred them
+WORD_ARRAY_KEYS = ('segments', 'chunks', 'words')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+FETCH_TIMEOUT = 300
+
+
+def parse_output(output):
+    """
+    Convert whatever the Whisper prediction returned into a Transcript: a URL
+    to a transcript file, an SRT/VTT/JSON string, or already-decoded JSON.
+    """
+    if isinstance(output, str):
+        if output.startswith('http'):
+            return fetch_transcript(output)
+        return parse_text(output)
+
+    builder = TranscriptBuilder()
+
+    if isinstance(output, list):
+        for entry in output:
+            _append_entry(builder, entry)
+    elif isinstance(output, dict):
+        for key in WORD_ARRAY_KEYS:
+            if output.get(key):
+                for entry in output[key]:
+                    _append_entry(builder, entry)
+                break
+        else:
+            # Simple text output, try to parse if it's SRT
+            if output.get('text'):
+                return parse_text(output['text'])
+
+    return builder.build()
+
+
+def parse_text(text):
+    """
+    Parse an SRT, WebVTT or JSON transcript held in memory.
+    """
+    return parse_stream([text])
+
+
+def fetch_transcript(url, timeout=FETCH_TIMEOUT, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Download and parse a transcript file, consuming the body as it arrives.
+    """
+    import urllib.request
+
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        reader = io.TextIOWrapper(response, encoding='utf-8')
+        return parse_stream(iter(lambda: reader.read(chunk_size), ''))
+
+
+def parse_stream(chunks):
+    """
+    Parse a transcript delivered as an iterable of text chunks. The format is
+    sniffed from the first non-whitespace character.
+    """
+    chunks = iter(chunks)
+    head = ''
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+
+    builder = TranscriptBuilder()
+    chunks = chain([head], chunks)
+
+    if head.lstrip()[:1] in ('{', '['):
+        srt_text = _parse_json(chunks, builder)
+        if srt_text and not builder:
+            _parse_cues(_iter_lines([srt_text]), builder)
+    else:
+        _parse_cues(_iter_lines(chunks), builder)
+
+    return builder.build()
+
+
+def _append_entry(builder, entry):
+    """
+    Add one JSON segment, chunk or word to the builder.
+    """
+    if not isinstance(entry, dict):
+        return
+
+    if entry.get('words'):
+        # If segment has words, use word-level timestamps for better precision
+        for word in entry['words']:
+            start = word.get('start', 0)
+            builder.append(start, word.get('end', start), word.get('word', word.get('text', '')))
+    elif 'timestamp' in entry:
+        start, end = entry['timestamp'] or (0, 0)
+        builder.append(start, end, entry.get('text', ''))
+    else:
+        start = entry.get('start', 0)
+        builder.append(start, entry.get('end', start), entry.get('word', entry.get('text', '')))
+
+
+def _iter_lines(chunks):
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def _cue_seconds(hours, minutes, seconds, millis):
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000.0
+
+
+def _parse_cues(lines, builder):
+    """
+    Line-by-line state machine shared by SRT and WebVTT. Cue numbers, NOTE and
+    STYLE blocks are skipped because they never follow a timing line.
+    """
+    strip_tags = False
+    start = end = None
+    text = []
+
+    for line in lines:
+        line = line.strip()
+
+        if '-->' in line:
+            match = CUE_TIMING.match(line)
+            if match:
+                if start is not None:
+                    builder.append(start, end, ' '.join(text))
+                groups = match.groups()
+                start, end = _cue_seconds(*groups[:4]), _cue_seconds(*groups[4:])
+                text = []
+                continue
+
+        if start is None:
+            if line.startswith('WEBVTT'):
+                # WebVTT cues may carry <c>, <v Speaker> and inline timestamp tags
+                strip_tags = True
+        elif line:
+            text.append(CUE_TAG.sub('', line) if strip_tags else line)
+        else:
+            builder.append(start, end, ' '.join(text))
+            start = end = None
+            text = []
+
+    if start is not None:
+        builder.append(start, end, ' '.join(text))
+
+
+def _parse_json(chunks, builder):
+    """
+    Walk a JSON transcript without building the document. Word arrays are
+    decoded one element at a time; other values are skipped unread. Returns an
+    SRT 'text' value if one was found, for outputs with no word arrays.
+    """
+    stream = _JsonStream(chunks)
+
+    if stream.peek() == '[':
+        for entry in stream.iter_array():
+            _append_entry(builder, entry)
+        return None
+
+    srt_text = None
+    source = None
+
+    stream.expect('{')
+    if stream.peek() == '}':
+        return None
+
+    while True:
+        key = stream.decode()
+        stream.expect(':')
+        value_start = stream.peek()
+
+        if key in WORD_ARRAY_KEYS and source in (None, key) and value_start == '[':
+            # The first word-bearing array wins, as with the in-memory parser
+            for entry in stream.iter_array():
+                _append_entry(builder, entry)
+            if builder:
+                source = key
+        elif key == 'text' and value_start == '"' and _looks_timed(stream.peek_prefix(512)):
+            srt_text = stream.decode()
+        else:
+            # e.g. the full plain-text transcript, which can be megabytes
+            stream.skip_value()
+
+        if stream.peek() == ',':
+            stream.advance()
+            continue
+        stream.expect('}')
+        return srt_text
+
+
+def _looks_timed(prefix):
+    return '-->' in prefix or prefix.lstrip('"').startswith('WEBVTT')
+
+
+class _JsonStream:
+    """
+    Minimal pull tokenizer over a sequence of text chunks. Only the unconsumed
+    tail of the input is buffered.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """
+        Append the next chunk, dropping what has been consumed. Returns False
+        at the end of input.
+        """
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Next non-whitespace character, or '' at the end of input.
+        """
+        while True:
+            self._pos = JSON_WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def peek_prefix(self, size):
+        self.peek()
+        while len(self._buf) - self._pos < size and self._fill():
+            pass
+        return self._buf[self._pos:self._pos + size]
+
+    def advance(self):
+        self._pos += 1
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'Malformed transcript JSON: expected {char!r}, found {found!r}')
+        self._pos += 1
+
+    def decode(self):
+        """
+        Decode one complete value, reading more input until it is available.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise ValueError('Malformed transcript JSON')
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.decode()
+            found = self.peek()
+            self._pos += 1
+            if found == ']':
+                return
+            if found != ',':
+                raise ValueError(f'Malformed transcript JSON: expected \',\' or \']\', found {found!r}')
+
+    def skip_value(self):
+        """
+        Consume one value without materializing it.
+        """
+        first = self.peek()
+
+        if first not in '"{[':
+            # Number or literal
+            while True:
+                match = JSON_SCALAR_END.search(self._buf, self._pos)
+                if match:
+                    self._pos = match.start()
+                    return
+                self._pos = len(self._buf)
+                if not self._fill():
+                    return
+
+        depth = 0
+        in_string = False
+        if first == '"':
+            in_string = True
+            self._pos += 1
+
+        while True:
+            buf = self._buf
+            if self._pos >= len(buf):
+                if not self._fill():
+                    raise ValueError('Malformed transcript JSON: unexpected end of input')
+                continue
+
+            if in_string:
+                match = JSON_STRING_SPECIAL.search(buf, self._pos)
+                if not match:
+                    self._pos = len(buf)
+                elif match.group() == '\\':
+                    if match.end() >= len(buf):
+                        # Escape split across chunks; keep the backslash and read on
+                        self._pos = match.start()
+                        if not self._fill():
+                            raise ValueError('Malformed transcript JSON: unexpected end of input')
+                    else:
+                        self._pos = match.end() + 1
+                else:
+                    self._pos = match.end()
+                    in_string = False
+                    if depth == 0:
+                        return
+            else:
+                match = JSON_STRUCTURAL.search(buf, self._pos)
+                if not match:
+                    self._pos = len(buf)
+                    continue
+                self._pos = match.end()
+                char = match.group()
+                if char == '"':
+                    in_string = True
+                elif char in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return
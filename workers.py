@@ -0,0 +1,50 @@
+"""
+Process pool for CPU-bound stages (pydub decoding, segment encoding).
+
+Running these in separate processes keeps them from competing for the GIL
+with request handling threads. The pool is created on first use, after any
+WSGI server has forked its workers.
+"""
+import os
+import threading
+
+_pool = None
+_pool_lock = threading.Lock()
+_max_workers = None
+
+
+def configure(max_workers=None):
+    """
+    Set the pool size. Takes effect when the pool is next created.
+    """
+    global _max_workers
+    _max_workers = max_workers
+
+
+def get_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Forking a multi-threaded server is unsafe; start children from a clean process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _pool = ProcessPoolExecutor(max_workers=_max_workers or os.cpu_count(), mp_context=context)
+        return _pool
+
+
+def run_in_process(fn, *args, **kwargs):
+    """
+    Run a picklable top-level function in the pool and wait for its result.
+    """
+    return get_process_pool().submit(fn, *args, **kwargs).result()
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
@@ -0,0 +1,19 @@
+"""
+Production entry point for WSGI servers, e.g.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Uploads and outputs default to one shared directory so a ZIP produced by one
+worker process can be downloaded through another. Override it with
+AUDIO_SEGMENTER_UPLOAD_FOLDER. The job database and caches go in a private
+'.state' directory next to it (AUDIO_SEGMENTER_STATE_FOLDER).
+"""
+import os
+import tempfile
+
+from app import create_app
+
+app = create_app({
+    'UPLOAD_FOLDER': os.environ.get('AUDIO_SEGMENTER_UPLOAD_FOLDER')
+    or os.path.join(tempfile.gettempdir(), 'audio-segmenter'),
+})